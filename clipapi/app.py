@@ -1,7 +1,7 @@
 import os
 import traceback
 
-from flask import Flask, request, current_app, jsonify
+from flask import Flask, request, current_app
 from waitress import serve
 
 from models.open_clip.main import (
@@ -11,32 +11,13 @@ from models.open_clip.main import (
 from predict.image.setup import ModelsPack
 from shared.helpers import download_images, download_images_from_s3
 import time
-import boto3
-from boto3_type_annotations.s3 import ServiceResource
-from botocore.config import Config
-from upload.constants import (
-    S3_ACCESS_KEY_ID,
-    S3_BUCKET_NAME_UPLOAD,
-    S3_ENDPOINT_URL,
-    S3_REGION,
-    S3_SECRET_ACCESS_KEY,
-)
+from upload.constants import S3_BUCKET_NAME_UPLOAD
+from shared.s3 import get_s3_client
+from shared.serialize import EMBEDDING_ENCODINGS, dumps_json
 from shared.helpers import time_code_block
 
 clipapi = Flask(__name__)
 
-s3: ServiceResource = boto3.resource(
-    "s3",
-    region_name=S3_REGION,
-    endpoint_url=S3_ENDPOINT_URL,
-    aws_access_key_id=S3_ACCESS_KEY_ID,
-    aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-    config=Config(
-        retries={"max_attempts": 3, "mode": "standard"}, max_pool_connections=300
-    ),
-)
-bucket = s3.Bucket(S3_BUCKET_NAME_UPLOAD)
-
 
 @clipapi.route("/health", methods=["GET"])
 def health():
@@ -48,6 +29,7 @@ def clip_embed():
     s = time.time()
     with current_app.app_context():
         models_pack: ModelsPack = current_app.models_pack
+        s3 = current_app.s3
     authheader = request.headers.get("Authorization")
     if authheader is None:
         return "Unauthorized", 401
@@ -65,6 +47,11 @@ def clip_embed():
         if isinstance(req_body, list) is not True:
             return "Body should be an array", 400
 
+    # Opt-in binary embeddings, see EMBEDDING_ENCODINGS
+    embedding_encoding = request.args.get("embedding_encoding", "float")
+    if embedding_encoding not in EMBEDDING_ENCODINGS:
+        return f"embedding_encoding should be one of {EMBEDDING_ENCODINGS}", 400
+
     embeds = [None for _ in range(len(req_body))]
     textObjects = []
     imageObjects = []
@@ -83,6 +70,7 @@ def clip_embed():
             texts,
             models_pack.open_clip["model"],
             models_pack.open_clip["tokenizer"],
+            embedding_encoding,
         )
         for i, embed in enumerate(text_embeds):
             item = textObjects[i]["item"]
@@ -109,6 +97,7 @@ def clip_embed():
             pil_images,
             models_pack.open_clip["model"],
             models_pack.open_clip["processor"],
+            embedding_encoding,
         )
         for i, embed in enumerate(image_embeds):
             item = imageObjects[i]["item"]
@@ -127,7 +116,10 @@ def clip_embed():
         try:
             with time_code_block(prefix=f"Downloaded {len(image_ids)} image(s)"):
                 pil_images = download_images_from_s3(
-                    keys=image_ids, bucket=bucket, max_workers=100
+                    keys=image_ids,
+                    s3=s3,
+                    bucket=S3_BUCKET_NAME_UPLOAD,
+                    max_workers=100,
                 )
         except Exception as e:
             tb = traceback.format_exc()
@@ -145,6 +137,7 @@ def clip_embed():
             filtered_pil_images,
             models_pack.open_clip["model"],
             models_pack.open_clip["processor"],
+            embedding_encoding,
         )
 
         for i, embed in enumerate(image_embeds):
@@ -172,7 +165,9 @@ def clip_embed():
 
     e = time.time()
     print(f"🖥️  Embedded {len(req_body)} items in: {e-s:.2f} seconds  🖥️\n")
-    return jsonify({"embeddings": embeds})
+    return current_app.response_class(
+        dumps_json({"embeddings": embeds}), mimetype="application/json"
+    )
 
 
 def run_clipapi(models_pack: ModelsPack):
@@ -180,5 +175,7 @@ def run_clipapi(models_pack: ModelsPack):
     port = os.environ.get("CLIPAPI_PORT", 13339)
     with clipapi.app_context():
         current_app.models_pack = models_pack
+        # Created when the API starts, not when the module is imported
+        current_app.s3 = get_s3_client("clipapi")
     # clipapi.run(host=host, port=port)
     serve(clipapi, host=host, port=port)
@@ -1,31 +1,22 @@
 from threading import Thread, Event
-from typing import Any, Dict
+from typing import Any, Callable, Tuple
 import logging
 import os
 import signal
-import queue
 
 import redis
-import boto3
-from boto3_type_annotations.s3 import ServiceResource
-from botocore.config import Config
 from dotenv import load_dotenv
 import torch
 
-from predict.image.setup import setup as image_setup
-from predict.voiceover.setup import setup as voiceover_setup
-from rdqueue.worker import start_redis_queue_worker
 from rabbitmq_consumer.worker import start_amqp_queue_worker
 from rabbitmq_consumer.connection import RabbitMQConnection
-from upload.constants import (
-    S3_ACCESS_KEY_ID,
-    S3_BUCKET_NAME_UPLOAD,
-    S3_ENDPOINT_URL,
-    S3_REGION,
-    S3_SECRET_ACCESS_KEY,
-)
+from upload.constants import S3_BUCKET_NAME_UPLOAD
+from upload.upload_queue import UploadQueue
 from upload.worker import start_upload_worker
-from clipapi.app import run_clipapi
+from shared.constants import WORKER_OFFLINE
+from shared.offline import enable_offline_mode
+from shared.s3 import get_s3_client
+from shared.webhook import webhook_dispatcher
 
 """ import subprocess
 import sys
@@ -40,6 +31,20 @@ logging.basicConfig(
 # Define an event to signal all threads to exit
 shutdown_event = Event()
 
+
+def import_worker_stack(worker_type: str) -> Tuple[Callable[[], Any], Callable | None]:
+    """Imports only the models of the worker type, returns its setup and the clipapi runner"""
+    if worker_type == "voiceover":
+        from predict.voiceover.setup import setup as voiceover_setup
+
+        return voiceover_setup, None
+
+    from predict.image.setup import setup as image_setup
+    from clipapi.app import run_clipapi
+
+    return image_setup, run_clipapi
+
+
 if __name__ == "__main__":
     if torch.cuda.is_available() is False:
         os.environ["CUDA_VISIBLE_DEVICES"] = "0"
@@ -64,30 +69,22 @@ if __name__ == "__main__":
     if redisWorkerId is None:
         raise ValueError("Missing WORKER_NAME environment variable.")
 
-    # S3 client
-    s3: ServiceResource = boto3.resource(
-        "s3",
-        region_name=S3_REGION,
-        endpoint_url=S3_ENDPOINT_URL,
-        aws_access_key_id=S3_ACCESS_KEY_ID,
-        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
-        config=Config(
-            retries={"max_attempts": 3, "mode": "standard"},
-            connect_timeout=5,
-            read_timeout=5,
-        ),
-    )
+    # S3 client, shared by the upload threads
+    s3 = get_s3_client("upload")
+
+    if WORKER_OFFLINE:
+        # Before the model libraries are imported, they read it from the environment
+        enable_offline_mode()
 
-    if WORKER_TYPE == "voiceover":
-        models_pack = voiceover_setup()
-    else:
-        models_pack = image_setup()
+    setup, run_clipapi = import_worker_stack(WORKER_TYPE)
+    models_pack = setup()
 
     # Setup redis
     redisConn = redis.BlockingConnectionPool.from_url(redisUrl)
 
     # Create queue for thread communication
-    upload_queue: queue.Queue[Dict[str, Any]] = queue.Queue()
+    # Bounded by the memory of its outputs, spills to disk past it
+    upload_queue = UploadQueue()
 
     # Create rabbitmq connection
     connection = RabbitMQConnection(amqpUrl)
@@ -97,7 +94,8 @@ if __name__ == "__main__":
         if not shutdown_event.is_set():
             print("Signal received, shutting down...")
             shutdown_event.set()
-            connection.connection.close()
+            # The worker thread finishes in-flight jobs and closes the connection
+            connection.stop_consuming()
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
@@ -134,6 +132,8 @@ if __name__ == "__main__":
             clipapi_thread.join()
         mq_worker_thread.join()
         upload_thread.join()
+        # Webhooks of the last jobs are still in the outbox
+        webhook_dispatcher.shutdown()
     except KeyboardInterrupt:
         pass  # Handle Ctrl+C gracefully. The signal handler already sets the shutdown_event.
     finally:
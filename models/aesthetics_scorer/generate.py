@@ -1,6 +1,6 @@
 import torch
-from .model import preprocess
-from models.constants import DEVICE
+from typing import List
+from .model import FusedAestheticScorers, preprocess
 
 
 def normalize(value, range_min, range_max):
@@ -28,17 +28,17 @@ class AestheticScoreResult:
 
 
 def generate_aesthetic_scores(
-    img, rating_model, artifacts_model, vision_model, clip_processor
-) -> AestheticScoreResult:
-    inputs = clip_processor(images=img, return_tensors="pt").to(DEVICE)
-    with torch.no_grad():
-        vision_output = vision_model(**inputs)
-    pooled_output = vision_output.pooler_output
+    pooled_output: torch.Tensor, fused_model: FusedAestheticScorers
+) -> List[AestheticScoreResult]:
+    """Scores a batch from the pooled output of the CLIP vision model.
+    Both heads run in the fused model and the scores come back in one transfer."""
     embedding = preprocess(pooled_output)
     with torch.no_grad():
-        rating = rating_model(embedding)
-        artifact = artifacts_model(embedding)
-    return AestheticScoreResult(
-        rating_score=normalize(rating.detach().cpu().item(), 0, 10),
-        artifact_score=normalize(artifact.detach().cpu().item(), 0, 5),
-    )
+        scores = fused_model(embedding).cpu().tolist()
+    return [
+        AestheticScoreResult(
+            rating_score=normalize(rating, 0, 10),
+            artifact_score=normalize(artifact, 0, 5),
+        )
+        for rating, artifact in scores
+    ]
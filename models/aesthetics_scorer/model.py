@@ -3,8 +3,12 @@ import torch.nn as nn
 import json
 import os
 import requests
+from typing import List
 from urllib.parse import urlparse
 
+from shared.constants import WORKER_OFFLINE
+from shared.offline import resolve_artifact
+
 
 class AestheticScorer(nn.Module):
     def __init__(
@@ -84,6 +88,49 @@ class AestheticScorer(nn.Module):
                     raise e
 
 
+class FusedAestheticScorers(nn.Module):
+    """Several AestheticScorer heads with the same config evaluated as one module.
+
+    The weights of each layer are stacked, so a batch of N embeddings goes through
+    all the heads with one batched matmul per layer and comes out as (N, heads).
+    """
+
+    def __init__(self, scorers: List[AestheticScorer]):
+        super().__init__()
+        config = scorers[0].config
+        for scorer in scorers[1:]:
+            if scorer.config != config:
+                raise ValueError("Only scorers with the same config can be fused.")
+        self.config = config
+
+        weights, biases = [], []
+        for layer_index, layer in enumerate(scorers[0].layers):
+            if not isinstance(layer, nn.Linear):
+                continue
+            layers = [scorer.layers[layer_index] for scorer in scorers]
+            # (heads, in, out) and (heads, 1, out) for baddbmm
+            weight = torch.stack([linear.weight.detach().t() for linear in layers])
+            bias = torch.stack([linear.bias.detach().unsqueeze(0) for linear in layers])
+            weights.append(nn.Parameter(weight, requires_grad=False))
+            biases.append(nn.Parameter(bias, requires_grad=False))
+        self.weights = nn.ParameterList(weights)
+        self.biases = nn.ParameterList(biases)
+
+    def forward(self, x):
+        # Dropout is a no-op at inference, only activations sit between the layers
+        x = x.unsqueeze(0).expand(len(self.weights[0]), -1, -1)
+        last_index = len(self.weights) - 1
+        for i, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if i < last_index and self.config["use_activation"]:
+                x = torch.relu(x)
+        if self.config["output_activation"] == "sigmoid":
+            upper, lower = 10, 1
+            x = (torch.sigmoid(x) * (upper - lower)) + lower
+        # (heads, N, 1) to (N, heads)
+        return x.squeeze(-1).t()
+
+
 def preprocess(embeddings):
     return embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
 
@@ -92,6 +139,8 @@ def download_weights(url, cache_dir):
     # Parse the filename from the URL
     parsed_url = urlparse(url)
     filename = os.path.basename(parsed_url.path)
+    if WORKER_OFFLINE:
+        return resolve_artifact(filename)
     file_path = os.path.join(cache_dir, filename)
 
     # Check if the file already exists
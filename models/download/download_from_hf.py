@@ -8,12 +8,14 @@ import concurrent.futures
 import os
 from models.swinir.constants import MODEL_DIR_SWINIR, MODEL_NAME_SWINIR
 from huggingface_hub import _login
+from shared.constants import WORKER_OFFLINE
+from shared.offline import resolve_artifact
 import time
 
 
 def download_models_from_hf(downloadAll=True):
     # Login to HuggingFace if there is a token
-    if os.environ.get("HUGGINGFACE_TOKEN"):
+    if os.environ.get("HUGGINGFACE_TOKEN") and not WORKER_OFFLINE:
         print(f"⏳ Logging in to HuggingFace")
         _login.login(token=os.environ.get("HUGGINGFACE_TOKEN"))
         print(f"✅ Logged in to HuggingFace")
@@ -69,15 +71,20 @@ def download_sd_models_concurrently_from_hf():
     executor.shutdown(wait=True)
 
 
-def download_swinir_models():
+def download_swinir_models() -> str:
+    """Returns the path of the SwinIR weights"""
+    if WORKER_OFFLINE:
+        return resolve_artifact(MODEL_NAME_SWINIR)
     print("⏳ Downloading SwinIR models...")
-    if os.path.exists(os.path.join(MODEL_DIR_SWINIR, MODEL_NAME_SWINIR)):
+    model_path = os.path.join(MODEL_DIR_SWINIR, MODEL_NAME_SWINIR)
+    if os.path.exists(model_path):
         print("✅ SwinIR models already downloaded")
     else:
         os.system(
             f"wget -q https://github.com/JingyunLiang/SwinIR/releases/download/v0.0/{MODEL_NAME_SWINIR} -P {MODEL_DIR_SWINIR}"
         )
         print("✅ Downloaded SwinIR models")
+    return model_path
 
 
 if __name__ == "__main__":
@@ -3,13 +3,17 @@ import time
 from models.kandinsky.constants import KANDIKSKY_2_1_SCHEDULERS
 from .helpers import get_scheduler
 from predict.image.setup import KandinskyPipe, KandinskyPipe_2_2
+from models.constants import DEVICE
 from shared.helpers import (
-    crop_images,
+    crop_image_tensors,
     download_and_fit_image,
     download_and_fit_image_mask,
+    image_to_mask,
     pad_image_mask_nd,
     pad_image_pil,
+    pil_images_to_tensor,
 )
+from typing import Tuple
 import torch
 from torch.cuda.amp import autocast
 
@@ -17,6 +21,19 @@ PRIOR_STEPS = 25
 PRIOR_GUIDANCE_SCALE = 4.0
 
 
+def filter_nsfw_images(
+    images: torch.Tensor, safety_checker
+) -> Tuple[torch.Tensor, int]:
+    """Drops the NSFW images of an (N, 3, H, W) batch, checked in one batched pass.
+    Returns the remaining images and how many were dropped."""
+    if safety_checker is None:
+        return images, 0
+    with autocast():
+        nsfw_flags = safety_checker["inspect_batch"](images)
+    keep = [i for i, nsfw_flag in enumerate(nsfw_flags) if not nsfw_flag]
+    return images[keep], len(nsfw_flags) - len(keep)
+
+
 def generate(
     prompt,
     negative_prompt,
@@ -35,6 +52,8 @@ def generate(
     model,
     pipe: KandinskyPipe,
     safety_checker,
+    init_image=None,
+    mask_image=None,
 ):
     if seed is None:
         seed = int.from_bytes(os.urandom(2), "big")
@@ -72,18 +91,22 @@ def generate(
 
     if init_image_url is not None and mask_image_url is not None:
         start = time.time()
-        init_image = download_and_fit_image(init_image_url, width, height)
+        if init_image is None:
+            init_image = download_and_fit_image(init_image_url, width, height)
         end = time.time()
         print(
             f"-- Downloaded and cropped init image in: {round((end - start) * 1000)} ms"
         )
         start = time.time()
-        mask_image = download_and_fit_image_mask(
-            url=mask_image_url,
-            width=width,
-            height=height,
-            inverted=True,
-        )
+        if mask_image is not None:
+            mask_image = image_to_mask(mask_image, inverted=True)
+        else:
+            mask_image = download_and_fit_image_mask(
+                url=mask_image_url,
+                width=width,
+                height=height,
+                inverted=True,
+            )
         end = time.time()
         print(
             f"-- Downloaded and cropped mask image in: {round((end - start) * 1000)} ms"
@@ -96,7 +119,8 @@ def generate(
         )
     elif init_image_url is not None:
         start_i = time.time()
-        init_image = download_and_fit_image(init_image_url, width, height)
+        if init_image is None:
+            init_image = download_and_fit_image(init_image_url, width, height)
         end_i = time.time()
         print(
             f"-- Downloaded and cropped init image in: {round((end_i - start_i) * 1000)} ms"
@@ -113,34 +137,8 @@ def generate(
             prompt,
             **args,
         )
-    output_images_nsfw_results = []
-    with autocast():
-        for image in output_images:
-            has_nsfw_concepts = False
-            result = None
-            if safety_checker is not None:
-                safety_checker_input = safety_checker["feature_extractor"](
-                    images=image, return_tensors="pt"
-                ).to("cuda")
-                result, has_nsfw_concepts = safety_checker["checker"].forward(
-                    clip_input=safety_checker_input.pixel_values, images=image
-                )
-            res = {
-                "result": result,
-                "has_nsfw_concepts": has_nsfw_concepts,
-            }
-            output_images_nsfw_results.append(res)
-
-    nsfw_count = 0
-    filtered_output_images = []
-
-    for i, res in enumerate(output_images_nsfw_results):
-        if res["has_nsfw_concepts"]:
-            nsfw_count += 1
-        else:
-            filtered_output_images.append(output_images[i])
-
-    return filtered_output_images, nsfw_count
+    output_images = pil_images_to_tensor(output_images, DEVICE)
+    return filter_nsfw_images(output_images, safety_checker)
 
 
 kandinsky_2_2_negative_prompt_prefix = "overexposed"
@@ -164,6 +162,8 @@ def generate_2_2(
     model,
     pipe: KandinskyPipe_2_2,
     safety_checker,
+    init_image=None,
+    mask_image=None,
 ):
     if seed is None:
         seed = int.from_bytes(os.urandom(2), "big")
@@ -191,18 +191,22 @@ def generate_2_2(
     if init_image_url is not None and mask_image_url is not None:
         pipe.inpaint.scheduler = get_scheduler(scheduler, pipe.inpaint)
         start = time.time()
-        init_image = download_and_fit_image(init_image_url, width, height)
+        if init_image is None:
+            init_image = download_and_fit_image(init_image_url, width, height)
         init_image = pad_image_pil(init_image, 64)
         end = time.time()
         print(
             f"-- Downloaded and cropped init image in: {round((end - start) * 1000)} ms"
         )
         start = time.time()
-        mask_image = download_and_fit_image_mask(
-            url=mask_image_url,
-            width=width,
-            height=height,
-        )
+        if mask_image is not None:
+            mask_image = image_to_mask(mask_image)
+        else:
+            mask_image = download_and_fit_image_mask(
+                url=mask_image_url,
+                width=width,
+                height=height,
+            )
         mask_image = pad_image_mask_nd(mask_image, 64, 0)
         end = time.time()
         print(
@@ -232,11 +236,13 @@ def generate_2_2(
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
             generator=generator,
+            output_type="pt",
         ).images
     elif init_image_url is not None:
         pipe.text2img.scheduler = get_scheduler(scheduler, pipe.text2img)
         start = time.time()
-        init_image = download_and_fit_image(init_image_url, width, height)
+        if init_image is None:
+            init_image = download_and_fit_image(init_image_url, width, height)
         end = time.time()
         print(
             f"-- Downloaded and cropped init image in: {round((end - start) * 1000)} ms"
@@ -260,6 +266,7 @@ def generate_2_2(
             generator=generator,
             num_inference_steps=num_inference_steps,
             guidance_scale=guidance_scale,
+            output_type="pt",
         ).images
     else:
         pipe.text2img.scheduler = get_scheduler(scheduler, pipe.text2img)
@@ -285,35 +292,11 @@ def generate_2_2(
             generator=generator,
             image_embeds=img_emb.image_embeds,
             negative_image_embeds=neg_emb.image_embeds,
+            output_type="pt",
         ).images
 
-    output_images = crop_images(image_array=output_images, width=width, height=height)
-
-    output_images_nsfw_results = []
-    with autocast():
-        for image in output_images:
-            has_nsfw_concepts = False
-            result = None
-            if safety_checker is not None:
-                safety_checker_input = safety_checker["feature_extractor"](
-                    images=image, return_tensors="pt"
-                ).to("cuda")
-                result, has_nsfw_concepts = safety_checker["checker"].forward(
-                    clip_input=safety_checker_input.pixel_values, images=image
-                )
-            res = {
-                "result": result,
-                "has_nsfw_concepts": has_nsfw_concepts,
-            }
-            output_images_nsfw_results.append(res)
-
-    nsfw_count = 0
-    filtered_output_images = []
-
-    for i, res in enumerate(output_images_nsfw_results):
-        if res["has_nsfw_concepts"]:
-            nsfw_count += 1
-        else:
-            filtered_output_images.append(output_images[i])
+    # The 2.2 pipelines only denormalize for "np" and "pil", "pt" is in [-1, 1]
+    output_images = (output_images * 0.5 + 0.5).clamp(0, 1)
+    output_images = crop_image_tensors(output_images, width=width, height=height)
 
-    return filtered_output_images, nsfw_count
+    return filter_nsfw_images(output_images, safety_checker)
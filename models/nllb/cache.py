@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, List, Tuple
+
+from tabulate import tabulate
+
+from .constants import TRANSLATION_CACHE_SIZE, TRANSLATION_CACHE_TTL
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after ttl seconds, with hit and miss counters.
+    A size of 0 disables it."""
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int = TRANSLATION_CACHE_SIZE,
+        ttl: float = TRANSLATION_CACHE_TTL,
+    ):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Returns whether the key was found, and its value"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: Hashable, value: Any):
+        if self.max_size < 1:
+            return
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> List[Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            hit_rate = f"{self.hits / lookups * 100:.0f}%" if lookups > 0 else "-"
+            return [self.name, self.hits, self.misses, hit_rate, len(self.entries)]
+
+
+# Detected FLORES-200 codes by text
+flores_cache = TTLCache("Language detection")
+# Translations by text, source FLORES-200 code and target FLORES-200 code
+translation_cache = TTLCache("Translation")
+
+
+def log_translation_caches():
+    print(
+        tabulate(
+            [flores_cache.stats(), translation_cache.stats()],
+            headers=["Cache", "Hits", "Misses", "Hit rate", "Entries"],
+            tablefmt="double_grid",
+        )
+    )
@@ -0,0 +1,154 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Dict, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .constants import (
+    DETECTED_CONFIDENCE_SCORE_MIN,
+    TARGET_LANG_FLORES,
+    TARGET_LANG_SCORE_MAX,
+    TRANSLATOR_BREAKER_FAILURES,
+    TRANSLATOR_BREAKER_RESET,
+    TRANSLATOR_CONNECT_TIMEOUT,
+    TRANSLATOR_MAX_CONNECTIONS,
+    TRANSLATOR_TIMEOUT,
+)
+
+
+class CircuitBreaker:
+    """Opens after failures in a row, then lets a single trial request through
+    every reset_seconds until one succeeds"""
+
+    def __init__(
+        self,
+        failure_threshold: int = TRANSLATOR_BREAKER_FAILURES,
+        reset_seconds: float = TRANSLATOR_BREAKER_RESET,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = Lock()
+        self.failures = 0
+        self.opened_at: float | None = None
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at < self.reset_seconds:
+                return False
+            # Half-open, the next trial waits for another reset period
+            self.opened_at = time.time()
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(
+                        f"-- Translator failed {self.failures} times in a row, using untranslated texts for {self.reset_seconds}s --"
+                    )
+                self.opened_at = time.time()
+
+
+class TranslatorClient:
+    """Client of the translator cog, safe to use from several threads.
+
+    Connections are pooled and kept alive. The cog translates two texts per request,
+    translate_many sends the requests of a list of texts concurrently. When the cog
+    fails, or its circuit breaker is open, texts come back untranslated.
+    """
+
+    def __init__(self, max_connections: int = TRANSLATOR_MAX_CONNECTIONS):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_connections, thread_name_prefix="translator"
+        )
+        self.lock = Lock()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def get_breaker(self, translator_url: str) -> CircuitBreaker:
+        with self.lock:
+            if translator_url not in self.breakers:
+                self.breakers[translator_url] = CircuitBreaker()
+            return self.breakers[translator_url]
+
+    def translate_pair(
+        self, translator_url: str, items: List[Tuple[str, str]]
+    ) -> List[str]:
+        """Translates one or two (text, source FLORES-200 code) items in one request"""
+        if len(items) == 1:
+            # Padded like an empty negative prompt, which isn't translated
+            items = items + [("", TARGET_LANG_FLORES)]
+        [(text_1, text_flores_1), (text_2, text_flores_2)] = items
+        json_data = {
+            "input": {
+                "text_1": text_1,
+                "text_flores_1": text_flores_1,
+                "target_flores_1": TARGET_LANG_FLORES,
+                "target_score_max_1": TARGET_LANG_SCORE_MAX,
+                "detected_confidence_score_min_1": DETECTED_CONFIDENCE_SCORE_MIN,
+                "text_2": text_2,
+                "text_flores_2": text_flores_2,
+                "target_flores_2": TARGET_LANG_FLORES,
+                "target_score_max_2": TARGET_LANG_SCORE_MAX,
+                "detected_confidence_score_min_2": DETECTED_CONFIDENCE_SCORE_MIN,
+            }
+        }
+        res = self.session.post(
+            f"{translator_url}/predictions",
+            json=json_data,
+            timeout=(TRANSLATOR_CONNECT_TIMEOUT, TRANSLATOR_TIMEOUT),
+        )
+        if res.status_code != 200:
+            raise Exception(f"Translation failed with status code: {res.status_code}")
+        return res.json()["output"]
+
+    def translate_pair_or_fallback(
+        self, translator_url: str, items: List[Tuple[str, str]]
+    ) -> Tuple[List[str], bool]:
+        """Returns the translations and whether they are, the original texts otherwise"""
+        breaker = self.get_breaker(translator_url)
+        if not breaker.allow():
+            return [text for text, _ in items], False
+        try:
+            translated = self.translate_pair(translator_url, items)
+        except Exception as e:
+            print(f"-- Translation failed with error, using untranslated texts: {e} --")
+            breaker.record_failure()
+            return [text for text, _ in items], False
+        breaker.record_success()
+        return translated[: len(items)], True
+
+    def translate_many(
+        self, translator_url: str, items: List[Tuple[str, str]]
+    ) -> List[Tuple[str, bool]]:
+        """Translates (text, source FLORES-200 code) items to the target language.
+        Returns each translation and whether it is one, or the original text."""
+        pairs = [items[i : i + 2] for i in range(0, len(items), 2)]
+        if len(pairs) == 1:
+            results = [self.translate_pair_or_fallback(translator_url, pairs[0])]
+        else:
+            results = list(
+                self.executor.map(
+                    lambda pair: self.translate_pair_or_fallback(translator_url, pair),
+                    pairs,
+                )
+            )
+        return [
+            (text, translated) for texts, translated in results for text in texts
+        ]
+
+
+translator_client = TranslatorClient()
@@ -89,3 +89,18 @@ TARGET_LANG_FLORES = LANG_TO_FLORES[TARGET_LANG.name]
 TARGET_LANG_SCORE_MAX = 0.88
 DETECTED_CONFIDENCE_SCORE_MIN = 0.1
 TRANSLATOR_COG_URL = os.environ.get("TRANSLATOR_COG_URL", None)
+
+# Detected languages and translations kept for repeated prompts, 0 disables the caches
+TRANSLATION_CACHE_SIZE = int(os.environ.get("TRANSLATION_CACHE_SIZE", "4096"))
+# Seconds an entry is kept
+TRANSLATION_CACHE_TTL = float(os.environ.get("TRANSLATION_CACHE_TTL", "3600"))
+
+# Connections to the translator cog, also the number of requests sent at the same time
+TRANSLATOR_MAX_CONNECTIONS = int(os.environ.get("TRANSLATOR_MAX_CONNECTIONS", "8"))
+# Seconds to connect to the translator cog, and to wait for a translation
+TRANSLATOR_CONNECT_TIMEOUT = float(os.environ.get("TRANSLATOR_CONNECT_TIMEOUT", "3"))
+TRANSLATOR_TIMEOUT = float(os.environ.get("TRANSLATOR_TIMEOUT", "15"))
+# Failed requests in a row after which texts are left untranslated for a while
+TRANSLATOR_BREAKER_FAILURES = int(os.environ.get("TRANSLATOR_BREAKER_FAILURES", "3"))
+# Seconds before the translator cog is tried again
+TRANSLATOR_BREAKER_RESET = float(os.environ.get("TRANSLATOR_BREAKER_RESET", "30"))
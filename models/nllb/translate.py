@@ -1,6 +1,7 @@
 from lingua import Language, LanguageDetector
-from threading import Lock
 import time
+from .cache import flores_cache, log_translation_caches, translation_cache
+from .client import translator_client
 from .constants import (
     LANG_TO_FLORES,
     TARGET_LANG,
@@ -10,104 +11,94 @@ from .constants import (
 )
 from transformers import pipeline
 import torch
-from typing import Any
-import requests
+from typing import Any, Dict, List, Tuple
 from tabulate import tabulate
 
-translator_mutex = Lock()
 
+def get_cached_translation(text: str, flores: str) -> Tuple[bool, str | None]:
+    """Returns whether the translation of the text is known, and the translation"""
+    if flores == TARGET_LANG_FLORES:
+        return True, text
+    return translation_cache.get((text, flores, TARGET_LANG_FLORES))
 
-def translate_text_set_via_api(
-    text_1: str,
-    flores_1: str | None,
-    text_2: str,
-    flores_2: str | None,
-    translator_url: str,
-    detector: LanguageDetector,
-    label: str,
-):
-    with translator_mutex:
-        print(f"-- {label} - Translator url is: '{translator_url}' --")
 
-        if text_1 is None:
-            text_1 = ""
-        if text_2 is None:
-            text_2 = ""
+def cache_translation(text: str, flores: str, translated_text: str):
+    if flores != TARGET_LANG_FLORES:
+        translation_cache.put((text, flores, TARGET_LANG_FLORES), translated_text)
 
-        if text_1 == "" and text_2 == "":
-            print(f"-- {label} - No text to translate, skipping --")
-            return ["", ""]
 
-        startTimeTranslation = time.time()
+def translate_text_sets_via_api(
+    text_sets: List[Tuple[str | None, str | None, str | None, str | None]],
+    translator_url: str,
+    detector: LanguageDetector,
+    label: str,
+) -> List[List[str]]:
+    """Translates (text_1, flores_1, text_2, flores_2) sets with the translator cog.
+    Texts in the target language and cached ones are left out, the others are
+    translated together, texts the cog fails on come back untranslated."""
+    print(f"-- {label} - Translator url is: '{translator_url}' --")
+    startTimeTranslation = time.time()
 
-        translated_text_1 = ""
-        translated_text_2 = ""
+    texts: List[Tuple[str, str]] = []
+    for i, (text_1, flores_1, text_2, flores_2) in enumerate(text_sets):
+        for n, (text, flores) in enumerate([(text_1, flores_1), (text_2, flores_2)]):
+            text = "" if text is None else text
+            texts.append(
+                (
+                    text,
+                    get_flores(
+                        text=text,
+                        flores=flores,
+                        detector=detector,
+                        label=f"{label} - Set {i + 1} - #{n + 1}",
+                    ),
+                )
+            )
 
-        text_flores_1 = TARGET_LANG_FLORES
-        text_flores_2 = TARGET_LANG_FLORES
+    translations: Dict[Tuple[str, str], str] = {}
+    to_translate: List[Tuple[str, str]] = []
+    for item in texts:
+        if item in translations or item in to_translate:
+            continue
+        cached, cached_text = get_cached_translation(*item)
+        if cached:
+            translations[item] = cached_text
+        else:
+            to_translate.append(item)
+
+    if len(to_translate) > 0:
+        results = translator_client.translate_many(translator_url, to_translate)
+        for item, (translated_text, is_translated) in zip(to_translate, results):
+            translations[item] = translated_text
+            if is_translated:
+                cache_translation(item[0], item[1], translated_text)
+            print(f'-- {label} - Original text is: "{item[0]}" --')
+            print(f'-- {label} - Translated text is: "{translated_text}" --')
+    else:
+        print(f"-- {label} - No translation needed or all cached, skipping the translator --")
 
-        text_flores_1 = get_flores(
-            text=text_1,
-            flores=flores_1,
-            detector=detector,
-            label=f"{label} - #1",
-        )
-        text_flores_2 = get_flores(
-            text=text_2,
-            flores=flores_2,
-            detector=detector,
-            label=f"{label} - #2",
-        )
+    endTimeTranslation = time.time()
+    print(
+        f"-- {label} - Translation completed in: {round((endTimeTranslation - startTimeTranslation) * 1000)} ms - {len(to_translate)} text(s) sent --"
+    )
+    log_translation_caches()
 
-        if text_flores_1 != TARGET_LANG_FLORES or text_flores_2 != TARGET_LANG_FLORES:
-            jsonData = {
-                "input": {
-                    "text_1": text_1,
-                    "text_flores_1": text_flores_1,
-                    "target_flores_1": TARGET_LANG_FLORES,
-                    "target_score_max_1": TARGET_LANG_SCORE_MAX,
-                    "detected_confidence_score_min_1": DETECTED_CONFIDENCE_SCORE_MIN,
-                    "text_2": text_2,
-                    "text_flores_2": text_flores_2,
-                    "target_flores_2": TARGET_LANG_FLORES,
-                    "target_score_max_2": TARGET_LANG_SCORE_MAX,
-                    "detected_confidence_score_min_2": DETECTED_CONFIDENCE_SCORE_MIN,
-                }
-            }
-            try:
-                res = requests.post(
-                    f"{translator_url}/predictions",
-                    json=jsonData,
-                    headers={"Content-Type": "application/json"},
-                )
-                if res.status_code != 200:
-                    raise Exception(
-                        f"Translation failed with status code: {res.status_code}"
-                    )
-                resJson = res.json()
-                [translated_text_1, translated_text_2] = resJson["output"]
-            except Exception as e:
-                raise Exception(f"Translation failed with error: {e}")
-
-            print(f'-- {label} - #1 - Original text is: "{text_1}" --')
-            print(f'-- {label} - #1 - Translated text is: "{translated_text_1}" --')
-            print(f'-- {label} - #2 - Original text is: "{text_2}" --')
-            print(f'-- {label} - #2 - Translated text is: "{translated_text_2}" --')
-        else:
-            translated_text_1 = text_1
-            translated_text_2 = text_2
-            print(
-                f"-- {label} - Texts are already in the correct language, no translation needed --"
-            )
-            print(f'-- {label} - #1 - Text is: "{translated_text_1}" --')
-            print(f'-- {label} - #2 - Text is: "{translated_text_2}" --')
+    translated = [translations[item] for item in texts]
+    return [translated[i : i + 2] for i in range(0, len(translated), 2)]
 
-        endTimeTranslation = time.time()
-        print(
-            f"-- {label} - Translation completed in: {round((endTimeTranslation - startTimeTranslation) * 1000)} ms --"
-        )
 
-        return [translated_text_1, translated_text_2]
+def translate_text_set_via_api(
+    text_1: str,
+    flores_1: str | None,
+    text_2: str,
+    flores_2: str | None,
+    translator_url: str,
+    detector: LanguageDetector,
+    label: str,
+):
+    return translate_text_sets_via_api(
+        [(text_1, flores_1, text_2, flores_2)], translator_url, detector, label
+    )[0]
 
 
 def translate_prompt_set(
@@ -161,12 +152,16 @@ def translate_text(
         label=label,
     )
 
+    cached, cached_text = get_cached_translation(text, detected_flores)
     if detected_flores == TARGET_LANG_FLORES:
         translated_text = text
         print(
             f"-- {label} - Text is already in the correct language, no translation needed --"
         )
         print(f'-- {label} - #1 - Text is: "{translated_text}" --')
+    elif cached:
+        translated_text = cached_text
+        print(f'-- {label} - Translation is cached: "{translated_text}" --')
     else:
         translate = pipeline(
             "translation",
@@ -179,6 +174,7 @@ def translate_text(
         )
         translate_output = translate(text, max_length=1000)
         translated_text = translate_output[0]["translation_text"]
+        cache_translation(text, detected_flores, translated_text)
         print(f'-- {label} - Original text is: "{text}" --')
         print(f'-- {label} - Translated text is: "{translated_text}" --')
 
@@ -202,6 +198,11 @@ def get_flores(
         )
         return flores
 
+    cached, cached_flores = flores_cache.get(text)
+    if cached:
+        print(f'-- {label} - Cached text language FLORES-200: "{cached_flores}" --')
+        return cached_flores
+
     text_flores = TARGET_LANG_FLORES
     confidence_values = detector.compute_language_confidence_values(text)
     target_lang_score = None
@@ -240,4 +241,5 @@ def get_flores(
         print(f"-- {label} - Target language score: {target_lang_score} --")
 
     print(f'-- {label} - Selected text language FLORES-200: "{text_flores}" --')
+    flores_cache.put(text, text_flores)
     return text_flores
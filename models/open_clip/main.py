@@ -1,9 +1,10 @@
 from PIL import Image
 from models.constants import DEVICE
 from .constants import OPEN_CLIP_TOKEN_LENGTH_MAX
-from typing import List
+from typing import Any, Dict, List, Tuple
 import torch
 from shared.helpers import time_it, time_code_block
+from shared.serialize import encode_embeddings
 from torchvision.transforms import (
     Compose,
     Resize,
@@ -15,6 +16,8 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 CLIP_IMAGE_SIZE = 224
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
 
 
 def convert_to_rgb(img: Image.Image):
@@ -28,10 +31,7 @@ def create_clip_transform(n_px):
             CenterCrop(n_px),
             convert_to_rgb,
             ToTensor(),
-            Normalize(
-                (0.48145466, 0.4578275, 0.40821073),
-                (0.26862954, 0.26130258, 0.27577711),
-            ),
+            Normalize(CLIP_MEAN, CLIP_STD),
         ]
     )
 
@@ -39,6 +39,30 @@ def create_clip_transform(n_px):
 clip_transform = create_clip_transform(CLIP_IMAGE_SIZE)
 
 
+def clip_preprocess_tensor(
+    images: torch.Tensor, n_px: int = CLIP_IMAGE_SIZE
+) -> torch.Tensor:
+    """Same steps as clip_transform, batched on an (N, 3, H, W) float batch in [0, 1]
+    where it already lives, instead of per PIL image on the CPU"""
+    height, width = images.shape[-2:]
+    scale = n_px / min(height, width)
+    resized_height = max(n_px, round(height * scale))
+    resized_width = max(n_px, round(width * scale))
+    resized = torch.nn.functional.interpolate(
+        images.float(),
+        size=(resized_height, resized_width),
+        mode="bicubic",
+        align_corners=False,
+        antialias=True,
+    )
+    top = int(round((resized_height - n_px) / 2.0))
+    left = int(round((resized_width - n_px) / 2.0))
+    cropped = resized[..., top : top + n_px, left : left + n_px].clamp(0, 1)
+    mean = torch.tensor(CLIP_MEAN, device=images.device).view(1, 3, 1, 1)
+    std = torch.tensor(CLIP_STD, device=images.device).view(1, 3, 1, 1)
+    return (cropped - mean) / std
+
+
 def clip_preprocessor(images: List[Image.Image], return_tensors="pt"):
     def process_image(img: Image.Image, index: int):
         return clip_transform(img), index
@@ -59,22 +83,42 @@ def clip_preprocessor(images: List[Image.Image], return_tensors="pt"):
 
 
 @time_it
-def open_clip_get_embeds_of_images(images: List[Image.Image], model, processor):
+def open_clip_get_features_of_images(
+    images: List[Image.Image] | torch.Tensor, model, embedding_encoding: str = "float"
+) -> Tuple[torch.Tensor, List[List[float] | Dict[str, Any]]]:
+    """Runs the vision model once and returns both its pooled output, which the
+    aesthetics scorer takes, and the projected embeddings as lists, or encoded
+    with embedding_encoding. A tensor batch from the generators is preprocessed on its device."""
     with torch.no_grad():
         with time_code_block(prefix=f"// Preprocessed {len(images)} image(s)"):
-            inputs = clip_preprocessor(images=images, return_tensors="pt")
+            if isinstance(images, torch.Tensor):
+                inputs = clip_preprocess_tensor(images.to(DEVICE))
+            else:
+                inputs = clip_preprocessor(images=images, return_tensors="pt")
         inputs = inputs.to(DEVICE)
         with time_code_block(prefix=f"// Embedded {len(images)} image(s)"):
-            image_embeddings = model.get_image_features(pixel_values=inputs)
+            pooled_output = model.vision_model(pixel_values=inputs).pooler_output
+            image_embeddings = model.visual_projection(pooled_output)
         with time_code_block(
-            prefix=f"// Moved {len(images)} embedding(s) to CPU as list"
+            prefix=f"// Moved {len(images)} embedding(s) to CPU as {embedding_encoding}"
         ):
-            image_embeddings = image_embeddings.cpu().numpy().tolist()
-        return image_embeddings
+            image_embeddings = encode_embeddings(image_embeddings, embedding_encoding)
+        return pooled_output, image_embeddings
+
+
+def open_clip_get_embeds_of_images(
+    images: List[Image.Image], model, processor, embedding_encoding: str = "float"
+):
+    _, image_embeddings = open_clip_get_features_of_images(
+        images, model, embedding_encoding
+    )
+    return image_embeddings
 
 
 @time_it
-def open_clip_get_embeds_of_texts(texts: str, model, tokenizer):
+def open_clip_get_embeds_of_texts(
+    texts: str, model, tokenizer, embedding_encoding: str = "float"
+):
     with torch.no_grad():
         with time_code_block(prefix=f"Tokenized {len(texts)} text(s)"):
             inputs = tokenizer(
@@ -88,5 +132,5 @@ def open_clip_get_embeds_of_texts(texts: str, model, tokenizer):
         with time_code_block(prefix=f"Embedded {len(texts)} text(s)"):
             text_embeddings = model.get_text_features(**inputs)
         with time_code_block(prefix=f"Moved {len(texts)} embeddings(s) to CPU"):
-            text_embeddings = text_embeddings.cpu().numpy().tolist()
+            text_embeddings = encode_embeddings(text_embeddings, embedding_encoding)
         return text_embeddings
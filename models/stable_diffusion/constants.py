@@ -1,3 +1,4 @@
+import os
 import torch
 from diffusers import (
     PNDMScheduler,
@@ -100,6 +101,18 @@ SD_MODELS_ALL = {
     },
 }
 
+# Keep the last used keep_in_cpu_when_idle model on the GPU until another one is needed
+SD_KEEP_LAST_MODEL_ON_GPU = os.environ.get("SD_KEEP_LAST_MODEL_ON_GPU", "1") == "1"
+# Host copies of keep_in_cpu_when_idle models are pinned, so they can be uploaded asynchronously
+SD_PIN_IDLE_MODELS = os.environ.get("SD_PIN_IDLE_MODELS", "1") == "1"
+# GPU memory left free for activations when moving or prefetching a model
+SD_RESIDENCY_HEADROOM = int(os.environ.get("SD_RESIDENCY_HEADROOM_MB", "3072")) * 1024**2
+# Load SD models on their first job instead of at startup
+SD_LAZY_LOAD = os.environ.get("SD_LAZY_LOAD", "0") == "1"
+# Memory for SD models that stay on the GPU and for the ones idling in host memory, 0 is unlimited
+SD_GPU_MEMORY_BUDGET = int(os.environ.get("SD_GPU_MEMORY_BUDGET_MB", "0")) * 1024**2
+SD_HOST_MEMORY_BUDGET = int(os.environ.get("SD_HOST_MEMORY_BUDGET_MB", "0")) * 1024**2
+
 SD_MODEL_FOR_SAFETY_CHECKER = "Luna Diffusion"
 SD_MODELS = {}
 if MODELS_FROM_ENV == "all":
@@ -1,5 +1,8 @@
 import torch
 from torch import nn
+from typing import List
+
+from models.open_clip.main import clip_preprocess_tensor
 
 # Stable Diffusion NSFW filter config (see LAION-AI/CLIP-based-NSFW-Detector repo).
 concepts = [
@@ -79,3 +82,29 @@ def forward_inspect(self, clip_input, images):
     has_nsfw_concepts = len(matches["nsfw"]) > 0
 
     return matches, has_nsfw_concepts
+
+
+@torch.no_grad()
+def inspect_batch(safety_checker, images: torch.Tensor) -> List[bool]:
+    """Batched forward_inspect on an (N, 3, H, W) float batch in [0, 1].
+    Returns whether each image has NSFW concepts."""
+    clip_input = clip_preprocess_tensor(images).to(
+        device=safety_checker.device, dtype=safety_checker.dtype
+    )
+    pooled_output = safety_checker.vision_model(clip_input)[1]
+    image_embeds = safety_checker.visual_projection(pooled_output)
+
+    special_scores = (
+        cosine_distance(image_embeds, safety_checker.special_care_embeds)
+        - safety_checker.special_care_embeds_weights
+    )
+    # Any special care concept makes the NSFW concepts a bit stricter
+    special_care = (torch.round(special_scores, decimals=3) > 0).any(dim=1)
+    adjustment = special_care.to(special_scores.dtype).unsqueeze(1) * 0.01
+    concept_scores = (
+        cosine_distance(image_embeds, safety_checker.concept_embeds)
+        - safety_checker.concept_embeds_weights
+        + adjustment
+    )
+    has_nsfw_concepts = (torch.round(concept_scores, decimals=3) > 0).any(dim=1)
+    return has_nsfw_concepts.cpu().tolist()
@@ -4,37 +4,25 @@ import torch
 from models.constants import DEVICE
 from .helpers import get_scheduler
 from .constants import SD_MODELS
+from .residency import residency_manager
 import time
+from typing import Any, Dict, List, Tuple
 from shared.helpers import (
     download_and_fit_image,
     log_gpu_memory,
     print_tuple,
 )
 
+GENERATOR_DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
-def generate(
+
+def get_final_prompts(
     prompt,
     negative_prompt,
     prompt_prefix,
     negative_prompt_prefix,
-    width,
-    height,
-    num_outputs,
-    num_inference_steps,
-    guidance_scale,
-    init_image_url,
-    mask_image_url,
-    prompt_strength,
-    scheduler,
-    seed,
     model,
-    pipe,
 ):
-    if seed is None:
-        seed = int.from_bytes(os.urandom(2), "big")
-    print(f"Using seed: {seed}")
-    generator = torch.Generator(device="cuda").manual_seed(seed)
-
     if prompt_prefix is not None:
         prompt = f"{prompt_prefix} {prompt}"
     else:
@@ -57,42 +45,86 @@ def generate(
             else:
                 negative_prompt = f"{default_negative_prompt_prefix} {negative_prompt}"
 
+    return prompt, negative_prompt
+
+
+def generate(
+    prompt,
+    negative_prompt,
+    prompt_prefix,
+    negative_prompt_prefix,
+    width,
+    height,
+    num_outputs,
+    num_inference_steps,
+    guidance_scale,
+    init_image_url,
+    mask_image_url,
+    prompt_strength,
+    scheduler,
+    seed,
+    model,
+    pipe,
+    init_image=None,
+    mask_image=None,
+):
+    if seed is None:
+        seed = int.from_bytes(os.urandom(2), "big")
+    print(f"Using seed: {seed}")
+    generator = torch.Generator(device=GENERATOR_DEVICE).manual_seed(seed)
+
+    prompt, negative_prompt = get_final_prompts(
+        prompt=prompt,
+        negative_prompt=negative_prompt,
+        prompt_prefix=prompt_prefix,
+        negative_prompt_prefix=negative_prompt_prefix,
+        model=model,
+    )
+
     print(f"-- Prompt: {prompt} --")
     print(f"-- Negative Prompt: {negative_prompt} --")
 
     extra_kwargs = {}
     pipe_selected = None
 
+    # Images stay on the device as an (N, 3, H, W) batch in [0, 1]
+    extra_kwargs["output_type"] = "pt"
     if pipe.refiner is not None:
         extra_kwargs["output_type"] = "latent"
     if init_image_url is not None:
         # The process is: img2img or inpainting
-        start_i = time.time()
-        extra_kwargs["image"] = download_and_fit_image(
-            url=init_image_url,
-            width=width,
-            height=height,
-        )
-        extra_kwargs["strength"] = prompt_strength
-        end_i = time.time()
-        print(
-            f"-- Downloaded and cropped init image in: {round((end_i - start_i) * 1000)} ms"
-        )
-
-        if mask_image_url is not None and pipe.inpaint is not None:
-            # The process is: inpainting
-            pipe_selected = pipe.inpaint
+        if init_image is not None:
+            extra_kwargs["image"] = init_image
+        else:
             start_i = time.time()
-            extra_kwargs["mask_image"] = download_and_fit_image(
-                url=mask_image_url,
+            extra_kwargs["image"] = download_and_fit_image(
+                url=init_image_url,
                 width=width,
                 height=height,
             )
-            extra_kwargs["strength"] = 0.99
             end_i = time.time()
             print(
-                f"-- Downloaded and cropped mask image in: {round((end_i - start_i) * 1000)} ms"
+                f"-- Downloaded and cropped init image in: {round((end_i - start_i) * 1000)} ms"
             )
+        extra_kwargs["strength"] = prompt_strength
+
+        if mask_image_url is not None and pipe.inpaint is not None:
+            # The process is: inpainting
+            pipe_selected = pipe.inpaint
+            if mask_image is not None:
+                extra_kwargs["mask_image"] = mask_image
+            else:
+                start_i = time.time()
+                extra_kwargs["mask_image"] = download_and_fit_image(
+                    url=mask_image_url,
+                    width=width,
+                    height=height,
+                )
+                end_i = time.time()
+                print(
+                    f"-- Downloaded and cropped mask image in: {round((end_i - start_i) * 1000)} ms"
+                )
+            extra_kwargs["strength"] = 0.99
         else:
             # The process is: img2img
             pipe_selected = pipe.img2img
@@ -102,58 +134,197 @@ def generate(
         extra_kwargs["width"] = width
         extra_kwargs["height"] = height
 
-    if "keep_in_cpu_when_idle" in SD_MODELS[model]:
-        s = time.time()
-        pipe_selected = pipe_selected.to(DEVICE)
-        e = time.time()
-        print_tuple(f"🚀 Moved {model} to GPU", f"{round((e - s) * 1000)} ms")
+    residency_manager.acquire(model)
 
     pipe_selected.scheduler = get_scheduler(scheduler, pipe_selected.scheduler.config)
-    output = pipe_selected(
-        prompt=prompt,
-        negative_prompt=negative_prompt,
-        guidance_scale=guidance_scale,
-        generator=generator,
-        num_images_per_prompt=num_outputs,
-        num_inference_steps=num_inference_steps,
-        **extra_kwargs,
-    )
-    log_gpu_memory(message="GPU status after inference")
+    try:
+        output = pipe_selected(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            guidance_scale=guidance_scale,
+            generator=generator,
+            num_images_per_prompt=num_outputs,
+            num_inference_steps=num_inference_steps,
+            **extra_kwargs,
+        )
+        log_gpu_memory(message="GPU status after inference")
 
-    if "keep_in_cpu_when_idle" in SD_MODELS[model]:
-        s = time.time()
-        pipe_selected = pipe_selected.to("cpu", silence_dtype_warnings=True)
-        e = time.time()
-        print_tuple(f"🐢 Moved {model} to CPU", f"{round((e - s) * 1000)} ms")
+        output_images = output.images
+        nsfw_count = 0
+
+        if (
+            hasattr(output, "nsfw_content_detected")
+            and output.nsfw_content_detected is not None
+        ):
+            keep = [
+                i
+                for i, nsfw_flag in enumerate(output.nsfw_content_detected)
+                if not nsfw_flag
+            ]
+            nsfw_count = len(output.nsfw_content_detected) - len(keep)
+            output_images = output_images[keep]
 
-    output_images = []
-    nsfw_count = 0
+        if pipe.refiner is not None:
+            args = {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,
+                "guidance_scale": guidance_scale,
+                "generator": generator,
+                "num_images_per_prompt": num_outputs,
+                "num_inference_steps": num_inference_steps,
+                "image": output_images,
+                "output_type": "pt",
+            }
+            output_images = pipe.refiner(**args).images
+    finally:
+        # The refiner is part of the model's residency too
+        residency_manager.release(model)
+
+    if nsfw_count > 0:
+        print(f"NSFW content detected in {nsfw_count}/{num_outputs} of the outputs.")
+
+    return output_images, nsfw_count
+
+
+def generate_batch(
+    jobs: List[Dict[str, Any]],
+    width,
+    height,
+    num_inference_steps,
+    guidance_scale,
+    prompt_strength,
+    scheduler,
+    model,
+    pipe,
+) -> List[Tuple[torch.Tensor, int]]:
+    """Run several compatible jobs through a single pipeline call.
+
+    Every job is a dict with the per-job arguments of `generate` (prompt,
+    negative_prompt, prompt_prefix, negative_prompt_prefix, num_outputs,
+    init_image_url, seed and optionally a prefetched init_image). Prompts are
+    expanded per output so jobs with a different `num_outputs` can share the
+    call, and each job keeps its own generator. Returns one
+    (output_images, nsfw_count) tuple per job, with the images as an
+    (N, 3, H, W) batch on the device.
+    """
+    prompts = []
+    negative_prompts = []
+    generators = []
+    init_images = []
+    counts = []
+
+    for job in jobs:
+        seed = job["seed"]
+        if seed is None:
+            seed = int.from_bytes(os.urandom(2), "big")
+        generator = torch.Generator(device=GENERATOR_DEVICE).manual_seed(seed)
+
+        prompt, negative_prompt = get_final_prompts(
+            prompt=job["prompt"],
+            negative_prompt=job["negative_prompt"],
+            prompt_prefix=job["prompt_prefix"],
+            negative_prompt_prefix=job["negative_prompt_prefix"],
+            model=model,
+        )
+        print(f"-- Batch - Seed: {seed} | Prompt: {prompt} --")
 
+        num_outputs = job["num_outputs"]
+        prompts += [prompt] * num_outputs
+        negative_prompts += [negative_prompt] * num_outputs
+        generators += [generator] * num_outputs
+        counts.append(num_outputs)
+
+        if job["init_image_url"] is not None:
+            init_image = job.get("init_image", None)
+            if init_image is None:
+                start_i = time.time()
+                init_image = download_and_fit_image(
+                    url=job["init_image_url"],
+                    width=width,
+                    height=height,
+                )
+                end_i = time.time()
+                print(
+                    f"-- Downloaded and cropped init image in: {round((end_i - start_i) * 1000)} ms"
+                )
+            init_images += [init_image] * num_outputs
+
+    # SDXL treats a missing negative prompt differently from an empty one
+    if all(negative_prompt is None for negative_prompt in negative_prompts):
+        negative_prompts = None
+    else:
+        negative_prompts = [
+            negative_prompt if negative_prompt is not None else ""
+            for negative_prompt in negative_prompts
+        ]
+
+    extra_kwargs = {"output_type": "pt"}
+    if pipe.refiner is not None:
+        extra_kwargs["output_type"] = "latent"
+    if len(init_images) > 0:
+        if len(init_images) != len(prompts):
+            raise ValueError("Can't mix img2img and text2img jobs in one batch.")
+        pipe_selected = pipe.img2img
+        extra_kwargs["image"] = init_images
+        extra_kwargs["strength"] = prompt_strength
+    else:
+        pipe_selected = pipe.text2img
+        extra_kwargs["width"] = width
+        extra_kwargs["height"] = height
+
+    residency_manager.acquire(model)
+
+    pipe_selected.scheduler = get_scheduler(scheduler, pipe_selected.scheduler.config)
+    try:
+        output = pipe_selected(
+            prompt=prompts,
+            negative_prompt=negative_prompts,
+            guidance_scale=guidance_scale,
+            generator=generators,
+            num_images_per_prompt=1,
+            num_inference_steps=num_inference_steps,
+            **extra_kwargs,
+        )
+        log_gpu_memory(message="GPU status after batched inference")
+
+        images = output.images
+        if pipe.refiner is not None:
+            images = pipe.refiner(
+                prompt=prompts,
+                negative_prompt=negative_prompts,
+                guidance_scale=guidance_scale,
+                generator=generators,
+                num_images_per_prompt=1,
+                num_inference_steps=num_inference_steps,
+                image=images,
+                output_type="pt",
+            ).images
+    finally:
+        residency_manager.release(model)
+
+    nsfw_flags = None
     if (
         hasattr(output, "nsfw_content_detected")
         and output.nsfw_content_detected is not None
     ):
-        for i, nsfw_flag in enumerate(output.nsfw_content_detected):
-            if nsfw_flag:
+        nsfw_flags = output.nsfw_content_detected
+
+    results = []
+    offset = 0
+    for num_outputs in counts:
+        keep = []
+        nsfw_count = 0
+        for i in range(offset, offset + num_outputs):
+            if nsfw_flags is not None and nsfw_flags[i]:
                 nsfw_count += 1
             else:
-                output_images.append(output.images[i])
-    else:
-        output_images = output.images
-
-    if pipe.refiner is not None:
-        args = {
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,
-            "guidance_scale": guidance_scale,
-            "generator": generator,
-            "num_images_per_prompt": num_outputs,
-            "num_inference_steps": num_inference_steps,
-            "image": output_images,
-        }
-        output_images = pipe.refiner(**args).images
-
-    if nsfw_count > 0:
-        print(f"NSFW content detected in {nsfw_count}/{num_outputs} of the outputs.")
+                keep.append(i)
+        output_images = images[keep]
+        if nsfw_count > 0:
+            print(
+                f"NSFW content detected in {nsfw_count}/{num_outputs} of the outputs."
+            )
+        results.append((output_images, nsfw_count))
+        offset += num_outputs
 
-    return output_images, nsfw_count
+    return results
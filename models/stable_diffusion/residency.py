@@ -0,0 +1,256 @@
+import itertools
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, List, Set
+
+import torch
+from tabulate import tabulate
+
+from models.constants import DEVICE
+from shared.helpers import print_tuple
+
+from .constants import (
+    SD_KEEP_LAST_MODEL_ON_GPU,
+    SD_PIN_IDLE_MODELS,
+    SD_RESIDENCY_HEADROOM,
+)
+
+
+class ResidentTensor:
+    """A parameter or buffer of a pipeline, with the host copy its data is swapped back to"""
+
+    def __init__(self, tensor: torch.Tensor, host: torch.Tensor):
+        self.tensor = tensor
+        self.host = host
+
+
+class ModelResidency:
+    def __init__(self, model: str, tensors: List[ResidentTensor]):
+        self.model = model
+        self.tensors = tensors
+        self.nbytes = sum(t.host.numel() * t.host.element_size() for t in tensors)
+        self.on_gpu = False
+        self.in_use = False
+        self.last_used = 0.0
+        self.prefetched = False
+        self.upload_start: torch.cuda.Event | None = None
+        self.upload_end: torch.cuda.Event | None = None
+        # Metrics
+        self.swaps_in = 0
+        self.prefetch_hits = 0
+        self.kept_hits = 0
+        self.evictions = 0
+        self.last_swap_in_ms = 0.0
+        self.total_swap_in_ms = 0.0
+        self.total_wait_ms = 0.0
+
+
+def get_pipe_tensors(*pipes: Any) -> List[torch.Tensor]:
+    """Parameters and buffers of all the torch modules of the pipelines, each only once"""
+    tensors: List[torch.Tensor] = []
+    seen = set()
+    components = itertools.chain(*[pipe.components.values() for pipe in pipes])
+    for component in components:
+        if not isinstance(component, torch.nn.Module):
+            continue
+        for tensor in itertools.chain(component.parameters(), component.buffers()):
+            if id(tensor) in seen:
+                continue
+            seen.add(id(tensor))
+            tensors.append(tensor)
+    return tensors
+
+
+class ResidencyManager:
+    """Moves keep_in_cpu_when_idle pipelines between host and GPU memory.
+
+    Each registered pipeline keeps a host copy of its weights, pinned when possible.
+    Uploads are `non_blocking` copies issued on a side stream, so the next model can
+    be uploaded while the current job runs. Inference never changes the weights, so
+    eviction only points the tensors back to their host copy, without copying.
+    Idle models stay on the GPU until their memory is needed by another model.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.models: Dict[str, ModelResidency] = {}
+        self.stream: torch.cuda.Stream | None = None
+        # Returns the model of the job that is most likely to run next
+        self.predict_next: Callable[[], str | None] | None = None
+
+    def register(self, model: str, *pipes: Any, exclude: Set[int] | None = None) -> None:
+        """Moves the pipelines to host memory, they are uploaded when the model is acquired.
+        Tensors in `exclude` (ids) are shared with pipelines that stay on the GPU and are left alone."""
+        s = time.time()
+        pin = SD_PIN_IDLE_MODELS and torch.cuda.is_available()
+        tensors: List[ResidentTensor] = []
+        for tensor in get_pipe_tensors(*pipes):
+            if exclude is not None and id(tensor) in exclude:
+                continue
+            host = tensor.data.to("cpu")
+            if pin:
+                host = host.pin_memory()
+            tensor.data = host
+            tensors.append(ResidentTensor(tensor, host))
+        residency = ModelResidency(model, tensors)
+        with self.lock:
+            self.models[model] = residency
+        e = time.time()
+        print_tuple(
+            f"📌 Registered {model} in {'pinned' if pin else 'pageable'} memory",
+            f"{round(residency.nbytes / 1024**2)} MB - {round((e - s) * 1000)} ms",
+        )
+
+    def unregister(self, model: str) -> None:
+        with self.lock:
+            residency = self.models.pop(model, None)
+            if residency is not None and residency.on_gpu:
+                self.evict(residency)
+
+    def is_registered(self, model: str) -> bool:
+        return model in self.models
+
+    def get_available_bytes(self) -> int:
+        free, _ = torch.cuda.mem_get_info()
+        # Memory cached by the allocator is free for our uploads too
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+    def make_room(self, nbytes: int) -> bool:
+        """Evicts idle models, least recently used first, until `nbytes` fit with the headroom"""
+        needed = nbytes + SD_RESIDENCY_HEADROOM
+        while self.get_available_bytes() < needed:
+            idle = [r for r in self.models.values() if r.on_gpu and not r.in_use]
+            if len(idle) == 0:
+                return False
+            self.evict(min(idle, key=lambda r: r.last_used))
+        return True
+
+    def upload(self, residency: ModelResidency, prefetched: bool) -> None:
+        if self.stream is None:
+            self.stream = torch.cuda.Stream()
+        main_stream = torch.cuda.current_stream()
+        residency.upload_start = torch.cuda.Event(enable_timing=True)
+        residency.upload_end = torch.cuda.Event(enable_timing=True)
+        with torch.cuda.stream(self.stream):
+            residency.upload_start.record(self.stream)
+            for t in residency.tensors:
+                data = t.host.to(DEVICE, non_blocking=True)
+                # Allocated on the side stream but used on the main one
+                data.record_stream(main_stream)
+                t.tensor.data = data
+            residency.upload_end.record(self.stream)
+        residency.on_gpu = True
+        residency.prefetched = prefetched
+
+    def wait_for_upload(self, residency: ModelResidency) -> None:
+        if residency.upload_end is None:
+            return
+        s = time.time()
+        residency.upload_end.synchronize()
+        wait_ms = (time.time() - s) * 1000
+        swap_in_ms = residency.upload_start.elapsed_time(residency.upload_end)
+        residency.upload_start = None
+        residency.upload_end = None
+        residency.swaps_in += 1
+        residency.last_swap_in_ms = swap_in_ms
+        residency.total_swap_in_ms += swap_in_ms
+        residency.total_wait_ms += wait_ms
+        if residency.prefetched:
+            residency.prefetch_hits += 1
+        print_tuple(
+            f"🚀 Moved {residency.model} to GPU{' (prefetched)' if residency.prefetched else ''}",
+            f"{round(swap_in_ms)} ms - waited {round(wait_ms)} ms",
+        )
+        self.log_metrics()
+
+    def evict(self, residency: ModelResidency) -> None:
+        for t in residency.tensors:
+            t.tensor.data = t.host
+        residency.upload_start = None
+        residency.upload_end = None
+        residency.on_gpu = False
+        residency.evictions += 1
+        print_tuple(f"🐢 Evicted {residency.model} from GPU", "0 ms")
+
+    def acquire(self, model: str) -> None:
+        """Makes sure the model is on the GPU before running it, then prefetches the next one"""
+        residency = self.models.get(model, None)
+        if residency is None:
+            return
+        with self.lock:
+            residency.in_use = True
+            residency.last_used = time.time()
+            if not residency.on_gpu:
+                if not self.make_room(residency.nbytes):
+                    print_tuple(f"⚠️  Low GPU memory headroom for {model}", "Moving anyway")
+                self.upload(residency, prefetched=False)
+            elif residency.upload_end is None:
+                residency.kept_hits += 1
+                print_tuple(f"🚀 {model} is already on GPU", "Kept")
+            self.wait_for_upload(residency)
+        self.prefetch_next()
+
+    def release(self, model: str) -> None:
+        residency = self.models.get(model, None)
+        if residency is None:
+            return
+        with self.lock:
+            residency.in_use = False
+            residency.last_used = time.time()
+            if not SD_KEEP_LAST_MODEL_ON_GPU:
+                self.evict(residency)
+
+    def prefetch(self, model: str) -> None:
+        """Starts uploading the model without waiting, if it fits next to the ones in use"""
+        residency = self.models.get(model, None)
+        if residency is None:
+            return
+        with self.lock:
+            if residency.on_gpu:
+                return
+            if not self.make_room(residency.nbytes):
+                print_tuple(f"⏭️  Not enough GPU memory to prefetch {model}", "Skipped")
+                return
+            residency.last_used = time.time()
+            self.upload(residency, prefetched=True)
+
+    def prefetch_next(self) -> None:
+        if self.predict_next is None:
+            return
+        try:
+            model = self.predict_next()
+        except Exception:
+            return
+        if model is not None:
+            self.prefetch(model)
+
+    def get_metrics(self) -> Dict[str, Dict[str, Any]]:
+        metrics = {}
+        for model, r in self.models.items():
+            metrics[model] = {
+                "on_gpu": r.on_gpu,
+                "size_mb": round(r.nbytes / 1024**2),
+                "swaps_in": r.swaps_in,
+                "prefetch_hits": r.prefetch_hits,
+                "kept_hits": r.kept_hits,
+                "evictions": r.evictions,
+                "last_swap_in_ms": round(r.last_swap_in_ms),
+                "avg_swap_in_ms": (
+                    round(r.total_swap_in_ms / r.swaps_in) if r.swaps_in > 0 else 0
+                ),
+                "avg_wait_ms": (
+                    round(r.total_wait_ms / r.swaps_in) if r.swaps_in > 0 else 0
+                ),
+            }
+        return metrics
+
+    def log_metrics(self) -> None:
+        metrics = self.get_metrics()
+        if len(metrics) == 0:
+            return
+        headers = ["Model", *next(iter(metrics.values())).keys()]
+        table = [[model, *values.values()] for model, values in metrics.items()]
+        print(tabulate(table, headers=headers, tablefmt="double_grid"))
+
+
+residency_manager = ResidencyManager()
@@ -8,7 +8,7 @@ import numpy as np
 from collections import OrderedDict
 import cv2
 import tempfile
-from shared.helpers import clean_folder
+from shared.helpers import clean_folder, tensor_to_uint8_arrays
 from .constants import DEVICE_SWINIR
 from .helpers import get_image_pair, setup
 import time
@@ -20,7 +20,7 @@ from io import BytesIO
 
 @torch.inference_mode()
 @torch.cuda.amp.autocast()
-def upscale(image: np.ndarray | Image.Image | str, upscaler: Any) -> Image.Image:
+def upscale(image: np.ndarray | Image.Image | str, upscaler: Any) -> np.ndarray:
     if image is None:
         raise ValueError("Image is required for the upscaler.")
 
@@ -77,28 +77,21 @@ def upscale(image: np.ndarray | Image.Image | str, upscaler: Any) -> Image.Image
     )
 
     save_start_time = time.time()
-    # save image
-    output = output.data.squeeze().float().cpu().clamp_(0, 1).numpy()
-    if output.ndim == 3:
-        output = np.transpose(output[[2, 1, 0], :, :], (1, 2, 0))
-    # float32 to uint8
-    output = (output * 255.0).round().astype(np.uint8)
-    output_image = output
+    # Same channels as the former flip to BGR and BGR2RGBA conversion, without alpha.
+    # Converted to uint8 HWC on the device and copied to the host once.
+    output_image = tensor_to_uint8_arrays(output.data.float())[0]
     save_end_time = time.time()
     print(
-        f"-- Upscale - Image save in: {round((save_end_time - save_start_time) * 1000)} ms --"
+        f"-- Upscale - Image to array in: {round((save_end_time - save_start_time) * 1000)} ms --"
     )
+    return output_image
 
-    start = time.time()
-    imageRGB = cv2.cvtColor(output_image, cv2.COLOR_BGR2RGBA)
-    pil_image = Image.fromarray(imageRGB)
-    end = time.time()
-    print(f"-- Upscale - Array to PIL Image in: {round((end - start) * 1000)} ms --")
-    return pil_image
 
-
-def is_url(url: str) -> bool:
-    return url.startswith("http://") or url.startswith("https://")
+def is_url(url: Any) -> bool:
+    # Prefetched and generated images are arrays
+    return isinstance(url, str) and (
+        url.startswith("http://") or url.startswith("https://")
+    )
 
 
 def download_image(url: str) -> np.array:
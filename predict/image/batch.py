@@ -0,0 +1,77 @@
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Tuple
+
+from models.kandinsky.constants import (
+    KANDINSKY_2_1_MODEL_NAME,
+    KANDINKSY_2_2_MODEL_NAME,
+)
+
+
+def get_batch_key(input: Any) -> Tuple[Hashable, ...] | None:
+    """Returns the key jobs must share to run in one pipeline call, None if the job can't be batched."""
+    if input.process_type != "generate":
+        return None
+    if input.model in [KANDINSKY_2_1_MODEL_NAME, KANDINKSY_2_2_MODEL_NAME]:
+        return None
+    # Inpainting downloads a mask per job, keep it on the single job path
+    if input.mask_image_url is not None:
+        return None
+    is_img2img = input.init_image_url is not None
+    return (
+        input.model,
+        input.scheduler,
+        input.width,
+        input.height,
+        input.num_inference_steps,
+        input.guidance_scale,
+        is_img2img,
+        input.prompt_strength if is_img2img else None,
+        input.skip_safety_checker,
+        input.embedding_encoding,
+    )
+
+
+def group_by_batch_key(
+    inputs: List[Any], max_batch_size: int
+) -> List[List[int]]:
+    """Groups input indexes by batch key, preserving arrival order. Unbatchable inputs get their own group."""
+    groups: List[List[int]] = []
+    open_groups: Dict[Tuple[Hashable, ...], List[int]] = {}
+    for i, input in enumerate(inputs):
+        key = get_batch_key(input)
+        if key is None:
+            groups.append([i])
+            continue
+        group = open_groups.get(key, None)
+        if group is None or len(group) >= max_batch_size:
+            group = []
+            open_groups[key] = group
+            groups.append(group)
+        group.append(i)
+    return groups
+
+
+class BatchTimings:
+    """Keeps the last seen per-image time of unbatched jobs, to estimate the speedup of batches."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.seconds_per_image: Dict[Tuple[Hashable, ...], float] = {}
+
+    def record_single(self, key: Tuple[Hashable, ...], seconds: float, num_images: int):
+        if key is None or num_images < 1:
+            return
+        with self.lock:
+            self.seconds_per_image[key] = seconds / num_images
+
+    def estimate_speedup(
+        self, key: Tuple[Hashable, ...], seconds: float, num_images: int
+    ) -> float | None:
+        with self.lock:
+            seconds_per_image = self.seconds_per_image.get(key, None)
+        if seconds_per_image is None or seconds <= 0:
+            return None
+        return round(seconds_per_image * num_images / seconds, 2)
+
+
+batch_timings = BatchTimings()
@@ -1,10 +1,11 @@
+import numpy as np
 from PIL import Image
 
 
 class PredictOutput:
     def __init__(
         self,
-        pil_image: Image.Image,
+        image: Image.Image | np.ndarray,
         target_extension: str,
         target_quality: int,
         open_clip_image_embed: list[float],
@@ -12,7 +13,8 @@ class PredictOutput:
         aesthetic_rating_score: float,
         aesthetic_artifact_score: float,
     ):
-        self.pil_image = pil_image
+        # Generated images are uint8 HWC arrays, only the encoder makes them PIL images
+        self.image = image
         self.target_extension = target_extension
         self.target_quality = target_quality
         self.open_clip_image_embed = open_clip_image_embed
@@ -0,0 +1,86 @@
+import itertools
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable, Set, Tuple
+
+import torch
+
+from models.stable_diffusion.residency import get_pipe_tensors
+from shared.helpers import print_tuple
+
+
+def get_component_tensors(component: Any):
+    if isinstance(component, torch.nn.Module):
+        return itertools.chain(component.parameters(), component.buffers())
+    if hasattr(component, "components"):
+        return get_pipe_tensors(component)
+    return []
+
+# from_pretrained kwargs that change the loaded weights
+LOADING_KWARGS_IN_KEY = ["torch_dtype", "variant", "revision"]
+
+
+class ComponentCache:
+    """Model components shared between pipelines, like VAEs, refiners and safety checkers.
+
+    Keyed by model id and subfolder, plus anything else that changes what gets loaded.
+    Each component is loaded once, even when pipelines that use it load in parallel.
+    Shared components stay on the GPU, pipelines moved to host memory leave them alone.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.loading: Dict[Tuple[Hashable, ...], Lock] = {}
+        self.components: Dict[Tuple[Hashable, ...], Any] = {}
+
+    def get(self, key: Tuple[Hashable, ...], load: Callable[[], Any]) -> Any:
+        with self.lock:
+            if key in self.components:
+                print_tuple("♻️  Reused shared component", get_key_name(key))
+                return self.components[key]
+            loading_lock = self.loading.setdefault(key, Lock())
+        with loading_lock:
+            with self.lock:
+                component = self.components.get(key, None)
+            if component is not None:
+                print_tuple("♻️  Reused shared component", get_key_name(key))
+                return component
+            s = time.time()
+            component = load()
+            with self.lock:
+                self.components[key] = component
+            e = time.time()
+            print_tuple(
+                f"🧩 Loaded shared component {get_key_name(key)}",
+                f"{round((e - s) * 1000)} ms",
+            )
+            return component
+
+    def from_pretrained(
+        self, cls: Any, model_id: str, subfolder: str | None = None, **kwargs
+    ) -> Any:
+        def load():
+            if subfolder is not None:
+                kwargs["subfolder"] = subfolder
+            return cls.from_pretrained(model_id, **kwargs)
+
+        key = (model_id, subfolder) + tuple(
+            kwargs.get(name, None) for name in LOADING_KWARGS_IN_KEY
+        )
+        return self.get(key, load)
+
+    def get_tensor_ids(self) -> Set[int]:
+        with self.lock:
+            components = list(self.components.values())
+        ids = set()
+        for component in components:
+            for tensor in get_component_tensors(component):
+                ids.add(id(tensor))
+        return ids
+
+
+def get_key_name(key: Tuple[Hashable, ...]) -> str:
+    return "/".join(str(part) for part in key if part is not None)
+
+
+component_cache = ComponentCache()
@@ -1 +1,16 @@
+import os
+
 SIZE_LIST = range(256, 1537, 8)
+
+# Input prefetching for upcoming jobs (init, mask and upscale images)
+PREFETCH_MAX_WORKERS = int(os.environ.get("PREFETCH_MAX_WORKERS", "4"))
+PREFETCH_MEMORY_BUDGET = int(os.environ.get("PREFETCH_MEMORY_BUDGET_MB", "256")) * 1024**2
+# Decoded size reserved for an image to upscale before its real size is known
+PREFETCH_UPSCALE_ESTIMATED_BYTES = 2048 * 2048 * 3
+
+# Threads loading models in setup(), independent models load at the same time
+SETUP_MAX_WORKERS = max(1, int(os.environ.get("SETUP_MAX_WORKERS", "4")))
+
+# Local snapshots of assembled SD pipelines, for fast warm restarts
+SD_SNAPSHOT = os.environ.get("SD_SNAPSHOT", "0") == "1"
+SD_SNAPSHOT_DIR = os.environ.get("SD_SNAPSHOT_DIR", "/app/data/pipeline-snapshots")
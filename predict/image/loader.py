@@ -0,0 +1,117 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from threading import current_thread
+from typing import Any, Callable, Dict, List
+
+from tabulate import tabulate
+
+from .constants import SETUP_MAX_WORKERS
+
+
+class LoadTask:
+    def __init__(self, name: str, load: Callable[..., Any], dependencies: List[str]):
+        self.name = name
+        self.load = load
+        self.dependencies = dependencies
+        self.started_at: float | None = None
+        self.ended_at: float | None = None
+        self.thread_name: str | None = None
+
+
+class ParallelLoader:
+    """Runs the load tasks of setup() on a thread pool.
+
+    A task starts as soon as all its dependencies are done and receives their results
+    as positional arguments, so shared components load once, before their users.
+    Disk reads, deserialization and device transfers of independent models overlap.
+    """
+
+    def __init__(self, max_workers: int = SETUP_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.tasks: Dict[str, LoadTask] = {}
+        self.results: Dict[str, Any] = {}
+        self.started_at: float | None = None
+        self.ended_at: float | None = None
+
+    def add(
+        self,
+        name: str,
+        load: Callable[..., Any],
+        dependencies: List[str] | None = None,
+    ) -> None:
+        if name in self.tasks:
+            raise ValueError(f"Load task {name} already exists")
+        self.tasks[name] = LoadTask(name, load, dependencies or [])
+
+    def run_task(self, task: LoadTask) -> Any:
+        task.started_at = time.time()
+        task.thread_name = current_thread().name
+        try:
+            return task.load(*[self.results[d] for d in task.dependencies])
+        finally:
+            task.ended_at = time.time()
+
+    def run(self) -> Dict[str, Any]:
+        """Blocks until every task is done, raises the first failure"""
+        for task in self.tasks.values():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise ValueError(f"{task.name} depends on unknown task {dependency}")
+
+        self.started_at = time.time()
+        waiting = dict(self.tasks)
+        running: Dict[Future, LoadTask] = {}
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="setup"
+        ) as executor:
+            while len(waiting) > 0 or len(running) > 0:
+                for name, task in list(waiting.items()):
+                    if all(d in self.results for d in task.dependencies):
+                        running[executor.submit(self.run_task, task)] = task
+                        del waiting[name]
+                if len(running) == 0:
+                    raise ValueError(
+                        f"Load tasks with circular dependencies: {list(waiting.keys())}"
+                    )
+                done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = running.pop(future)
+                    exception = future.exception()
+                    if exception is not None:
+                        for pending in running:
+                            pending.cancel()
+                        raise exception
+                    self.results[task.name] = future.result()
+        self.ended_at = time.time()
+        return self.results
+
+    def log_breakdown(self) -> None:
+        rows = []
+        for task in sorted(self.tasks.values(), key=lambda t: t.started_at or 0):
+            if task.started_at is None or task.ended_at is None:
+                continue
+            rows.append(
+                [
+                    task.name,
+                    f"{task.started_at - self.started_at:.1f}",
+                    f"{task.ended_at - task.started_at:.1f}",
+                    task.thread_name,
+                    ", ".join(task.dependencies),
+                ]
+            )
+        print(
+            tabulate(
+                rows,
+                headers=["Component", "Start (s)", "Duration (s)", "Thread", "After"],
+                tablefmt="double_grid",
+            )
+        )
+        wall_time = self.ended_at - self.started_at
+        total_time = sum(
+            t.ended_at - t.started_at
+            for t in self.tasks.values()
+            if t.started_at is not None and t.ended_at is not None
+        )
+        print(
+            f"⏱️  Loaded {len(rows)} components in: {wall_time:.1f} sec. wall time - {total_time:.1f} sec. sequential"
+        )
@@ -1,4 +1,5 @@
 import time
+import torch
 from models.aesthetics_scorer.generate import (
     AestheticScoreResult,
     generate_aesthetic_scores,
@@ -21,21 +22,34 @@ from models.stable_diffusion.constants import (
 )
 
 from models.stable_diffusion.generate import generate as generate_with_sd
-from models.nllb.translate import translate_text_set_via_api
+from models.stable_diffusion.generate import generate_batch as generate_batch_with_sd
+from models.nllb.translate import (
+    translate_text_set_via_api,
+    translate_text_sets_via_api,
+)
 from models.nllb.constants import TRANSLATOR_COG_URL
 from models.swinir.upscale import upscale
 
-from typing import List
+from typing import Dict, List, Tuple
 
 from .classes import PredictOutput, PredictResult
 from .constants import SIZE_LIST
+from .prefetch import PrefetchedInputs, resolve_image_to_upscale
 from .setup import ModelsPack
+from models.constants import DEVICE
 from models.open_clip.main import (
-    open_clip_get_embeds_of_images,
     open_clip_get_embeds_of_texts,
+    open_clip_get_features_of_images,
 )
 from pydantic import BaseModel, Field, validator
-from shared.helpers import log_gpu_memory, return_value_if_in_list, wrap_text
+from shared.serialize import EMBEDDING_ENCODINGS
+from shared.helpers import (
+    log_gpu_memory,
+    return_value_if_in_list,
+    tensor_to_uint8_arrays,
+    uint8_arrays_to_tensor,
+    wrap_text,
+)
 from tabulate import tabulate
 
 
@@ -124,6 +138,10 @@ class PredictInput(BaseModel):
     skip_safety_checker: bool = Field(
         description="Whether to skip the safety checker or not.", default=False
     )
+    embedding_encoding: str = Field(
+        description="Encoding of the embeddings. Can be 'float' (JSON lists), 'float16', 'float32' or 'int8' (base64 little-endian, int8 with a scale).",
+        default="float",
+    )
 
     @validator("model")
     def validate_model(cls, v):
@@ -158,6 +176,10 @@ class PredictInput(BaseModel):
             SIZE_LIST,
         )
 
+    @validator("embedding_encoding")
+    def validate_embedding_encoding(cls, v):
+        return return_value_if_in_list(v, EMBEDDING_ENCODINGS)
+
     @validator("output_image_extension")
     def validate_output_image_extension(cls, v):
         return return_value_if_in_list(v, ["png", "jpeg", "webp"])
@@ -169,9 +191,112 @@ class PredictInput(BaseModel):
         )
 
 
+def translate_prompts(input: PredictInput, models_pack: ModelsPack):
+    t_prompt = input.prompt
+    t_negative_prompt = input.negative_prompt
+    if input.translator_cog_url is not None and input.skip_translation is False:
+        [t_prompt, t_negative_prompt] = translate_text_set_via_api(
+            text_1=input.prompt,
+            flores_1=input.prompt_flores_200_code,
+            text_2=input.negative_prompt,
+            flores_2=input.negative_prompt_flores_200_code,
+            translator_url=input.translator_cog_url,
+            detector=models_pack.translator["detector"],
+            label="Prompt & Negative Prompt",
+        )
+    return t_prompt, t_negative_prompt
+
+
+def translate_prompts_batch(
+    inputs: List[PredictInput], models_pack: ModelsPack
+) -> List[Tuple[str, str]]:
+    """Translates the prompts of a batch together, one call per translator"""
+    translated = [(input.prompt, input.negative_prompt) for input in inputs]
+    by_url: Dict[str, List[int]] = {}
+    for i, input in enumerate(inputs):
+        if input.translator_cog_url is not None and input.skip_translation is False:
+            by_url.setdefault(input.translator_cog_url, []).append(i)
+    for translator_url, indexes in by_url.items():
+        text_sets = translate_text_sets_via_api(
+            text_sets=[
+                (
+                    inputs[i].prompt,
+                    inputs[i].prompt_flores_200_code,
+                    inputs[i].negative_prompt,
+                    inputs[i].negative_prompt_flores_200_code,
+                )
+                for i in indexes
+            ],
+            translator_url=translator_url,
+            detector=models_pack.translator["detector"],
+            label="Batch Prompts & Negative Prompts",
+        )
+        for i, (t_prompt, t_negative_prompt) in zip(indexes, text_sets):
+            translated[i] = (t_prompt, t_negative_prompt)
+    return translated
+
+
+def get_aesthetic_scores(
+    output_images, models_pack: ModelsPack, pooled_output: torch.Tensor | None = None
+) -> List[AestheticScoreResult]:
+    """Scores the images from the pooled CLIP vision output of their embeddings,
+    the vision model only runs again when there is none"""
+    if len(output_images) == 0:
+        return []
+    s_aes = time.time()
+    if pooled_output is None:
+        if not isinstance(output_images, torch.Tensor):
+            # Upscaler outputs are uint8 HWC arrays
+            output_images = uint8_arrays_to_tensor(output_images, DEVICE)
+        pooled_output, _ = open_clip_get_features_of_images(
+            output_images, models_pack.open_clip["model"]
+        )
+    aesthetic_scores = generate_aesthetic_scores(
+        pooled_output=pooled_output,
+        fused_model=models_pack.aesthetics_scorer["fused_model"],
+    )
+    for i, aesthetic_score_result in enumerate(aesthetic_scores):
+        print(
+            f"🎨 Image {i+1} | Rating Score: {aesthetic_score_result.rating_score} | Artifact Score: {aesthetic_score_result.artifact_score}"
+        )
+    e_aes = time.time()
+    print(f"🎨 Calculated aesthetic scores in: {round((e_aes - s_aes) * 1000)} ms")
+    return aesthetic_scores
+
+
+def create_output_objects(
+    input: PredictInput,
+    output_images,
+    open_clip_embeds_of_images,
+    open_clip_embed_of_prompt,
+    aesthetic_scores: List[AestheticScoreResult],
+) -> List[PredictOutput]:
+    output_objects: List[PredictOutput] = []
+    if isinstance(output_images, torch.Tensor):
+        # Generated images leave the device once, PIL conversion waits for the encoder
+        output_images = tensor_to_uint8_arrays(output_images)
+    for i, image in enumerate(output_images):
+        obj = PredictOutput(
+            image=image,
+            target_quality=input.output_image_quality,
+            target_extension=input.output_image_extension,
+            open_clip_image_embed=open_clip_embeds_of_images[i]
+            if open_clip_embeds_of_images is not None
+            else None,
+            open_clip_prompt_embed=open_clip_embed_of_prompt
+            if open_clip_embed_of_prompt is not None
+            else None,
+            aesthetic_rating_score=aesthetic_scores[i].rating_score,
+            aesthetic_artifact_score=aesthetic_scores[i].artifact_score,
+        )
+        output_objects.append(obj)
+    return output_objects
+
+
 def predict(
     input: PredictInput,
     models_pack: ModelsPack,
+    prefetched: PrefetchedInputs | None = None,
 ) -> PredictResult:
     process_start = time.time()
     print("//////////////////////////////////////////////////////////////////")
@@ -180,22 +305,12 @@ def predict(
     output_images = []
     nsfw_count = 0
     open_clip_embeds_of_images = None
+    open_clip_pooled_of_images = None
     open_clip_embed_of_prompt = None
     saved_safety_checker = None
 
     if input.process_type == "generate" or input.process_type == "generate_and_upscale":
-        t_prompt = input.prompt
-        t_negative_prompt = input.negative_prompt
-        if input.translator_cog_url is not None and input.skip_translation is False:
-            [t_prompt, t_negative_prompt] = translate_text_set_via_api(
-                text_1=input.prompt,
-                flores_1=input.prompt_flores_200_code,
-                text_2=input.negative_prompt,
-                flores_2=input.negative_prompt_flores_200_code,
-                translator_url=input.translator_cog_url,
-                detector=models_pack.translator["detector"],
-                label="Prompt & Negative Prompt",
-            )
+        t_prompt, t_negative_prompt = translate_prompts(input, models_pack)
         prompt_is_translated = input.prompt is not None and t_prompt != input.prompt
         neg_prompt_is_translated = (
             input.negative_prompt is not None
@@ -270,6 +385,9 @@ def predict(
             "model": input.model,
             "pipe": generator_pipe,
         }
+        if prefetched is not None:
+            args["init_image"] = prefetched.init_image
+            args["mask_image"] = prefetched.mask_image
 
         if input.model == KANDINSKY_2_1_MODEL_NAME:
             generate_output_images, generate_nsfw_count = generate_with_kandinsky(
@@ -304,6 +422,7 @@ def predict(
             [t_prompt],
             models_pack.open_clip["model"],
             models_pack.open_clip["tokenizer"],
+            input.embedding_encoding,
         )[0]
         end_open_clip_prompt = time.time()
         print(
@@ -312,10 +431,11 @@ def predict(
 
         if len(output_images) > 0:
             start_open_clip_image = time.time()
-            open_clip_embeds_of_images = open_clip_get_embeds_of_images(
-                output_images,
-                models_pack.open_clip["model"],
-                models_pack.open_clip["processor"],
+            (
+                open_clip_pooled_of_images,
+                open_clip_embeds_of_images,
+            ) = open_clip_get_features_of_images(
+                output_images, models_pack.open_clip["model"], input.embedding_encoding
             )
             end_open_clip_image = time.time()
             print(
@@ -330,52 +450,31 @@ def predict(
     if input.process_type == "upscale" or input.process_type == "generate_and_upscale":
         startTime = time.time()
         if input.process_type == "upscale":
-            upscale_output_image = upscale(input.image_to_upscale, models_pack.upscaler)
+            image_to_upscale = resolve_image_to_upscale(
+                input.image_to_upscale, prefetched
+            )
+            upscale_output_image = upscale(image_to_upscale, models_pack.upscaler)
             output_images = [upscale_output_image]
         else:
             upscale_output_images = []
-            for image in output_images:
+            for image in tensor_to_uint8_arrays(output_images):
                 upscale_output_image = upscale(image, models_pack.upscaler)
                 upscale_output_images.append(upscale_output_image)
             output_images = upscale_output_images
         endTime = time.time()
         print(f"⭐️ Upscaled in: {round((endTime - startTime) * 1000)} ms ⭐️")
 
-    # Aesthetic Score
-    s_aes = time.time()
-    aesthetic_scores: List[AestheticScoreResult] = []
-    for i, image in enumerate(output_images):
-        aesthetic_score_result = generate_aesthetic_scores(
-            img=image,
-            rating_model=models_pack.aesthetics_scorer["rating_model"],
-            artifacts_model=models_pack.aesthetics_scorer["artifact_model"],
-            clip_processor=models_pack.open_clip["processor"],
-            vision_model=models_pack.open_clip["model"].vision_model,
-        )
-        aesthetic_scores.append(aesthetic_score_result)
-        print(
-            f"🎨 Image {i+1} | Rating Score: {aesthetic_score_result.rating_score} | Artifact Score: {aesthetic_score_result.artifact_score}"
-        )
-    e_aes = time.time()
-    print(f"🎨 Calculated aesthetic scores in: {round((e_aes - s_aes) * 1000)} ms")
-
-    # Prepare output objects
-    output_objects: List[PredictOutput] = []
-    for i, image in enumerate(output_images):
-        obj = PredictOutput(
-            pil_image=image,
-            target_quality=input.output_image_quality,
-            target_extension=input.output_image_extension,
-            open_clip_image_embed=open_clip_embeds_of_images[i]
-            if open_clip_embeds_of_images is not None
-            else None,
-            open_clip_prompt_embed=open_clip_embed_of_prompt
-            if open_clip_embed_of_prompt is not None
-            else None,
-            aesthetic_rating_score=aesthetic_scores[i].rating_score,
-            aesthetic_artifact_score=aesthetic_scores[i].artifact_score,
-        )
-        output_objects.append(obj)
+    # Upscaled images are scored from the vision pass of the generated ones
+    aesthetic_scores = get_aesthetic_scores(
+        output_images, models_pack, pooled_output=open_clip_pooled_of_images
+    )
+    output_objects = create_output_objects(
+        input=input,
+        output_images=output_images,
+        open_clip_embeds_of_images=open_clip_embeds_of_images,
+        open_clip_embed_of_prompt=open_clip_embed_of_prompt,
+        aesthetic_scores=aesthetic_scores,
+    )
 
     result = PredictResult(
         outputs=output_objects,
@@ -394,3 +493,132 @@ def predict(
     print("//////////////////////////////////////////////////////////////////")
 
     return result
+
+
+def predict_batch(
+    inputs: List[PredictInput],
+    models_pack: ModelsPack,
+    prefetched: List[PrefetchedInputs | None] | None = None,
+) -> List[PredictResult]:
+    """Runs compatible "generate" inputs (same batch key) through one pipeline call."""
+    process_start = time.time()
+    print("//////////////////////////////////////////////////////////////////")
+    print(f"⏳ Batch process started: {len(inputs)} jobs ⏳")
+    log_gpu_memory(message="GPU status before batched inference")
+
+    first = inputs[0]
+    generator_pipe = models_pack.sd_pipes[first.model]
+    saved_safety_checker = None
+    if first.skip_safety_checker and hasattr(generator_pipe, "safety_checker"):
+        saved_safety_checker = generator_pipe.safety_checker
+        generator_pipe.safety_checker = None
+
+    try:
+        translated = translate_prompts_batch(inputs, models_pack)
+
+        log_table = [
+            ["Model", first.model],
+            ["Width", first.width],
+            ["Height", first.height],
+            ["Steps", first.num_inference_steps],
+            ["Guidance Scale", first.guidance_scale],
+            ["Scheduler", first.scheduler],
+            ["Jobs", len(inputs)],
+            ["Outputs", sum(input.num_outputs for input in inputs)],
+        ]
+        print(
+            tabulate(
+                [["🖼️  Batch Generation 🟡", "Started"]] + log_table,
+                tablefmt="double_grid",
+            )
+        )
+
+        startTime = time.time()
+        jobs = [
+            {
+                "prompt": t_prompt,
+                "negative_prompt": t_negative_prompt,
+                "prompt_prefix": input.prompt_prefix,
+                "negative_prompt_prefix": input.negative_prompt_prefix,
+                "num_outputs": input.num_outputs,
+                "init_image_url": input.init_image_url,
+                "init_image": prefetched[i].init_image
+                if prefetched is not None and prefetched[i] is not None
+                else None,
+                "seed": input.seed,
+            }
+            for i, (input, (t_prompt, t_negative_prompt)) in enumerate(
+                zip(inputs, translated)
+            )
+        ]
+        generated = generate_batch_with_sd(
+            jobs=jobs,
+            width=first.width,
+            height=first.height,
+            num_inference_steps=first.num_inference_steps,
+            guidance_scale=first.guidance_scale,
+            prompt_strength=first.prompt_strength,
+            scheduler=first.scheduler,
+            model=first.model,
+            pipe=generator_pipe,
+        )
+        endTime = time.time()
+        print(
+            tabulate(
+                [["🖼️  Batch Generation 🟢", f"{round((endTime - startTime) * 1000)} ms"]]
+                + log_table,
+                tablefmt="double_grid",
+            ),
+        )
+    finally:
+        if saved_safety_checker is not None:
+            generator_pipe.safety_checker = saved_safety_checker
+
+    # Embed all prompts and all images of the batch in one go
+    start_open_clip = time.time()
+    prompt_embeds = open_clip_get_embeds_of_texts(
+        [t_prompt for t_prompt, _ in translated],
+        models_pack.open_clip["model"],
+        models_pack.open_clip["tokenizer"],
+        # Part of the batch key, the same for all the jobs
+        inputs[0].embedding_encoding,
+    )
+    all_images = torch.cat([output_images for output_images, _ in generated])
+    all_image_embeds = []
+    all_pooled = None
+    if len(all_images) > 0:
+        all_pooled, all_image_embeds = open_clip_get_features_of_images(
+            all_images, models_pack.open_clip["model"], inputs[0].embedding_encoding
+        )
+    end_open_clip = time.time()
+    print(
+        f"🖼️ Open CLIP batch embeddings in: {round((end_open_clip - start_open_clip) * 1000)} ms - {len(all_images)} images 🖼️"
+    )
+    all_aesthetic_scores = get_aesthetic_scores(
+        all_images, models_pack, pooled_output=all_pooled
+    )
+
+    # One device to host transfer for the images of all the jobs
+    all_image_arrays = tensor_to_uint8_arrays(all_images)
+    results: List[PredictResult] = []
+    offset = 0
+    for i, input in enumerate(inputs):
+        output_images, nsfw_count = generated[i]
+        end = offset + len(output_images)
+        output_objects = create_output_objects(
+            input=input,
+            output_images=all_image_arrays[offset:end],
+            open_clip_embeds_of_images=all_image_embeds[offset:end],
+            open_clip_embed_of_prompt=prompt_embeds[i],
+            aesthetic_scores=all_aesthetic_scores[offset:end],
+        )
+        results.append(PredictResult(outputs=output_objects, nsfw_count=nsfw_count))
+        offset = end
+
+    process_end = time.time()
+    print(
+        f"✅ Batch process completed in: {round((process_end - process_start) * 1000)} ms ✅"
+    )
+    print("//////////////////////////////////////////////////////////////////")
+
+    return results
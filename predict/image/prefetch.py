@@ -0,0 +1,174 @@
+import json
+import logging
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Dict
+
+import numpy as np
+from PIL import Image
+
+from models.swinir.upscale import download_image as download_image_to_upscale
+from models.swinir.upscale import is_url
+from shared.helpers import download_and_fit_image
+
+from .constants import (
+    PREFETCH_MAX_WORKERS,
+    PREFETCH_MEMORY_BUDGET,
+    PREFETCH_UPSCALE_ESTIMATED_BYTES,
+)
+
+
+class PrefetchedInputs:
+    """Downloaded and decoded input images of a job, ready to be passed to predict()"""
+
+    def __init__(
+        self,
+        init_image: Image.Image | None = None,
+        mask_image: Image.Image | None = None,
+        image_to_upscale: np.ndarray | None = None,
+        nbytes: int = 0,
+    ):
+        self.init_image = init_image
+        self.mask_image = mask_image
+        self.image_to_upscale = image_to_upscale
+        self.nbytes = nbytes
+
+
+def resolve_image_to_upscale(
+    image_to_upscale: str | None, prefetched: PrefetchedInputs | None
+) -> str | np.ndarray | None:
+    """The prefetched image when there is one, it's BGR like the URL path downloads it"""
+    if prefetched is not None and prefetched.image_to_upscale is not None:
+        return prefetched.image_to_upscale
+    return image_to_upscale
+
+
+def get_image_nbytes(image: Image.Image | np.ndarray | None) -> int:
+    if image is None:
+        return 0
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
+
+
+def estimate_nbytes(input_obj: Dict[str, Any]) -> int:
+    """Upper bound of the decoded size of a job's inputs, reserved before downloading"""
+    nbytes = 0
+    width = input_obj.get("width", 512)
+    height = input_obj.get("height", 512)
+    if input_obj.get("init_image_url", None) is not None:
+        nbytes += width * height * 3
+    if input_obj.get("mask_image_url", None) is not None:
+        nbytes += width * height * 3
+    image_to_upscale = input_obj.get("image_to_upscale", None)
+    if image_to_upscale is not None and is_url(image_to_upscale):
+        nbytes += PREFETCH_UPSCALE_ESTIMATED_BYTES
+    return nbytes
+
+
+class InputPrefetcher:
+    """Fetches, decodes and fits the input images of upcoming jobs while the GPU is busy.
+
+    Jobs are submitted as they are received. Decoded inputs are held until `take` is
+    called for the job, within a memory budget; jobs that don't fit in it are skipped
+    and fall back to downloading inside predict().
+    """
+
+    def __init__(
+        self,
+        max_workers: int = PREFETCH_MAX_WORKERS,
+        memory_budget: int = PREFETCH_MEMORY_BUDGET,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="prefetch"
+        )
+        self.memory_budget = memory_budget
+        self.reserved = 0
+        self.lock = Lock()
+        self.futures: Dict[Any, Future] = {}
+
+    def reserve(self, nbytes: int) -> bool:
+        with self.lock:
+            if self.reserved + nbytes > self.memory_budget:
+                return False
+            self.reserved += nbytes
+            return True
+
+    def release(self, nbytes: int):
+        with self.lock:
+            self.reserved -= nbytes
+
+    def submit(self, job_id: Any, body: bytes) -> None:
+        """Non-blocking, safe to call from the AMQP I/O thread"""
+        self.futures[job_id] = self.executor.submit(self.fetch, body)
+
+    def fetch(self, body: bytes) -> PrefetchedInputs | None:
+        try:
+            input_obj = json.loads(body.decode("utf-8")).get("input", {})
+        except Exception:
+            return None
+        reserved = estimate_nbytes(input_obj)
+        if reserved == 0:
+            return None
+        if not self.reserve(reserved):
+            logging.info(
+                f"-- Prefetch: Memory budget reached, inputs will be fetched by predict --"
+            )
+            return None
+
+        try:
+            s = time.time()
+            width = input_obj.get("width", 512)
+            height = input_obj.get("height", 512)
+            inputs = PrefetchedInputs()
+            if input_obj.get("init_image_url", None) is not None:
+                inputs.init_image = download_and_fit_image(
+                    url=input_obj["init_image_url"], width=width, height=height
+                )
+            if input_obj.get("mask_image_url", None) is not None:
+                inputs.mask_image = download_and_fit_image(
+                    url=input_obj["mask_image_url"], width=width, height=height
+                )
+            image_to_upscale = input_obj.get("image_to_upscale", None)
+            if image_to_upscale is not None and is_url(image_to_upscale):
+                inputs.image_to_upscale = download_image_to_upscale(image_to_upscale)
+            inputs.nbytes = (
+                get_image_nbytes(inputs.init_image)
+                + get_image_nbytes(inputs.mask_image)
+                + get_image_nbytes(inputs.image_to_upscale)
+            )
+            e = time.time()
+            logging.info(
+                f"-- Prefetch: Fetched inputs in: {round((e - s) * 1000)} ms - {round(inputs.nbytes / 1024**2, 1)} MB --"
+            )
+        except Exception:
+            tb = traceback.format_exc()
+            logging.error(f"-- Prefetch: Failed, predict will retry: {tb}\n")
+            self.release(reserved)
+            return None
+
+        # Keep the actual decoded size reserved until the job takes its inputs
+        self.release(reserved - inputs.nbytes)
+        return inputs
+
+    def take(self, job_id: Any) -> PrefetchedInputs | None:
+        """Waits for the job's inputs and hands them over, releasing their budget"""
+        future = self.futures.pop(job_id, None)
+        if future is None:
+            return None
+        inputs = future.result()
+        if inputs is not None:
+            self.release(inputs.nbytes)
+        return inputs
+
+    def discard(self, job_id: Any) -> None:
+        future = self.futures.pop(job_id, None)
+        if future is None:
+            return
+        if future.cancel():
+            return
+        future.add_done_callback(
+            lambda f: self.release(f.result().nbytes) if f.result() is not None else None
+        )
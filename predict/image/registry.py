@@ -0,0 +1,174 @@
+import gc
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set
+
+import torch
+
+from models.stable_diffusion.constants import (
+    SD_GPU_MEMORY_BUDGET,
+    SD_HOST_MEMORY_BUDGET,
+)
+from models.stable_diffusion.residency import get_pipe_tensors, residency_manager
+from predict.image.components import component_cache
+from shared.helpers import print_tuple
+
+
+def get_pipes(pipe_set: Any) -> List[Any]:
+    pipes = [pipe_set.text2img, pipe_set.img2img, pipe_set.inpaint, pipe_set.refiner]
+    return [pipe for pipe in pipes if pipe is not None]
+
+
+def get_tensors_nbytes(tensors: Iterable[torch.Tensor]) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class RegistryEntry:
+    def __init__(self, key: str, pipe_set: Any, nbytes: int):
+        self.key = key
+        self.pipe_set = pipe_set
+        self.nbytes = nbytes
+        self.last_used = time.time()
+
+    @property
+    def on_host(self) -> bool:
+        """Pipelines handed to the residency manager live in host memory when idle"""
+        return residency_manager.is_registered(self.key)
+
+
+class ModelRegistry:
+    """Dict-like store of SD pipe sets that loads them on first use.
+
+    Pipelines that stay on the GPU are kept within `gpu_budget`: least recently used
+    ones are demoted to host memory and handed to the residency manager, like
+    keep_in_cpu_when_idle models. Pipelines in host memory are kept within
+    `host_budget`: least recently used ones are dropped and loaded again from the
+    disk cache on next use. A budget of 0 is unlimited.
+    """
+
+    def __init__(
+        self,
+        keys: Iterable[str],
+        load: Callable[[str], Any],
+        gpu_budget: int = SD_GPU_MEMORY_BUDGET,
+        host_budget: int = SD_HOST_MEMORY_BUDGET,
+    ):
+        self.available = list(keys)
+        self.load = load
+        self.gpu_budget = gpu_budget
+        self.host_budget = host_budget
+        self.lock = Lock()
+        self.loading: Dict[str, Lock] = {}
+        self.entries: OrderedDict[str, RegistryEntry] = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.available
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self.available:
+            raise KeyError(key)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None:
+                return self.touch(entry)
+            loading_lock = self.loading.setdefault(key, Lock())
+        # Different pipe sets can load at the same time, each one only once
+        with loading_lock:
+            with self.lock:
+                entry = self.entries.get(key, None)
+            if entry is None:
+                entry = self.load_entry(key)
+        with self.lock:
+            return self.touch(entry)
+
+    def touch(self, entry: RegistryEntry) -> Any:
+        entry.last_used = time.time()
+        if entry.key in self.entries:
+            self.entries.move_to_end(entry.key)
+        return entry.pipe_set
+
+    def __iter__(self) -> Iterator[str]:
+        """Only iterates over loaded pipe sets"""
+        with self.lock:
+            return iter(list(self.entries.keys()))
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get_loaded(self, key: str) -> Any | None:
+        """The pipe set if it's loaded, without loading it or marking it as used"""
+        with self.lock:
+            entry = self.entries.get(key, None)
+        return entry.pipe_set if entry is not None else None
+
+    def preload(self, keys: Iterable[str]) -> None:
+        for key in keys:
+            self[key]
+
+    def get_gpu_bytes(self) -> int:
+        return sum(e.nbytes for e in self.entries.values() if not e.on_host)
+
+    def get_host_bytes(self) -> int:
+        return sum(e.nbytes for e in self.entries.values() if e.on_host)
+
+    def get_shared_tensor_ids(self, key: str) -> Set[int]:
+        """Tensors of shared components and of the other loaded pipe sets"""
+        ids = component_cache.get_tensor_ids()
+        for entry in self.entries.values():
+            if entry.key == key:
+                continue
+            for tensor in get_pipe_tensors(*get_pipes(entry.pipe_set)):
+                ids.add(id(tensor))
+        return ids
+
+    def load_entry(self, key: str) -> RegistryEntry:
+        s = time.time()
+        pipe_set = self.load(key)
+        nbytes = get_tensors_nbytes(get_pipe_tensors(*get_pipes(pipe_set)))
+        entry = RegistryEntry(key, pipe_set, nbytes)
+        with self.lock:
+            self.entries[key] = entry
+            self.enforce_budgets(keep=key)
+        e = time.time()
+        print_tuple(
+            f"📦 Registry loaded {key}",
+            f"{round(nbytes / 1024**2)} MB - {round((e - s) * 1000)} ms",
+        )
+        return entry
+
+    def least_recently_used(self, on_host: bool, keep: str) -> RegistryEntry | None:
+        for entry in self.entries.values():
+            if entry.key != keep and entry.on_host == on_host:
+                return entry
+        return None
+
+    def enforce_budgets(self, keep: str) -> None:
+        while self.gpu_budget > 0 and self.get_gpu_bytes() > self.gpu_budget:
+            entry = self.least_recently_used(on_host=False, keep=keep)
+            if entry is None:
+                break
+            self.demote(entry)
+        while self.host_budget > 0 and self.get_host_bytes() > self.host_budget:
+            entry = self.least_recently_used(on_host=True, keep=keep)
+            if entry is None:
+                break
+            self.drop(entry)
+
+    def demote(self, entry: RegistryEntry) -> None:
+        """Moves a GPU pipe set to host memory, it's uploaded again when a job needs it"""
+        residency_manager.register(
+            entry.key,
+            *get_pipes(entry.pipe_set),
+            exclude=self.get_shared_tensor_ids(entry.key),
+        )
+        torch.cuda.empty_cache()
+        print_tuple(f"🐌 Registry demoted {entry.key} to CPU", "GPU budget")
+
+    def drop(self, entry: RegistryEntry) -> None:
+        residency_manager.unregister(entry.key)
+        del self.entries[entry.key]
+        entry.pipe_set = None
+        gc.collect()
+        torch.cuda.empty_cache()
+        print_tuple(f"🗑️  Registry dropped {entry.key}", "Host budget")
@@ -8,7 +8,10 @@ from models.aesthetics_scorer.constants import (
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
     AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
 )
-from models.aesthetics_scorer.model import load_model as load_aesthetics_scorer_model
+from models.aesthetics_scorer.model import (
+    FusedAestheticScorers,
+    load_model as load_aesthetics_scorer_model,
+)
 from models.kandinsky.constants import (
     KANDINSKY_2_2_DECODER_INPAINT_MODEL_ID,
     KANDINSKY_2_2_DECODER_MODEL_ID,
@@ -19,22 +22,26 @@ from models.kandinsky.constants import (
 from models.nllb.constants import TRANSLATOR_CACHE
 from shared.constants import (
     SKIP_SAFETY_CHECKER,
+    WORKER_OFFLINE,
     WORKER_VERSION,
 )
 from models.stable_diffusion.constants import (
     SD_MODEL_FOR_SAFETY_CHECKER,
     SD_MODELS,
+    SD_MODELS_ALL,
     SD_MODEL_CACHE,
+    SD_LAZY_LOAD,
 )
 from diffusers import StableDiffusionPipeline, AutoPipelineForInpainting
 from models.swinir.helpers import get_args_swinir, define_model_swinir
-from models.swinir.constants import TASKS_SWINIR, MODELS_SWINIR, DEVICE_SWINIR
+from models.swinir.constants import TASKS_SWINIR, DEVICE_SWINIR
 from models.download.download_from_hf import (
     download_swinir_models,
 )
 import time
 from models.constants import DEVICE
 from transformers import (
+    CLIPImageProcessor,
     AutoProcessor,
     AutoTokenizer,
     AutoModel,
@@ -44,7 +51,12 @@ import os
 from huggingface_hub import _login
 from kandinsky2 import get_kandinsky2
 from functools import partial
-from models.stable_diffusion.filter import forward_inspect
+from models.stable_diffusion.filter import forward_inspect, inspect_batch
+from models.stable_diffusion.residency import residency_manager
+from predict.image.components import component_cache
+from predict.image.loader import ParallelLoader
+from predict.image.registry import ModelRegistry
+from predict.image.snapshot import load_with_snapshot
 from diffusers import (
     StableDiffusionXLPipeline,
     StableDiffusionXLImg2ImgPipeline,
@@ -57,6 +69,9 @@ from diffusers import (
     KandinskyV22InpaintPipeline,
 )
 from diffusers.models import AutoencoderKL
+from diffusers.pipelines.stable_diffusion.safety_checker import (
+    StableDiffusionSafetyChecker,
+)
 import torch
 
 from shared.helpers import print_tuple
@@ -111,7 +126,7 @@ class KandinskyPipe_2_2:
 class ModelsPack:
     def __init__(
         self,
-        sd_pipes: dict[str, SDPipeSet],
+        sd_pipes: ModelRegistry,
         upscaler: Any,
         translator: Any,
         open_clip: Any,
@@ -135,29 +150,37 @@ def setup() -> ModelsPack:
     print(f"⏳ Setup has started - Version: {WORKER_VERSION}")
 
     hf_token = os.environ.get("HUGGINGFACE_TOKEN", None)
-    if hf_token is not None:
+    if hf_token is not None and not WORKER_OFFLINE:
         _login.login(token=hf_token)
         print(f"✅ Logged in to HuggingFace")
 
-    download_swinir_models()
-
-    sd_pipes: dict[str, SDPipeSet] = {}
-
-    def get_saved_sd_model(model_id_key: str, model_id: str, model_type_for_class: str):
-        for key in sd_pipes:
-            model_definition = SD_MODELS.get(key, None)
-            if model_definition is None:
-                continue
-            relevant_model_id = model_definition.get(model_id_key, None)
-            if relevant_model_id is None:
-                continue
-            if relevant_model_id == model_id:
-                model = getattr(sd_pipes[key], model_type_for_class, None)
-                if model:
-                    return model
-        return None
-
-    for key in SD_MODELS:
+    def get_vae(vae_id: str) -> AutoencoderKL:
+        return component_cache.get(
+            (vae_id, None),
+            lambda: AutoencoderKL.from_pretrained(
+                vae_id,
+                torch_dtype=torch.float16,
+                cache_dir=SD_MODEL_CACHE,
+            ).to(DEVICE),
+        )
+
+    def get_safety_checker(model_id: str, torch_dtype: Any):
+        checker = component_cache.from_pretrained(
+            StableDiffusionSafetyChecker,
+            model_id,
+            subfolder="safety_checker",
+            torch_dtype=torch_dtype,
+            cache_dir=SD_MODEL_CACHE,
+        )
+        feature_extractor = component_cache.from_pretrained(
+            CLIPImageProcessor,
+            model_id,
+            subfolder="feature_extractor",
+            cache_dir=SD_MODEL_CACHE,
+        )
+        return checker.to(DEVICE), feature_extractor
+
+    def load_sd_pipe(key: str) -> SDPipeSet:
         s = time.time()
         print(f"⏳ Loading SD model: {key}")
 
@@ -169,31 +192,11 @@ def setup() -> ModelsPack:
             refiner_vae_id = SD_MODELS[key].get("refiner_vae", None)
             vae_id = SD_MODELS[key].get("vae", None)
             if refiner_vae_id is not None:
-                refiner_vae = get_saved_sd_model(
-                    model_id_key="refiner_vae",
-                    model_id=refiner_vae_id,
-                    model_type_for_class="refiner_vae",
-                )
-                if refiner_vae == None:
-                    refiner_vae = AutoencoderKL.from_pretrained(
-                        refiner_vae_id,
-                        torch_dtype=torch.float16,
-                        cache_dir=SD_MODEL_CACHE,
-                    )
+                refiner_vae = get_vae(refiner_vae_id)
             if key == "SDXL":
                 vae = refiner_vae
             elif vae_id is not None:
-                vae = get_saved_sd_model(
-                    model_id_key="vae",
-                    model_id=vae_id,
-                    model_type_for_class="vae",
-                )
-                if vae == None:
-                    vae = AutoencoderKL.from_pretrained(
-                        vae_id,
-                        torch_dtype=torch.float16,
-                        cache_dir=SD_MODEL_CACHE,
-                    )
+                vae = get_vae(vae_id)
             args = {
                 "pretrained_model_name_or_path": SD_MODELS[key]["id"],
                 "torch_dtype": SD_MODELS[key]["torch_dtype"],
@@ -202,9 +205,20 @@ def setup() -> ModelsPack:
                 "use_safetensors": True,
                 "add_watermarker": False,
             }
+            snapshot_args = {
+                "torch_dtype": SD_MODELS[key]["torch_dtype"],
+                "add_watermarker": False,
+            }
             if vae is not None:
                 args["vae"] = vae
-            text2img = StableDiffusionXLPipeline.from_pretrained(**args)
+                snapshot_args["vae"] = vae
+            text2img = load_with_snapshot(
+                key,
+                SD_MODELS[key],
+                StableDiffusionXLPipeline,
+                lambda: StableDiffusionXLPipeline.from_pretrained(**args),
+                **snapshot_args,
+            )
 
             if "default_lora" in SD_MODELS[key]:
                 lora = SD_MODELS[key]["default_lora"]
@@ -219,28 +233,40 @@ def setup() -> ModelsPack:
                 "refiner_id" in SD_MODELS[key]
                 and SD_MODELS[key]["refiner_id"] is not None
             ):
-                refiner_args = {
-                    "pretrained_model_name_or_path": SD_MODELS[key]["refiner_id"],
-                    "torch_dtype": SD_MODELS[key]["torch_dtype"],
-                    "cache_dir": SD_MODEL_CACHE,
-                    "variant": SD_MODELS[key]["variant"],
-                    "use_safetensors": True,
-                    "add_watermarker": False,
-                }
-                if refiner_vae is not None:
-                    refiner_args["vae"] = refiner_vae
-                refiner = StableDiffusionXLImg2ImgPipeline.from_pretrained(
-                    SD_MODELS[key]["refiner_id"],
-                    torch_dtype=SD_MODELS[key]["torch_dtype"],
-                    cache_dir=SD_MODEL_CACHE,
-                    variant=SD_MODELS[key]["variant"],
-                    use_safetensors=True,
-                    vae=refiner_vae,
-                    add_watermarker=False,
+                # The same refiner is used by the whole SDXL family
+                refiner_id = SD_MODELS[key]["refiner_id"]
+                refiner_key = (
+                    refiner_id,
+                    None,
+                    SD_MODELS[key].get("refiner_vae", None),
+                    SD_MODELS[key]["torch_dtype"],
+                    SD_MODELS[key]["variant"],
+                )
+                refiner = component_cache.get(
+                    refiner_key,
+                    lambda: load_with_snapshot(
+                        refiner_id,
+                        {
+                            "refiner_vae": refiner_key[2],
+                            "torch_dtype": SD_MODELS[key]["torch_dtype"],
+                            "variant": SD_MODELS[key]["variant"],
+                        },
+                        StableDiffusionXLImg2ImgPipeline,
+                        lambda: StableDiffusionXLImg2ImgPipeline.from_pretrained(
+                            refiner_id,
+                            torch_dtype=SD_MODELS[key]["torch_dtype"],
+                            cache_dir=SD_MODEL_CACHE,
+                            variant=SD_MODELS[key]["variant"],
+                            use_safetensors=True,
+                            vae=refiner_vae,
+                            add_watermarker=False,
+                        ),
+                        torch_dtype=SD_MODELS[key]["torch_dtype"],
+                        vae=refiner_vae,
+                        add_watermarker=False,
+                    ).to(DEVICE),
                 )
             text2img = text2img.to(DEVICE)
-            if refiner is not None:
-                refiner = refiner.to(DEVICE)
             img2img = StableDiffusionXLImg2ImgPipeline(**text2img.components)
 
             inpaint = None
@@ -271,14 +297,32 @@ def setup() -> ModelsPack:
             extra_args = {}
             if SKIP_SAFETY_CHECKER == "1":
                 extra_args["safety_checker"] = None
-            text2img = StableDiffusionPipeline.from_pretrained(
-                SD_MODELS[key]["id"],
+            else:
+                # All SD 1.x models use the standalone safety checker, loaded once per dtype
+                checker, feature_extractor = get_safety_checker(
+                    SD_MODELS_ALL[SD_MODEL_FOR_SAFETY_CHECKER]["id"],
+                    SD_MODELS[key]["torch_dtype"],
+                )
+                extra_args["safety_checker"] = checker
+                extra_args["feature_extractor"] = feature_extractor
+            text2img = load_with_snapshot(
+                key,
+                {**SD_MODELS[key], "skip_safety_checker": SKIP_SAFETY_CHECKER},
+                StableDiffusionPipeline,
+                lambda: StableDiffusionPipeline.from_pretrained(
+                    SD_MODELS[key]["id"],
+                    torch_dtype=SD_MODELS[key]["torch_dtype"],
+                    cache_dir=SD_MODEL_CACHE,
+                    **extra_args,
+                ),
                 torch_dtype=SD_MODELS[key]["torch_dtype"],
-                cache_dir=SD_MODEL_CACHE,
                 **extra_args,
             )
             if "keep_in_cpu_when_idle" in SD_MODELS[key]:
-                text2img = text2img.to("cpu", silence_dtype_warnings=True)
+                # Shared components stay on the GPU
+                residency_manager.register(
+                    key, text2img, exclude=component_cache.get_tensor_ids()
+                )
                 print_tuple("🐌 Keep in CPU when idle", key)
             else:
                 text2img = text2img.to(DEVICE)
@@ -301,35 +345,32 @@ def setup() -> ModelsPack:
                 refiner=None,
             )
 
-        sd_pipes[key] = pipe
         print(
             f"✅ Loaded SD model: {key} | Duration: {round(time.time() - s, 1)} seconds"
         )
+        return pipe
+
+    sd_pipes = ModelRegistry(keys=SD_MODELS.keys(), load=load_sd_pipe)
 
     # Safety checker for Kandinsky
-    safety_checker = None
-    if SKIP_SAFETY_CHECKER == "1":
-        safety_checker = None
-    else:
+    def load_safety_checker():
         print("⏳ Loading safety checker")
-        safety_pipe = StableDiffusionPipeline.from_pretrained(
-            SD_MODELS[SD_MODEL_FOR_SAFETY_CHECKER]["id"],
-            torch_dtype=SD_MODELS[key]["torch_dtype"],
-            cache_dir=SD_MODEL_CACHE,
-        )
-        safety_pipe = safety_pipe.to(DEVICE)
-        safety_pipe.safety_checker.forward = partial(
-            forward_inspect, self=safety_pipe.safety_checker
+        checker, feature_extractor = get_safety_checker(
+            SD_MODELS_ALL[SD_MODEL_FOR_SAFETY_CHECKER]["id"],
+            SD_MODELS_ALL[SD_MODEL_FOR_SAFETY_CHECKER]["torch_dtype"],
         )
         safety_checker = {
-            "checker": safety_pipe.safety_checker,
-            "feature_extractor": safety_pipe.feature_extractor,
+            "checker": checker,
+            "feature_extractor": feature_extractor,
+            # The checker can be shared with an SD pipeline, so its forward isn't patched
+            "inspect": partial(forward_inspect, self=checker),
+            "inspect_batch": partial(inspect_batch, checker),
         }
         print("✅ Loaded safety checker")
+        return safety_checker
 
     # Kandinsky 2.1
-    kandinsky = None
-    if LOAD_KANDINSKY_2_1:
+    def load_kandinsky_2_1():
         s = time.time()
         print("⏳ Loading Kandinsky 2.1")
         text2img = get_kandinsky2(
@@ -354,10 +395,10 @@ def setup() -> ModelsPack:
         print(
             f"✅ Loaded Kandinsky 2.1 | Duration: {round(time.time() - s, 1)} seconds"
         )
+        return kandinsky
 
     # Kandinsky 2.2
-    kandinsky_2_2 = None
-    if LOAD_KANDINSKY_2_2:
+    def load_kandinsky_2_2():
         s = time.time()
         print("⏳ Loading Kandinsky 2.2")
         prior = KandinskyV22PriorPipeline.from_pretrained(
@@ -385,63 +426,123 @@ def setup() -> ModelsPack:
         print(
             f"✅ Loaded Kandinsky 2.2 | Duration: {round(time.time() - s, 1)} seconds"
         )
+        return kandinsky_2_2
 
     # For upscaler
-    upscaler_args = get_args_swinir()
-    upscaler_args.task = TASKS_SWINIR["Real-World Image Super-Resolution-Large"]
-    upscaler_args.scale = 4
-    upscaler_args.model_path = MODELS_SWINIR["real_sr"]["large"]
-    upscaler_args.large_model = True
-    upscaler_pipe = define_model_swinir(upscaler_args)
-    upscaler_pipe.eval()
-    upscaler_pipe = upscaler_pipe.to(DEVICE_SWINIR)
-    upscaler = {
-        "pipe": upscaler_pipe,
-        "args": upscaler_args,
-    }
-    print("✅ Loaded upscaler")
+    def load_upscaler(swinir_weights: str):
+        upscaler_args = get_args_swinir()
+        upscaler_args.task = TASKS_SWINIR["Real-World Image Super-Resolution-Large"]
+        upscaler_args.scale = 4
+        upscaler_args.model_path = swinir_weights
+        upscaler_args.large_model = True
+        upscaler_pipe = define_model_swinir(upscaler_args)
+        upscaler_pipe.eval()
+        upscaler_pipe = upscaler_pipe.to(DEVICE_SWINIR)
+        upscaler = {
+            "pipe": upscaler_pipe,
+            "args": upscaler_args,
+        }
+        print("✅ Loaded upscaler")
+        return upscaler
 
     # For translator
-    translator = {
-        "detector": (
-            LanguageDetectorBuilder.from_all_languages()
-            .with_preloaded_language_models()
-            .build()
-        ),
-    }
-    print("✅ Loaded translator")
+    def load_translator():
+        translator = {
+            "detector": (
+                LanguageDetectorBuilder.from_all_languages()
+                .with_preloaded_language_models()
+                .build()
+            ),
+        }
+        print("✅ Loaded translator")
+        return translator
 
     # For OpenCLIP
-    print("⏳ Loading OpenCLIP")
-    open_clip = {
-        "model": AutoModel.from_pretrained(
-            OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
-        ).to(DEVICE),
-        "processor": AutoProcessor.from_pretrained(
-            OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
+    def load_open_clip():
+        print("⏳ Loading OpenCLIP")
+        open_clip = {
+            "model": AutoModel.from_pretrained(
+                OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
+            ).to(DEVICE),
+            "processor": AutoProcessor.from_pretrained(
+                OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
+            ),
+            "tokenizer": AutoTokenizer.from_pretrained(
+                OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
+            ),
+        }
+        print("✅ Loaded OpenCLIP")
+        return open_clip
+
+    # For asthetics scorer
+    def load_aesthetics_scorer(weight_url: str, config: Any):
+        return load_aesthetics_scorer_model(
+            weight_url=weight_url,
+            cache_dir=AESTHETICS_SCORER_CACHE_DIR,
+            config=config,
+        ).to(DEVICE)
+
+    def load_sd_model(key: str, *_vaes):
+        return sd_pipes[key]
+
+    loader = ParallelLoader()
+    loader.add("SwinIR weights", download_swinir_models)
+    loader.add("Upscaler", load_upscaler, ["SwinIR weights"])
+    loader.add("Translator", load_translator)
+    loader.add("OpenCLIP", load_open_clip)
+    loader.add(
+        "Aesthetics rating",
+        partial(
+            load_aesthetics_scorer,
+            AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
+            AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
         ),
-        "tokenizer": AutoTokenizer.from_pretrained(
-            OPEN_CLIP_MODEL_ID, cache_dir=TRANSLATOR_CACHE
+    )
+    loader.add(
+        "Aesthetics artifact",
+        partial(
+            load_aesthetics_scorer,
+            AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
+            AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
         ),
-    }
-    print("✅ Loaded OpenCLIP")
+    )
+    if SKIP_SAFETY_CHECKER != "1":
+        loader.add("Safety checker", load_safety_checker)
+    if LOAD_KANDINSKY_2_1:
+        loader.add("Kandinsky 2.1", load_kandinsky_2_1)
+    if LOAD_KANDINSKY_2_2:
+        loader.add("Kandinsky 2.2", load_kandinsky_2_2)
+    if SD_LAZY_LOAD:
+        print_tuple("💤 SD models load on their first job", len(SD_MODELS))
+    else:
+        for key in SD_MODELS:
+            # Shared VAEs load first, once
+            dependencies = []
+            if SD_MODELS[key].get("base_model", None) == "SDXL":
+                for vae_key in ["vae", "refiner_vae"]:
+                    vae_id = SD_MODELS[key].get(vae_key, None)
+                    if vae_id is None:
+                        continue
+                    if f"VAE {vae_id}" not in loader.tasks:
+                        loader.add(f"VAE {vae_id}", partial(get_vae, vae_id))
+                    dependencies.append(f"VAE {vae_id}")
+            loader.add(
+                f"SD {key}",
+                partial(load_sd_model, key),
+                dependencies,
+            )
+
+    components = loader.run()
+    loader.log_breakdown()
 
-    # For asthetics scorer
-    print("⏳ Loading Aesthetics Scorer")
-    rating_model = load_aesthetics_scorer_model(
-        weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_WEIGHT_URL,
-        cache_dir=AESTHETICS_SCORER_CACHE_DIR,
-        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
-    ).to(DEVICE)
-    artifact_model = load_aesthetics_scorer_model(
-        weight_url=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_WEIGHT_URL,
-        cache_dir=AESTHETICS_SCORER_CACHE_DIR,
-        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
-    ).to(DEVICE)
     aesthetics_scorer = {
-        "rating_model": rating_model,
-        "artifact_model": artifact_model,
+        "rating_model": components["Aesthetics rating"],
+        "artifact_model": components["Aesthetics artifact"],
     }
+    # Columns of the fused model: rating, artifact
+    aesthetics_scorer["fused_model"] = FusedAestheticScorers(
+        [aesthetics_scorer["rating_model"], aesthetics_scorer["artifact_model"]]
+    ).eval()
     print("✅ Loaded Aesthetics Scorer")
 
     end = time.time()
@@ -451,11 +552,11 @@ def setup() -> ModelsPack:
 
     return ModelsPack(
         sd_pipes=sd_pipes,
-        upscaler=upscaler,
-        translator=translator,
-        open_clip=open_clip,
-        kandinsky=kandinsky,
-        kandinsky_2_2=kandinsky_2_2,
-        safety_checker=safety_checker,
+        upscaler=components["Upscaler"],
+        translator=components["Translator"],
+        open_clip=components["OpenCLIP"],
+        kandinsky=components.get("Kandinsky 2.1", None),
+        kandinsky_2_2=components.get("Kandinsky 2.2", None),
+        safety_checker=components.get("Safety checker", None),
         aesthetics_scorer=aesthetics_scorer,
     )
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import traceback
+from typing import Any, Callable, Dict
+
+import diffusers
+
+from shared.constants import WORKER_VERSION
+from shared.helpers import print_tuple
+
+from .constants import SD_SNAPSHOT, SD_SNAPSHOT_DIR
+
+MANIFEST_FILE_NAME = "manifest.json"
+
+
+def get_fingerprint(name: str, definition: Dict[str, Any]) -> str:
+    """Changes whenever the worker version, the model definition or diffusers changes"""
+    data = {
+        "name": name,
+        "definition": definition,
+        "worker_version": WORKER_VERSION,
+        "diffusers_version": diffusers.__version__,
+    }
+    encoded = json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def get_safe_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+
+
+def get_snapshot_path(name: str, fingerprint: str) -> str:
+    return os.path.join(SD_SNAPSHOT_DIR, f"{get_safe_name(name)}-{fingerprint[:16]}")
+
+
+def read_manifest(path: str) -> Dict[str, Any] | None:
+    try:
+        with open(os.path.join(path, MANIFEST_FILE_NAME)) as f:
+            return json.load(f)
+    except Exception:
+        return None
+
+
+def is_snapshot_valid(path: str, fingerprint: str) -> bool:
+    manifest = read_manifest(path)
+    if manifest is None or manifest.get("fingerprint", None) != fingerprint:
+        return False
+    for file in manifest.get("files", []):
+        file_path = os.path.join(path, file["path"])
+        if not os.path.isfile(file_path) or os.path.getsize(file_path) != file["size"]:
+            return False
+    return True
+
+
+def remove_stale_snapshots(name: str, keep: str) -> None:
+    if not os.path.isdir(SD_SNAPSHOT_DIR):
+        return
+    prefix = f"{get_safe_name(name)}-"
+    for entry in os.listdir(SD_SNAPSHOT_DIR):
+        path = os.path.join(SD_SNAPSHOT_DIR, entry)
+        if entry.startswith(prefix) and path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            print_tuple("🧹 Removed stale snapshot", entry)
+
+
+def save_snapshot(pipe: Any, name: str, fingerprint: str, path: str) -> None:
+    """Saves each component as safetensors, then the manifest, into a temporary folder
+    that is renamed at the end so a crash never leaves a half written snapshot"""
+    s = time.time()
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    pipe.save_pretrained(tmp_path, safe_serialization=True)
+    files = []
+    for root, _, file_names in os.walk(tmp_path):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            files.append(
+                {
+                    "path": os.path.relpath(file_path, tmp_path),
+                    "size": os.path.getsize(file_path),
+                }
+            )
+    manifest = {
+        "name": name,
+        "fingerprint": fingerprint,
+        "worker_version": WORKER_VERSION,
+        "pipeline_class": pipe.__class__.__name__,
+        "created_at": time.time(),
+        "files": files,
+    }
+    with open(os.path.join(tmp_path, MANIFEST_FILE_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+    remove_stale_snapshots(name, keep=path)
+    e = time.time()
+    size = sum(file["size"] for file in files)
+    print_tuple(
+        f"📸 Saved snapshot of {name}",
+        f"{round(size / 1024**2)} MB - {round((e - s) * 1000)} ms",
+    )
+
+
+def load_with_snapshot(
+    name: str,
+    definition: Dict[str, Any],
+    cls: Any,
+    load: Callable[[], Any],
+    **kwargs,
+) -> Any:
+    """Loads a pipeline from its local snapshot, or with `load` and then snapshots it.
+
+    Snapshots are loaded with `local_files_only`, so no Hub metadata is resolved, and
+    safetensors weights are memory-mapped instead of read and copied. `kwargs` go to
+    `cls.from_pretrained`, components passed there (e.g. shared VAEs) aren't loaded.
+    """
+    if not SD_SNAPSHOT:
+        return load()
+
+    fingerprint = get_fingerprint(name, definition)
+    path = get_snapshot_path(name, fingerprint)
+    if is_snapshot_valid(path, fingerprint):
+        try:
+            s = time.time()
+            pipe = cls.from_pretrained(
+                path, local_files_only=True, use_safetensors=True, **kwargs
+            )
+            e = time.time()
+            print_tuple(
+                f"📸 Loaded {name} from snapshot", f"{round((e - s) * 1000)} ms"
+            )
+            return pipe
+        except Exception:
+            tb = traceback.format_exc()
+            print(f"❌ Failed to load snapshot of {name}, loading it again: {tb}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    pipe = load()
+    try:
+        save_snapshot(pipe, name, fingerprint, path)
+    except Exception:
+        tb = traceback.format_exc()
+        print(f"❌ Failed to save snapshot of {name}: {tb}")
+    return pipe
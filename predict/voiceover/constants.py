@@ -20,3 +20,6 @@ for language in bark_languages:
         models_speakers["bark"].append(f"v2/{language}_speaker_{i}")
 for i in range(0, 18):
     models_speakers["bark"].append(f"c_en_{i}")
+
+# Directory of the artifact manifest with the punkt tokenizer, used by WORKER_OFFLINE
+NLTK_DATA_ARTIFACT = "nltk_data"
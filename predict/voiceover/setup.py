@@ -1,11 +1,13 @@
 import time
-from shared.constants import WORKER_VERSION
+from shared.constants import WORKER_OFFLINE, WORKER_VERSION
+from shared.offline import resolve_artifact
 from bark.generation import (
     preload_models,
 )
 import nltk
 from typing import Any
 from denoiser import pretrained
+from .constants import NLTK_DATA_ARTIFACT
 
 
 class ModelsPack:
@@ -20,7 +22,11 @@ def setup() -> ModelsPack:
     start = time.time()
     print(f"⏳ Setup has started - Version: {WORKER_VERSION}")
 
-    nltk.download("punkt")
+    if WORKER_OFFLINE:
+        nltk.data.path.insert(0, resolve_artifact(NLTK_DATA_ARTIFACT))
+        nltk.data.find("tokenizers/punkt")
+    else:
+        nltk.download("punkt")
     preload_models()
 
     denoiser_model = pretrained.dns64().cuda()
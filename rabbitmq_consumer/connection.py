@@ -32,3 +32,12 @@ class RabbitMQConnection:
             except pika.exceptions.AMQPConnectionError:
                 logging.error(f"Connection to RabbitMQ failed. Retrying in {retry_interval} seconds.")
                 time.sleep(retry_interval)
+
+    def stop_consuming(self):
+        """
+        Stop consuming from any thread, the connection itself is only touched by its own thread.
+        """
+        try:
+            self.connection.add_callback_threadsafe(self.channel.stop_consuming)
+        except Exception as e:
+            logging.error(f"Failed to stop consuming: {e}")
@@ -0,0 +1,13 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Number of compatible image jobs that can share one pipeline call, 1 disables batching
+AMQP_BATCH_SIZE = max(1, int(os.environ.get("AMQP_BATCH_SIZE", "1")))
+# How long to wait for more messages before running an incomplete batch
+AMQP_BATCH_WINDOW = float(os.environ.get("AMQP_BATCH_WINDOW_MS", "250")) / 1000
+# Extra messages held by the image worker so their inputs are downloaded while the GPU is busy
+AMQP_PREFETCH_DEPTH = max(0, int(os.environ.get("AMQP_PREFETCH_DEPTH", "2")))
+# How many times a pending job can be passed over to run same-model jobs back-to-back, 0 keeps FIFO order
+AMQP_AFFINITY_MAX_BYPASS = max(0, int(os.environ.get("AMQP_AFFINITY_MAX_BYPASS", "3")))
@@ -0,0 +1,161 @@
+import logging
+import queue
+import time
+import traceback
+from threading import Condition, Event, Thread
+from typing import Callable, List
+
+from pika.adapters.blocking_connection import BlockingChannel
+from pika.spec import Basic, BasicProperties
+
+from rabbitmq_consumer.scheduler import AffinityScheduler
+
+
+class Delivery:
+    """A message received on the pika thread, waiting to be executed"""
+
+    def __init__(
+        self,
+        channel: BlockingChannel,
+        method: Basic.Deliver,
+        properties: BasicProperties,
+        body: bytes,
+    ):
+        self.channel = channel
+        self.connection = channel.connection
+        self.method = method
+        self.properties = properties
+        self.body = body
+        self.received_at = time.time()
+
+    @property
+    def is_stale(self) -> bool:
+        """The broker redelivers messages of closed channels, they shouldn't be executed here too"""
+        return not self.channel.is_open
+
+
+class Dispatcher:
+    """Decouples AMQP I/O from execution.
+
+    The pika thread only calls `on_message`, which queues the delivery and returns
+    immediately, so heartbeats keep flowing while the GPU is busy. A single execution
+    thread takes up to `batch_size` deliveries at a time and hands them to `execute`.
+    Acks are scheduled back on the pika thread with `add_callback_threadsafe`.
+    `on_receive` runs on the pika thread for every delivery and must not block.
+    """
+
+    def __init__(
+        self,
+        execute: Callable[[List[Delivery]], None],
+        shutdown_event: Event,
+        batch_size: int = 1,
+        batch_window: float = 0,
+        on_receive: Callable[[Delivery], None] | None = None,
+        on_discard: Callable[[Delivery], None] | None = None,
+        scheduler: AffinityScheduler | None = None,
+    ):
+        self.execute = execute
+        self.on_receive = on_receive
+        self.on_discard = on_discard
+        self.shutdown_event = shutdown_event
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        # FIFO unless a scheduler that reorders pending deliveries is given
+        self.pending = scheduler if scheduler is not None else AffinityScheduler()
+        self.in_progress = 0
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, name="dispatcher", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def on_message(
+        self,
+        channel: BlockingChannel,
+        method: Basic.Deliver,
+        properties: BasicProperties,
+        body: bytes,
+    ) -> None:
+        """pika `on_message_callback`, runs on the pika thread"""
+        delivery = Delivery(channel, method, properties, body)
+        if self.on_receive is not None:
+            try:
+                self.on_receive(delivery)
+            except Exception as e:
+                logging.error(f"on_receive failed: {e}")
+        self.pending.put(delivery)
+
+    def is_busy(self) -> bool:
+        with self.condition:
+            return self.in_progress > 0
+
+    def wait_until_idle(self, timeout: float) -> bool:
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_progress == 0, timeout)
+
+    def ack(self, delivery: Delivery) -> None:
+        """Schedule the ack on the thread that owns the connection"""
+
+        def basic_ack():
+            if delivery.is_stale:
+                logging.warning(
+                    f"Channel closed, can't ack message {delivery.properties.message_id}, it will be redelivered"
+                )
+                return
+            delivery.channel.basic_ack(delivery_tag=delivery.method.delivery_tag)
+
+        try:
+            delivery.connection.add_callback_threadsafe(basic_ack)
+        except Exception as e:
+            logging.error(
+                f"Failed to schedule ack for message {delivery.properties.message_id}: {e}"
+            )
+
+    def next_deliveries(self) -> List[Delivery]:
+        """Blocks for the first delivery, then collects followers that arrive within the batch window"""
+        deliveries: List[Delivery] = []
+        try:
+            deliveries.append(self.pending.get(timeout=1))
+        except queue.Empty:
+            return deliveries
+        deadline = time.time() + self.batch_window
+        while len(deliveries) < self.batch_size:
+            try:
+                deliveries.append(
+                    self.pending.get(timeout=max(0, deadline - time.time()))
+                )
+            except queue.Empty:
+                break
+        return deliveries
+
+    def run(self):
+        logging.info("Dispatcher started")
+        while not self.shutdown_event.is_set():
+            deliveries = []
+            for delivery in self.next_deliveries():
+                if not delivery.is_stale:
+                    deliveries.append(delivery)
+                elif self.on_discard is not None:
+                    try:
+                        self.on_discard(delivery)
+                    except Exception as e:
+                        tb = traceback.format_exc()
+                        logging.error(
+                            f"Failed to discard message {delivery.properties.message_id}: {tb}\n"
+                        )
+            if len(deliveries) == 0:
+                continue
+            with self.condition:
+                self.in_progress += len(deliveries)
+            try:
+                self.execute(deliveries)
+            except Exception as e:
+                tb = traceback.format_exc()
+                logging.error(f"Failed to execute deliveries: {tb}\n")
+            finally:
+                for delivery in deliveries:
+                    self.ack(delivery)
+                with self.condition:
+                    self.in_progress -= len(deliveries)
+                    self.condition.notify_all()
+        logging.info("Dispatcher stopped")
@@ -0,0 +1,103 @@
+import queue
+import time
+from threading import Condition
+from typing import Any, Callable, Hashable, List
+
+
+class ScheduledItem:
+    def __init__(self, item: Any):
+        self.item = item
+        self.affinity: Hashable = None
+        self.priority = 0
+        self.bypassed = 0
+
+
+class AffinityScheduler:
+    """A local queue that hands out items with the same affinity as the previous one first.
+
+    Used to run same-model jobs back-to-back. An item is never skipped more than
+    `max_bypass` times, and never in favor of an item with a lower priority, so the
+    reordering can't starve a job. Without `get_affinity` it behaves as a FIFO queue.
+    """
+
+    def __init__(
+        self,
+        get_affinity: Callable[[Any], Hashable] | None = None,
+        get_priority: Callable[[Any], int] | None = None,
+        max_bypass: int = 0,
+    ):
+        self.get_affinity = get_affinity
+        self.get_priority = get_priority
+        self.max_bypass = max_bypass
+        self.items: List[ScheduledItem] = []
+        self.last_affinity: Hashable = None
+        self.condition = Condition()
+
+    def put(self, item: Any) -> None:
+        with self.condition:
+            self.items.append(ScheduledItem(item))
+            self.condition.notify()
+
+    def qsize(self) -> int:
+        with self.condition:
+            return len(self.items)
+
+    def resolve(self, scheduled: ScheduledItem) -> None:
+        """Affinity and priority are computed lazily, off the thread that puts items"""
+        if scheduled.affinity is not None or self.get_affinity is None:
+            return
+        try:
+            scheduled.affinity = self.get_affinity(scheduled.item)
+            if self.get_priority is not None:
+                scheduled.priority = self.get_priority(scheduled.item) or 0
+        except Exception:
+            scheduled.affinity = None
+
+    def select(self, commit: bool = True) -> int:
+        """Index of the item to hand out next, `commit` counts the bypasses it causes"""
+        oldest = self.items[0]
+        if (
+            self.get_affinity is None
+            or self.last_affinity is None
+            or oldest.bypassed >= self.max_bypass
+        ):
+            return 0
+        for i, scheduled in enumerate(self.items):
+            self.resolve(scheduled)
+            if scheduled.affinity != self.last_affinity:
+                continue
+            skipped = self.items[:i]
+            if any(s.bypassed >= self.max_bypass for s in skipped):
+                return 0
+            if any(s.priority > scheduled.priority for s in skipped):
+                return 0
+            if commit:
+                for s in skipped:
+                    s.bypassed += 1
+            return i
+        return 0
+
+    def peek_affinity(self) -> Hashable:
+        """Affinity of the item `get` would hand out next, None if there is none"""
+        with self.condition:
+            if len(self.items) == 0:
+                return None
+            scheduled = self.items[self.select(commit=False)]
+            self.resolve(scheduled)
+            return scheduled.affinity
+
+    def get(self, timeout: float | None = None) -> Any:
+        """Same contract as queue.Queue.get, raises queue.Empty on timeout"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while len(self.items) == 0:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.condition.wait(remaining)
+            index = self.select()
+            scheduled = self.items.pop(index)
+            self.resolve(scheduled)
+            if scheduled.affinity is not None:
+                self.last_affinity = scheduled.affinity
+            return scheduled.item
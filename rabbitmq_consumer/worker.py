@@ -1,3 +1,5 @@
+from __future__ import annotations
+
 import datetime
 import json
 import queue
@@ -5,7 +7,7 @@ import hashlib
 import os
 import time
 import traceback
-from typing import Any, Dict, Iterable, Tuple, Callable
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, Tuple, Callable
 from threading import Event
 import logging
 
@@ -16,22 +18,28 @@ from pika.exceptions import ConnectionClosedByBroker, AMQPConnectionError, AMQPC
 
 from rabbitmq_consumer.events import Status, Event
 from rabbitmq_consumer.connection import RabbitMQConnection
-from predict.image.predict import (
-    PredictInput as PredictInputForImage,
-    predict as predict_for_image,
-    PredictResult as PredictResultForImage,
-)
-from predict.voiceover.predict import (
-    PredictInput as PredictInputForVoiceover,
-    predict as predict_for_voiceover,
-    PredictResult as PredictResultForVoiceover,
+from rabbitmq_consumer.dispatcher import Delivery, Dispatcher
+from rabbitmq_consumer.constants import (
+    AMQP_BATCH_SIZE,
+    AMQP_BATCH_WINDOW,
+    AMQP_PREFETCH_DEPTH,
+    AMQP_AFFINITY_MAX_BYPASS,
 )
+from rabbitmq_consumer.scheduler import AffinityScheduler
+from predict.image.classes import PredictResult as PredictResultForImage
+from predict.voiceover.classes import PredictResult as PredictResultForVoiceover
 from shared.helpers import format_datetime
-from predict.image.setup import ModelsPack as ModelsPackForImage
-from predict.voiceover.setup import ModelsPack as ModelsPackForVoiceover
-from shared.webhook import post_webhook
+from shared.webhook import webhook_dispatcher
 from tabulate import tabulate
 
+# The image and voiceover stacks are imported where they are used,
+# so each worker type only imports its own models
+if TYPE_CHECKING:
+    from predict.image.predict import PredictInput as PredictInputForImage
+    from predict.image.prefetch import InputPrefetcher, PrefetchedInputs
+    from predict.image.setup import ModelsPack as ModelsPackForImage
+    from predict.voiceover.setup import ModelsPack as ModelsPackForVoiceover
+
 
 def generate_queue_name_from_capabilities(
     exchange_name: str, capabilities: list[str]
@@ -54,9 +62,6 @@ def generate_queue_name_from_capabilities(
     return queue_name
 
 
-callback_in_progress = False
-
-
 # def should_process(redisConn: redis.Redis, message_id):
 #     """See if a message is being processed by another worker"""
 #     # Check and set the message_id in Redis atomically
@@ -65,54 +70,71 @@ callback_in_progress = False
 #     return bool(result)
 
 
+def get_events_filter(message: Dict[str, Any]) -> set:
+    if "webhook_events_filter" in message:
+        valid_events = {ev.value for ev in Event}
+
+        for event in message["webhook_events_filter"]:
+            if event not in valid_events:
+                raise ValueError(
+                    f"Invalid webhook event {event}! Must be one of {valid_events}"
+                )
+
+        # We always send the completed event
+        return set(message["webhook_events_filter"]) | {Event.COMPLETED}
+    return Event.default_events()
+
+
+def handle_response(
+    worker_type: str,
+    response_event: Event,
+    response: Dict[str, Any],
+    events_filter: set,
+    upload_queue: queue.Queue[Dict[str, Any]],
+) -> None:
+    """Send a prediction response to the upload queue or to the webhook"""
+    if "upload_output" in response and isinstance(
+        response["upload_output"],
+        PredictResultForVoiceover if worker_type == "voiceover" else PredictResultForImage,
+    ):
+        logging.info(f"-- Upload: Putting to queue")
+        upload_queue.put(response)
+        logging.info(f"-- Upload: Put to queue")
+    elif response_event in events_filter:
+        # Posted in the background, in order with the job's later events
+        webhook_dispatcher.submit(response["webhook_url"], response)
+
+
+def log_message(queue_name: str, properties: BasicProperties) -> None:
+    log_table = [
+        ["Queue Name", queue_name],
+        ["Message ID", properties.message_id],
+        ["Priority", properties.priority],
+    ]
+    logging.info("\n" + tabulate(log_table, tablefmt="double_grid"))
+
+
 def create_amqp_callback(
     queue_name: str,
     worker_type: str,
     upload_queue: queue.Queue[Dict[str, Any]],
     models_pack: ModelsPackForImage | ModelsPackForVoiceover,
+    prefetcher: InputPrefetcher | None = None,
 ):
     """Create the amqp callback to handle rabbitmq messages"""
 
-    def amqp_callback(
-        channel: BlockingChannel,
-        method: Basic.Deliver,
-        properties: BasicProperties,
-        body: bytes,
-    ) -> None:
+    def amqp_callback(delivery: Delivery) -> None:
         # if not should_process(redisConn, properties.message_id):
         #     logging.info(f"Message {properties.message_id} is already being processed")
         #     channel.basic_ack(delivery_tag=method.delivery_tag)
         #     return
 
-        global callback_in_progress
         try:
-            callback_in_progress = True
-            message = json.loads(body.decode("utf-8"))
+            message = json.loads(delivery.body.decode("utf-8"))
 
-            webhook_url = message["webhook_url"]
+            log_message(queue_name, delivery.properties)
 
-            log_table = [
-                ["Queue Name", queue_name],
-                ["Message ID", properties.message_id],
-                ["Priority", properties.priority],
-            ]
-            logging.info("\n" + tabulate(log_table, tablefmt="double_grid"))
-
-            if "webhook_events_filter" in message:
-                valid_events = {ev.value for ev in Event}
-
-                for event in message["webhook_events_filter"]:
-                    if event not in valid_events:
-                        raise ValueError(
-                            f"Invalid webhook event {event}! Must be one of {valid_events}"
-                        )
-
-                # We always send the completed event
-                events_filter = set(message["webhook_events_filter"]) | {
-                    Event.COMPLETED
-                }
-            else:
-                events_filter = Event.default_events()
+            events_filter = get_events_filter(message)
 
             run_prediction = None
             args = {}
@@ -122,30 +144,85 @@ def create_amqp_callback(
                 run_prediction = run_prediction_for_image
 
             args["models_pack"] = models_pack
+            if prefetcher is not None:
+                args["prefetched"] = prefetcher.take(delivery)
 
             for response_event, response in run_prediction(message, **args):
-                if "upload_output" in response and isinstance(
-                    response["upload_output"],
-                    PredictResultForVoiceover
-                    if worker_type == "voiceover"
-                    else PredictResultForImage,
-                ):
-                    logging.info(f"-- Upload: Putting to queue")
-                    upload_queue.put(response)
-                    logging.info(f"-- Upload: Put to queue")
-                elif response_event in events_filter:
-                    status_code = post_webhook(webhook_url, response)
-                    logging.info(f"-- Webhook: {status_code}")
+                handle_response(
+                    worker_type, response_event, response, events_filter, upload_queue
+                )
         except Exception as e:
             tb = traceback.format_exc()
             logging.error(f"Failed to handle message: {tb}\n")
-        finally:
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-            callback_in_progress = False
+            if prefetcher is not None:
+                prefetcher.discard(delivery)
 
     return amqp_callback
 
 
+def create_amqp_batch_callback(
+    queue_name: str,
+    upload_queue: queue.Queue[Dict[str, Any]],
+    models_pack: ModelsPackForImage,
+    prefetcher: InputPrefetcher | None = None,
+):
+    """Create the amqp callback to handle a batch of rabbitmq messages for the image worker"""
+
+    def amqp_batch_callback(deliveries: List[Delivery]) -> None:
+        try:
+            messages = []
+            events_filters = []
+            prefetched = []
+            for delivery in deliveries:
+                try:
+                    log_message(queue_name, delivery.properties)
+                    message = json.loads(delivery.body.decode("utf-8"))
+                    events_filter = get_events_filter(message)
+                    delivery_prefetched = (
+                        prefetcher.take(delivery) if prefetcher is not None else None
+                    )
+                    # Appended together, the lists are indexed by the same message
+                    events_filters.append(events_filter)
+                    messages.append(message)
+                    prefetched.append(delivery_prefetched)
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    logging.error(f"Failed to handle message: {tb}\n")
+                    if prefetcher is not None:
+                        prefetcher.discard(delivery)
+
+            for index, response_event, response in run_prediction_for_image_batch(
+                messages, models_pack, prefetched
+            ):
+                try:
+                    handle_response(
+                        "image",
+                        response_event,
+                        response,
+                        events_filters[index],
+                        upload_queue,
+                    )
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    logging.error(f"Failed to handle response: {tb}\n")
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error(f"Failed to handle batch: {tb}\n")
+
+    return amqp_batch_callback
+
+
+def get_delivery_model(delivery: Delivery) -> str:
+    from models.stable_diffusion.constants import SD_MODEL_DEFAULT_KEY
+
+    message = json.loads(delivery.body.decode("utf-8"))
+    return message.get("input", {}).get("model", SD_MODEL_DEFAULT_KEY)
+
+
+def get_delivery_priority(delivery: Delivery) -> int:
+    return delivery.properties.priority or 0
+
+
 def start_amqp_queue_worker(
     worker_type: str,
     connection: RabbitMQConnection,
@@ -174,16 +251,58 @@ def start_amqp_queue_worker(
     #         exchange=exchange_name, queue=queue_name, routing_key=capability
     #     )
 
-    # Create callback
-    msg_callback = create_amqp_callback(
-        queue_name, worker_type, upload_queue, models_pack
+    # Create callback, it runs on the dispatcher thread, never on the pika thread
+    batch_size = AMQP_BATCH_SIZE if worker_type == "image" else 1
+    prefetch_count = batch_size
+    prefetcher = None
+    if worker_type == "image":
+        from models.stable_diffusion.residency import residency_manager
+        from predict.image.prefetch import InputPrefetcher
+    if worker_type == "image" and AMQP_PREFETCH_DEPTH > 0:
+        # Inputs of the next jobs are downloaded while the current one runs
+        prefetch_count += AMQP_PREFETCH_DEPTH
+        prefetcher = InputPrefetcher()
+    if batch_size > 1:
+        logging.info(f"Batching up to {batch_size} compatible messages\n")
+        execute = create_amqp_batch_callback(
+            queue_name, upload_queue, models_pack, prefetcher
+        )
+    else:
+        msg_callback = create_amqp_callback(
+            queue_name, worker_type, upload_queue, models_pack, prefetcher
+        )
+
+        def execute(deliveries: List[Delivery]) -> None:
+            for delivery in deliveries:
+                msg_callback(delivery)
+
+    scheduler = None
+    if worker_type == "image":
+        # Run same-model jobs of the prefetch window back-to-back, FIFO when max bypass is 0
+        scheduler = AffinityScheduler(
+            get_affinity=get_delivery_model,
+            get_priority=get_delivery_priority,
+            max_bypass=AMQP_AFFINITY_MAX_BYPASS,
+        )
+        # Upload the model of the next job while the current one runs
+        residency_manager.predict_next = scheduler.peek_affinity
+    dispatcher = Dispatcher(
+        execute=execute,
+        shutdown_event=shutdown_event,
+        batch_size=batch_size,
+        batch_window=AMQP_BATCH_WINDOW if batch_size > 1 else 0,
+        on_receive=(lambda d: prefetcher.submit(d, d.body)) if prefetcher else None,
+        on_discard=prefetcher.discard if prefetcher else None,
+        scheduler=scheduler,
     )
+    dispatcher.start()
 
-    global callback_in_progress
-    while not shutdown_event.is_set() or callback_in_progress:
+    while not shutdown_event.is_set():
         try:
-            connection.channel.basic_qos(prefetch_count=1)
-            connection.channel.basic_consume(queue=queue_name, on_message_callback=msg_callback)
+            connection.channel.basic_qos(prefetch_count=prefetch_count)
+            connection.channel.basic_consume(
+                queue=queue_name, on_message_callback=dispatcher.on_message
+            )
             connection.channel.start_consuming()
         except ConnectionClosedByBroker as err:
             logging.error(f"ConnectionClosedByBroker {err}")
@@ -194,18 +313,22 @@ def start_amqp_queue_worker(
             break
         except AMQPConnectionError as err:
             logging.error(f"AMQPConnectionError {err}")
+            if shutdown_event.is_set():
+                break
             connection.reconnect()
             continue
-    if callback_in_progress:
-        logging.info(f"Waiting for callback to finish")
-        # Give it a max of 30s to finish
-        for i in range(60):
-            if not callback_in_progress:
-                break
-            # Sleep for 500ms
-            time.sleep(0.5)
-            pass
+    if dispatcher.is_busy():
+        logging.info(f"Waiting for dispatcher to finish")
+        # Give it a max of 30s to finish, keep serving heartbeats and acks meanwhile
+        deadline = time.time() + 30
+        while dispatcher.is_busy() and time.time() < deadline:
+            try:
+                connection.connection.process_data_events(time_limit=0.5)
+            except Exception:
+                dispatcher.wait_until_idle(timeout=0.5)
     try:
+        # Flush the acks scheduled by the dispatcher
+        connection.connection.process_data_events(time_limit=0)
         logging.info(f"Stopping rabbitmq queue channel")
         connection.channel.close()
         logging.info(f"Closing rabbitmq connection")
@@ -222,8 +345,14 @@ def start_amqp_queue_worker(
 def run_prediction_for_image(
     message: Dict[str, Any],
     models_pack: ModelsPackForImage,
+    prefetched: PrefetchedInputs | None = None,
 ) -> Iterable[Tuple[Event, Dict[str, Any]]]:
     """Runs the prediction and yields events and responses."""
+    from predict.image.batch import batch_timings, get_batch_key
+    from predict.image.predict import (
+        PredictInput as PredictInputForImage,
+        predict as predict_for_image,
+    )
 
     # use the request message as the basis of our response so
     # that we echo back any additional fields sent to us
@@ -251,25 +380,19 @@ def run_prediction_for_image(
     yield (Event.START, response)
 
     try:
+        input = PredictInputForImage(**input_obj)
         predictResult = predict_for_image(
-            input=PredictInputForImage(**input_obj),
+            input=input,
             models_pack=models_pack,
+            prefetched=prefetched,
         )
-
-        if (predictResult.nsfw_count == 0) and (len(predictResult.outputs) == 0):
-            raise Exception("Missing outputs and nsfw_count")
-
-        response["upload_prefix"] = input_obj.get("upload_path_prefix", "")
-        response["upload_output"] = predictResult
-        response["nsfw_count"] = predictResult.nsfw_count
-
         completed_at = datetime.datetime.now()
-        response["completed_at"] = format_datetime(completed_at)
-
-        response["status"] = Status.SUCCEEDED
-        response["metrics"] = {
-            "predict_time": (completed_at - started_at).total_seconds()
-        }
+        set_image_prediction_result(response, predictResult, completed_at)
+        predict_time = (completed_at - started_at).total_seconds()
+        response["metrics"] = {"predict_time": predict_time}
+        batch_timings.record_single(
+            get_batch_key(input), predict_time, input.num_outputs
+        )
     except Exception as e:
         tb = traceback.format_exc()
         logging.error(f"Failed to run prediction: {tb}\n")
@@ -281,11 +404,125 @@ def run_prediction_for_image(
         yield (Event.COMPLETED, response)
 
 
+def set_image_prediction_result(
+    response: Dict[str, Any],
+    predictResult: PredictResultForImage,
+    completed_at: datetime.datetime,
+) -> None:
+    if (predictResult.nsfw_count == 0) and (len(predictResult.outputs) == 0):
+        raise Exception("Missing outputs and nsfw_count")
+
+    response["upload_prefix"] = response["input"].get("upload_path_prefix", "")
+    response["upload_output"] = predictResult
+    response["nsfw_count"] = predictResult.nsfw_count
+    response["completed_at"] = format_datetime(completed_at)
+    response["status"] = Status.SUCCEEDED
+
+
+def run_prediction_for_image_batch(
+    messages: List[Dict[str, Any]],
+    models_pack: ModelsPackForImage,
+    prefetched: List[PrefetchedInputs | None] | None = None,
+) -> Iterable[Tuple[int, Event, Dict[str, Any]]]:
+    """Runs the predictions of several messages, sharing pipeline calls between compatible ones.
+    Yields the message index, the event and the response."""
+    from predict.image.batch import batch_timings, get_batch_key, group_by_batch_key
+    from predict.image.predict import (
+        PredictInput as PredictInputForImage,
+        predict as predict_for_image,
+        predict_batch as predict_batch_for_image,
+    )
+
+    inputs: Dict[int, PredictInputForImage] = {}
+    for index, message in enumerate(messages):
+        # use the request message as the basis of our response so
+        # that we echo back any additional fields sent to us
+        response = message
+        response["status"] = Status.PROCESSING
+        response["outputs"] = None
+        response["logs"] = ""
+        try:
+            inputs[index] = PredictInputForImage(**response["input"])
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error(f"Failed to start prediction: {tb}\n")
+            response["status"] = Status.FAILED
+            response["error"] = str(e)
+            yield (index, Event.COMPLETED, response)
+            continue
+        response["started_at"] = format_datetime(datetime.datetime.now())
+        yield (index, Event.START, response)
+
+    indexes = list(inputs.keys())
+    groups = group_by_batch_key([inputs[i] for i in indexes], AMQP_BATCH_SIZE)
+    for group in groups:
+        group_indexes = [indexes[i] for i in group]
+        group_inputs = [inputs[i] for i in group_indexes]
+        started_at = datetime.datetime.now()
+        try:
+            group_prefetched = [
+                prefetched[i] if prefetched is not None else None
+                for i in group_indexes
+            ]
+            if len(group_inputs) == 1:
+                predictResults = [
+                    predict_for_image(
+                        input=group_inputs[0],
+                        models_pack=models_pack,
+                        prefetched=group_prefetched[0],
+                    )
+                ]
+            else:
+                predictResults = predict_batch_for_image(
+                    inputs=group_inputs,
+                    models_pack=models_pack,
+                    prefetched=group_prefetched,
+                )
+            error = None
+        except Exception as e:
+            tb = traceback.format_exc()
+            logging.error(f"Failed to run prediction: {tb}\n")
+            predictResults = [None] * len(group_inputs)
+            error = e
+        completed_at = datetime.datetime.now()
+        predict_time = (completed_at - started_at).total_seconds()
+
+        key = get_batch_key(group_inputs[0])
+        num_images = sum(input.num_outputs for input in group_inputs)
+        if len(group_inputs) == 1 and error is None:
+            batch_timings.record_single(key, predict_time, num_images)
+        speedup = None
+        if len(group_inputs) > 1 and error is None:
+            speedup = batch_timings.estimate_speedup(key, predict_time, num_images)
+
+        for index, predictResult in zip(group_indexes, predictResults):
+            response = messages[index]
+            try:
+                if error is not None:
+                    raise error
+                set_image_prediction_result(response, predictResult, completed_at)
+                response["metrics"] = {
+                    "predict_time": predict_time,
+                    "batch_size": len(group_inputs),
+                }
+                if speedup is not None:
+                    response["metrics"]["batch_speedup"] = speedup
+            except Exception as e:
+                response["completed_at"] = format_datetime(completed_at)
+                response["status"] = Status.FAILED
+                response["error"] = str(e)
+            yield (index, Event.COMPLETED, response)
+
+
 def run_prediction_for_voiceover(
     message: Dict[str, Any],
     models_pack: ModelsPackForVoiceover,
 ) -> Iterable[Tuple[Event, Dict[str, Any]]]:
     """Runs the prediction and yields events and responses."""
+    from predict.voiceover.predict import (
+        PredictInput as PredictInputForVoiceover,
+        predict as predict_for_voiceover,
+    )
 
     # use the request message as the basis of our response so
     # that we echo back any additional fields sent to us
@@ -22,7 +22,7 @@ from predict.voiceover.predict import (
 from shared.helpers import format_datetime
 from predict.image.setup import ModelsPack as ModelsPackForImage
 from predict.voiceover.setup import ModelsPack as ModelsPackForVoiceover
-from shared.webhook import post_webhook
+from shared.webhook import webhook_dispatcher
 
 
 def start_redis_queue_worker(
@@ -134,8 +134,7 @@ def start_redis_queue_worker(
                     upload_queue.put(response)
                     print(f"-- Upload: Put to queue")
                 elif response_event in events_filter:
-                    status_code = post_webhook(webhook_url, response)
-                    print(f"-- Webhook: {status_code}")
+                    webhook_dispatcher.submit(webhook_url, response)
 
             redis.xack(input_queue, input_queue, message_id)
             redis.xdel(input_queue, message_id)
@@ -0,0 +1,38 @@
+"""Writes the manifest of an artifact directory for WORKER_OFFLINE.
+
+Every top level file of the directory is listed under its name with its checksum,
+directories (nltk_data, torch, ...) are listed for existence checks.
+Directories outside of it, such as the HuggingFace caches, can be added as name=path.
+
+    python scripts/artifact_manifest.py /app/data/artifacts sd=/app/data/diffusers-cache
+"""
+
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.offline import ARTIFACT_MANIFEST, get_file_sha256
+
+
+def main(artifact_dir: str, extra: list[str]):
+    artifacts = {}
+    for name in sorted(os.listdir(artifact_dir)):
+        if name == ARTIFACT_MANIFEST:
+            continue
+        path = os.path.join(artifact_dir, name)
+        artifacts[name] = {"path": name}
+        if os.path.isfile(path):
+            artifacts[name]["sha256"] = get_file_sha256(path)
+    for item in extra:
+        name, path = item.split("=", 1)
+        artifacts[name] = {"path": os.path.abspath(path)}
+
+    with open(os.path.join(artifact_dir, ARTIFACT_MANIFEST), "w") as f:
+        json.dump({"artifacts": artifacts}, f, indent=2)
+    print(f"✅ Wrote {len(artifacts)} artifacts to the manifest of {artifact_dir}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
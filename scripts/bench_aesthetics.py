@@ -0,0 +1,96 @@
+"""CPU micro-benchmark of the aesthetics heads.
+
+Compares scoring one image at a time with the rating and artifact models separately,
+as generate_aesthetic_scores used to, against the batched FusedAestheticScorers.
+
+    python scripts/bench_aesthetics.py
+"""
+
+import os
+import sys
+import time
+
+import torch
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.aesthetics_scorer.constants import (
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG,
+    AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG,
+)
+from models.aesthetics_scorer.model import (
+    AestheticScorer,
+    FusedAestheticScorers,
+    preprocess,
+)
+
+IMAGE_COUNTS = [1, 4, 10]
+RUNS = 50
+
+
+def score_separately(embeddings, rating_model, artifact_model):
+    scores = []
+    for embedding in embeddings:
+        embedding = embedding.unsqueeze(0)
+        scores.append(
+            (rating_model(embedding).cpu().item(), artifact_model(embedding).cpu().item())
+        )
+    return scores
+
+
+def score_fused(embeddings, fused_model):
+    return fused_model(embeddings).cpu().tolist()
+
+
+def time_ms(fn) -> float:
+    fn()
+    s = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+    return (time.perf_counter() - s) / RUNS * 1000
+
+
+def main():
+    torch.manual_seed(0)
+    rating_model = AestheticScorer(
+        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG
+    ).eval()
+    artifact_model = AestheticScorer(
+        config=AESTHETICS_SCORER_OPENCLIP_VIT_H_14_ARTIFACT_CONFIG
+    ).eval()
+    fused_model = FusedAestheticScorers([rating_model, artifact_model]).eval()
+    input_size = AESTHETICS_SCORER_OPENCLIP_VIT_H_14_RATING_CONFIG["input_size"]
+
+    table = []
+    with torch.no_grad():
+        for count in IMAGE_COUNTS:
+            embeddings = preprocess(torch.randn(count, input_size))
+            separate = torch.tensor(
+                score_separately(embeddings, rating_model, artifact_model)
+            )
+            fused = torch.tensor(score_fused(embeddings, fused_model))
+            separate_ms = time_ms(
+                lambda: score_separately(embeddings, rating_model, artifact_model)
+            )
+            fused_ms = time_ms(lambda: score_fused(embeddings, fused_model))
+            table.append(
+                [
+                    count,
+                    f"{separate_ms:.2f}",
+                    f"{fused_ms:.2f}",
+                    f"{separate_ms / fused_ms:.1f}x",
+                    f"{(separate - fused).abs().max().item():.1e}",
+                ]
+            )
+    print(
+        tabulate(
+            table,
+            headers=["Images", "Separate ms", "Fused ms", "Speedup", "Max diff"],
+            tablefmt="double_grid",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Benchmark of the webhook payload of an image job.
+
+Compares the former payload (embeddings as float lists, serialized with json.dumps
+as requests' json= did) against dumps_json with each of the EMBEDDING_ENCODINGS,
+for jobs of 1, 4 and 10 images with 1024-dimensional embeddings.
+
+    python scripts/bench_embeddings.py
+"""
+
+import json
+import os
+import sys
+import time
+
+import torch
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared.serialize import EMBEDDING_ENCODINGS, dumps_json, encode_embeddings
+
+EMBEDDING_SIZE = 1024
+IMAGE_COUNTS = [1, 4, 10]
+RUNS = 50
+
+
+def make_payload(embeddings: torch.Tensor, prompt_embedding: torch.Tensor, encoding: str):
+    image_embeds = encode_embeddings(embeddings, encoding)
+    return {
+        "status": "succeeded",
+        "webhook_url": "http://localhost/webhook",
+        "output": {
+            "prompt_embed": encode_embeddings(prompt_embedding, encoding)[0],
+            "images": [
+                {
+                    "image": f"s3://bucket/{i}.jpeg",
+                    "image_embed": image_embed,
+                    "aesthetic_rating_score": 5.5,
+                    "aesthetic_artifact_score": 1.5,
+                }
+                for i, image_embed in enumerate(image_embeds)
+            ],
+        },
+    }
+
+
+def time_ms(fn) -> float:
+    fn()
+    s = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+    return (time.perf_counter() - s) / RUNS * 1000
+
+
+def main():
+    torch.manual_seed(0)
+    prompt_embedding = torch.randn(1, EMBEDDING_SIZE)
+    table = []
+    for count in IMAGE_COUNTS:
+        embeddings = torch.randn(count, EMBEDDING_SIZE)
+        former = lambda: json.dumps(
+            make_payload(embeddings, prompt_embedding, "float")
+        ).encode("utf-8")
+        former_ms = time_ms(former)
+        former_size = len(former())
+        for encoding in EMBEDDING_ENCODINGS:
+            current = lambda: dumps_json(
+                make_payload(embeddings, prompt_embedding, encoding)
+            )
+            current_ms = time_ms(current)
+            current_size = len(current())
+            table.append(
+                [
+                    count,
+                    encoding,
+                    f"{former_size / 1024:.1f}",
+                    f"{current_size / 1024:.1f}",
+                    f"{former_ms:.2f}",
+                    f"{current_ms:.2f}",
+                    f"{former_ms / current_ms:.1f}x",
+                ]
+            )
+    print(
+        tabulate(
+            table,
+            headers=[
+                "Images",
+                "Encoding",
+                "Former KB",
+                "Current KB",
+                "Former ms",
+                "Current ms",
+                "Speedup",
+            ],
+            tablefmt="double_grid",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Benchmark of the image encoding stage.
+
+Compares the former upload path (PIL image, convert("RGB") for JPEG, new BytesIO,
+getvalue() copy) against encode_image from uint8 HWC arrays into a pooled buffer,
+at generated sizes of SIZE_LIST from 512 to 1024px and their 4x upscales.
+
+    python scripts/bench_encode.py
+"""
+
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from predict.image.constants import SIZE_LIST
+from upload.encode import encode_buffers, encode_image
+
+SIZES = [size for size in SIZE_LIST if 512 <= size <= 1024 and size % 256 == 0]
+UPSCALE_FACTOR = 4
+FORMATS = ["jpeg", "webp", "png"]
+QUALITY = 90
+RUNS = 3
+
+
+def make_image(size: int) -> np.ndarray:
+    """Smooth gradients with some noise, closer to generated images than pure noise"""
+    rng = np.random.default_rng(size)
+    x = np.linspace(0, 255, size, dtype=np.float32)
+    gradient = (x[None, :, None] + x[:, None, None]) / 2
+    channels = np.concatenate(
+        [gradient, gradient[::-1], gradient.transpose(1, 0, 2)], axis=2
+    )
+    noise = rng.normal(0, 8, (size, size, 3)).astype(np.float32)
+    return np.ascontiguousarray(np.clip(channels + noise, 0, 255).astype(np.uint8))
+
+
+def encode_former(image: np.ndarray, extension: str, upscaled: bool) -> int:
+    pil_image = Image.fromarray(image)
+    if upscaled:
+        # SwinIR outputs used to be RGBA PIL images
+        pil_image = pil_image.convert("RGBA")
+    if extension == "jpeg":
+        pil_image = pil_image.convert("RGB")
+    img_bytes = BytesIO()
+    pil_image.save(img_bytes, format=extension.upper(), quality=QUALITY)
+    return len(img_bytes.getvalue())
+
+
+def encode_current(image: np.ndarray, extension: str) -> int:
+    with encode_buffers.buffer() as buffer:
+        return encode_image(image, extension, QUALITY, buffer)
+
+
+def time_ms(fn) -> float:
+    fn()
+    s = time.perf_counter()
+    for _ in range(RUNS):
+        fn()
+    return (time.perf_counter() - s) / RUNS * 1000
+
+
+def main():
+    table = []
+    for size in SIZES + [size * UPSCALE_FACTOR for size in SIZES]:
+        image = make_image(size)
+        upscaled = size > max(SIZES)
+        for extension in FORMATS:
+            former_ms = time_ms(lambda: encode_former(image, extension, upscaled))
+            current_ms = time_ms(lambda: encode_current(image, extension))
+            table.append(
+                [
+                    f"{size}x{size}",
+                    extension,
+                    f"{former_ms:.1f}",
+                    f"{current_ms:.1f}",
+                    f"{former_ms / current_ms:.2f}x",
+                    f"{encode_current(image, extension) / 1024:.0f}",
+                ]
+            )
+    print(
+        tabulate(
+            table,
+            headers=["Size", "Format", "Former ms", "Current ms", "Speedup", "KB"],
+            tablefmt="double_grid",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
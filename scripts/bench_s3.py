@@ -0,0 +1,114 @@
+"""Upload throughput benchmark against a local S3 stand-in.
+
+Compares the former upload path (one boto3 resource with the default pool of 10
+connections, s3.Bucket(...).put_object from every upload thread) against the
+shared "upload" client of shared/s3.py, with UPLOAD_MAX_WORKERS threads.
+
+Starts a moto server when moto[server] is installed, otherwise uses the S3
+endpoint of BENCH_S3_ENDPOINT_URL, a local MinIO for instance.
+
+    python scripts/bench_s3.py
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BUCKET = "bench-upload"
+OBJECT_SIZES_KB = [64, 512, 2048]
+OBJECT_COUNT = 200
+
+
+def start_endpoint() -> str:
+    endpoint_url = os.environ.get("BENCH_S3_ENDPOINT_URL")
+    if endpoint_url:
+        return endpoint_url
+    try:
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        sys.exit("Install moto[server] or set BENCH_S3_ENDPOINT_URL to a local S3 endpoint")
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return f"http://{host}:{port}"
+
+
+def upload_all(put, body: bytes, max_workers: int) -> float:
+    """Returns the objects uploaded per second"""
+    s = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for future in [
+            executor.submit(put, f"bench/{i}", body) for i in range(OBJECT_COUNT)
+        ]:
+            future.result()
+    return OBJECT_COUNT / (time.perf_counter() - s)
+
+
+def main():
+    os.environ["S3_ENDPOINT_URL"] = start_endpoint()
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+    os.environ.setdefault("S3_REGION", "us-east-1")
+
+    # Read the endpoint from the environment set above
+    import boto3
+    from botocore.config import Config
+
+    from shared.s3 import get_s3_client
+    from upload.constants import UPLOAD_MAX_WORKERS
+
+    client = get_s3_client("upload")
+    try:
+        client.create_bucket(Bucket=BUCKET)
+    except client.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    resource = boto3.resource(
+        "s3",
+        region_name=os.environ["S3_REGION"],
+        endpoint_url=os.environ["S3_ENDPOINT_URL"],
+        config=Config(
+            retries={"max_attempts": 3, "mode": "standard"},
+            connect_timeout=5,
+            read_timeout=5,
+        ),
+    )
+
+    def put_former(key: str, body: bytes):
+        resource.Bucket(BUCKET).put_object(Body=body, Key=key)
+
+    def put_current(key: str, body: bytes):
+        client.put_object(Bucket=BUCKET, Body=body, Key=key)
+
+    table = []
+    for size_kb in OBJECT_SIZES_KB:
+        body = os.urandom(size_kb * 1024)
+        # Warm up the connection pools
+        upload_all(put_former, body, UPLOAD_MAX_WORKERS)
+        upload_all(put_current, body, UPLOAD_MAX_WORKERS)
+        former = upload_all(put_former, body, UPLOAD_MAX_WORKERS)
+        current = upload_all(put_current, body, UPLOAD_MAX_WORKERS)
+        table.append(
+            [
+                size_kb,
+                UPLOAD_MAX_WORKERS,
+                f"{former:.0f}",
+                f"{current:.0f}",
+                f"{current / former:.2f}x",
+            ]
+        )
+    print(
+        tabulate(
+            table,
+            headers=["KB", "Threads", "Former obj/s", "Current obj/s", "Speedup"],
+            tablefmt="double_grid",
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Check of the AMQP batching path on CPU, with a stub pipeline in place of SD.
+
+Groups job inputs with group_by_batch_key, then runs a group through
+generate_batch. The stub flags prompts containing "nsfw" the way the SD safety
+checker does. The check confirms there is a single pipeline call and that each
+job gets back its own outputs and NSFW count.
+
+    python scripts/check_batch_stub.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import torch
+from diffusers import DDIMScheduler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models.stable_diffusion.constants import (
+    SD_MODEL_DEFAULT_KEY,
+    SD_SCHEDULER_DEFAULT,
+)
+from models.stable_diffusion.generate import generate_batch
+from predict.image.batch import group_by_batch_key
+
+WIDTH = 64
+HEIGHT = 48
+
+
+class StubPipeline:
+    """Fills each output with the index of its prompt, flags "nsfw" prompts"""
+
+    def __init__(self):
+        self.scheduler = DDIMScheduler()
+        self.calls = 0
+
+    def __call__(self, prompt, generator, output_type, **kwargs):
+        assert output_type == "pt"
+        assert len(generator) == len(prompt)
+        self.calls += 1
+        images = torch.stack(
+            [torch.full((3, HEIGHT, WIDTH), float(i)) for i in range(len(prompt))]
+        )
+        return SimpleNamespace(
+            images=images,
+            nsfw_content_detected=["nsfw" in p for p in prompt],
+        )
+
+
+def make_input(**kwargs):
+    input = {
+        "process_type": "generate",
+        "model": SD_MODEL_DEFAULT_KEY,
+        "scheduler": SD_SCHEDULER_DEFAULT,
+        "width": WIDTH,
+        "height": HEIGHT,
+        "num_inference_steps": 2,
+        "guidance_scale": 7.0,
+        "init_image_url": None,
+        "mask_image_url": None,
+        "prompt_strength": None,
+        "skip_safety_checker": False,
+        "embedding_encoding": "float",
+    }
+    input.update(kwargs)
+    return SimpleNamespace(**input)
+
+
+def make_job(prompt: str, num_outputs: int, seed: int):
+    return {
+        "prompt": prompt,
+        "negative_prompt": None,
+        "prompt_prefix": "",
+        "negative_prompt_prefix": None,
+        "num_outputs": num_outputs,
+        "init_image_url": None,
+        "seed": seed,
+    }
+
+
+def check_grouping():
+    inputs = [
+        make_input(),
+        make_input(width=WIDTH * 2),
+        make_input(),
+        make_input(process_type="upscale"),
+        make_input(),
+    ]
+    groups = group_by_batch_key(inputs, max_batch_size=2)
+    assert groups == [[0, 2], [1], [3], [4]], groups
+
+
+def check_split():
+    # Output indexes in the call: cat 0-1, nsfw 2-4, dog 5
+    jobs = [
+        make_job("a cat", 2, 1),
+        make_job("an nsfw cat", 3, 2),
+        make_job("a dog", 1, 3),
+    ]
+    text2img = StubPipeline()
+    pipe = SimpleNamespace(text2img=text2img, img2img=StubPipeline(), refiner=None)
+    results = generate_batch(
+        jobs,
+        width=WIDTH,
+        height=HEIGHT,
+        num_inference_steps=2,
+        guidance_scale=7.0,
+        prompt_strength=None,
+        scheduler=SD_SCHEDULER_DEFAULT,
+        model=SD_MODEL_DEFAULT_KEY,
+        pipe=pipe,
+    )
+    assert text2img.calls == 1, text2img.calls
+    assert len(results) == len(jobs)
+
+    (cat_images, cat_nsfw), (nsfw_images, nsfw_count), (dog_images, dog_nsfw) = results
+    assert cat_nsfw == 0 and cat_images.shape == (2, 3, HEIGHT, WIDTH)
+    assert cat_images[:, 0, 0, 0].tolist() == [0.0, 1.0]
+    assert nsfw_count == 3 and nsfw_images.shape[0] == 0
+    assert dog_nsfw == 0 and dog_images[:, 0, 0, 0].tolist() == [5.0]
+
+
+def main():
+    check_grouping()
+    check_split()
+    print("-- Batched outputs and NSFW counts split per job --")
+
+
+if __name__ == "__main__":
+    main()
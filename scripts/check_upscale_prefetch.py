@@ -0,0 +1,65 @@
+"""Check of the upscale branch of predict() with a prefetched image.
+
+Runs an upscale input through resolve_image_to_upscale and upscale, once with the
+image the prefetcher would have downloaded and once through the URL path, with a
+nearest-neighbour upscaler in place of SwinIR. Both must give the same RGB image.
+
+    python scripts/check_upscale_prefetch.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models.swinir.upscale as swinir_upscale
+from predict.image.prefetch import PrefetchedInputs, resolve_image_to_upscale
+
+URL = "https://example.com/image.png"
+SCALE = 4
+
+
+def main():
+    rng = np.random.default_rng(0)
+    image_rgb = rng.integers(0, 256, size=(37, 53, 3), dtype=np.uint8)
+    # What download_image_to_upscale returns, and the prefetcher stores
+    image_bgr = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)
+    upscaler = {
+        "args": SimpleNamespace(task="real_sr", scale=SCALE, noise=0),
+        "pipe": lambda x: torch.nn.functional.interpolate(
+            x, scale_factor=SCALE, mode="nearest"
+        ),
+    }
+
+    prefetched = PrefetchedInputs(image_to_upscale=image_bgr)
+    image_to_upscale = resolve_image_to_upscale(URL, prefetched)
+    assert image_to_upscale is image_bgr
+    prefetched_output = swinir_upscale.upscale(image_to_upscale, upscaler)
+
+    download_image = swinir_upscale.download_image
+    swinir_upscale.download_image = lambda url: image_bgr.copy()
+    try:
+        image_to_upscale = resolve_image_to_upscale(URL, None)
+        assert image_to_upscale == URL
+        url_output = swinir_upscale.upscale(image_to_upscale, upscaler)
+    finally:
+        swinir_upscale.download_image = download_image
+
+    expected_shape = (image_rgb.shape[0] * SCALE, image_rgb.shape[1] * SCALE, 3)
+    assert prefetched_output.shape == expected_shape, prefetched_output.shape
+    assert np.array_equal(prefetched_output, url_output)
+    # RGB out, like the input before the prefetcher's conversion
+    difference = np.abs(
+        prefetched_output[::SCALE, ::SCALE].astype(np.int16) - image_rgb
+    )
+    assert difference.max() <= 1, difference.max()
+    print("-- Prefetched upscale input matches the URL path --")
+
+
+if __name__ == "__main__":
+    main()
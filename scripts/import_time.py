@@ -0,0 +1,87 @@
+"""Import time benchmark of the worker entry point.
+
+Runs `python -X importtime` on what main.py imports before setup() for each
+worker type, and fails when the total is over the budget or when a module of
+the other worker type's stack gets imported.
+
+    python scripts/import_time.py [image|voiceover] ...
+"""
+
+import os
+import subprocess
+import sys
+
+from tabulate import tabulate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budgets in ms, override with IMPORT_TIME_BUDGET_MS_IMAGE / _VOICEOVER
+BUDGETS_MS = {
+    "image": int(os.environ.get("IMPORT_TIME_BUDGET_MS_IMAGE", 15000)),
+    "voiceover": int(os.environ.get("IMPORT_TIME_BUDGET_MS_VOICEOVER", 10000)),
+}
+
+# Top level modules a worker type must not import
+FORBIDDEN_MODULES = {
+    "image": ["bark", "nltk", "denoiser", "pydub", "pyloudnorm"],
+    "voiceover": ["diffusers", "kandinsky2", "lingua", "open_clip", "flask", "waitress"],
+}
+
+TOP_COUNT = 15
+
+
+def measure(worker_type: str) -> tuple[int, list[tuple[int, str]]]:
+    """Returns the total import time in us and the cumulative time of each top level module"""
+    code = f"import main; main.import_worker_stack({worker_type!r})"
+    env = {**os.environ, "WORKER_TYPE": worker_type}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr[-4000:])
+        raise RuntimeError(f"Importing the {worker_type} worker stack failed")
+
+    modules: list[tuple[int, str]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        # Nested imports are indented, only top level ones add up to the total
+        if not name.startswith("  "):
+            modules.append((int(cumulative), name.strip()))
+    return sum(us for us, _ in modules), modules
+
+
+def main(worker_types: list[str]) -> int:
+    failed = False
+    for worker_type in worker_types:
+        total_us, modules = measure(worker_type)
+        total_ms = total_us / 1000
+        budget_ms = BUDGETS_MS[worker_type]
+        imported = {name.split(".")[0] for _, name in modules}
+        forbidden = [m for m in FORBIDDEN_MODULES[worker_type] if m in imported]
+
+        slowest = sorted(modules, reverse=True)[:TOP_COUNT]
+        print(
+            tabulate(
+                [[name, f"{us / 1000:.1f}"] for us, name in slowest],
+                headers=[f"Slowest imports ({worker_type})", "ms"],
+                tablefmt="double_grid",
+            )
+        )
+        print(f"{worker_type}: {total_ms:.0f}ms of {budget_ms}ms budget")
+        if total_ms > budget_ms:
+            print(f"{worker_type}: import time is over budget")
+            failed = True
+        if len(forbidden) > 0:
+            print(f"{worker_type}: imports modules it doesn't use: {forbidden}")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:] or list(BUDGETS_MS.keys())))
@@ -10,3 +10,17 @@ MODELS_FROM_ENV = os.environ.get("MODELS", "Luna Diffusion")
 MODELS_FROM_ENV_LIST = map(
     lambda x: clean_prefix_or_suffix_space(x), MODELS_FROM_ENV.split(",")
 )
+
+# Resolve model files from a local artifact directory instead of the network
+WORKER_OFFLINE = os.environ.get("WORKER_OFFLINE", "0") == "1"
+ARTIFACT_DIR = os.environ.get("ARTIFACT_DIR", "/app/data/artifacts")
+
+# Threads posting webhooks, posts of one job are delivered in order by the same thread
+WEBHOOK_MAX_WORKERS = int(os.environ.get("WEBHOOK_MAX_WORKERS", "4"))
+# Webhooks waiting to be posted, submitting waits past it
+WEBHOOK_OUTBOX_SIZE = int(os.environ.get("WEBHOOK_OUTBOX_SIZE", "1000"))
+WEBHOOK_TIMEOUT = float(os.environ.get("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_MAX_RETRIES = int(os.environ.get("WEBHOOK_MAX_RETRIES", "5"))
+# Retries wait a random time up to base * 2^attempt seconds, capped at max
+WEBHOOK_BACKOFF_BASE = float(os.environ.get("WEBHOOK_BACKOFF_BASE", "0.25"))
+WEBHOOK_BACKOFF_MAX = float(os.environ.get("WEBHOOK_BACKOFF_MAX", "10"))
@@ -9,18 +9,10 @@ from io import BytesIO
 from concurrent.futures import ThreadPoolExecutor
 from PIL import ImageOps
 from typing import TypeVar, List
-from scipy.io.wavfile import write
-from pydub import AudioSegment
-from io import BytesIO
-from pydub.silence import split_on_silence
 import numpy as np
 import textwrap
 import torch
 
-from pydub import AudioSegment
-from pyloudnorm import Meter, normalize
-from io import BytesIO
-
 
 from predict.voiceover.classes import RemoveSilenceParams
 from tabulate import tabulate
@@ -115,13 +107,17 @@ def download_and_fit_image(url, width, height):
     return fit_image(image, width, height)
 
 
-def download_and_fit_image_mask(url, width, height, inverted=False):
-    image = download_and_fit_image(url, width, height)
+def image_to_mask(image, inverted=False):
     image = image.convert("L")
     mask = 1 - np.array(image) / 255.0 if inverted else np.array(image) / 255.0
     return mask
 
 
+def download_and_fit_image_mask(url, width, height, inverted=False):
+    image = download_and_fit_image(url, width, height)
+    return image_to_mask(image, inverted=inverted)
+
+
 def download_images(urls, max_workers=10):
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = [executor.submit(download_image, url) for url in urls]
@@ -129,19 +125,22 @@ def download_images(urls, max_workers=10):
     return images
 
 
-def download_image_from_s3(key, bucket):
+def download_image_from_s3(key, s3, bucket):
     try:
-        image_object = bucket.Object(key)
-        image_data = image_object.get().get("Body").read()
+        image_data = s3.get_object(Bucket=bucket, Key=key)["Body"].read()
         image = Image.open(BytesIO(image_data))
         return image
     except Exception as e:
         return None
 
 
-def download_images_from_s3(keys, bucket, max_workers=25):
+def download_images_from_s3(keys, s3, bucket, max_workers=25):
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        images = list(executor.map(download_image_from_s3, keys, [bucket] * len(keys)))
+        images = list(
+            executor.map(
+                download_image_from_s3, keys, [s3] * len(keys), [bucket] * len(keys)
+            )
+        )
 
     return images
 
@@ -156,6 +155,8 @@ def return_value_if_in_list(value: T, list_of_values: List[T]) -> bool:
 
 
 def numpy_to_wav_bytes(numpy_array, sample_rate):
+    from scipy.io.wavfile import write
+
     wav_io = BytesIO()
     write(wav_io, sample_rate, numpy_array)
     wav_io.seek(0)
@@ -166,6 +167,9 @@ def remove_silence_from_wav(
     wav_bytes: BytesIO,
     remove_silence_params: RemoveSilenceParams,
 ) -> BytesIO:
+    from pydub import AudioSegment
+    from pydub.silence import split_on_silence
+
     audio_segment = AudioSegment.from_wav(wav_bytes)
     audio_chunks = split_on_silence(
         audio_segment,
@@ -183,6 +187,8 @@ def remove_silence_from_wav(
 
 
 def convert_wav_to_mp3(wav_bytes: BytesIO):
+    from pydub import AudioSegment
+
     audio_segment = AudioSegment.from_wav(wav_bytes)
     mp3_io = BytesIO()
     audio_segment.export(mp3_io, format="mp3", bitrate="320k")
@@ -238,6 +244,8 @@ def wrap_text(text, width=50):
 
 
 def do_normalize_audio_loudness(audio_arr, sample_rate, target_lufs=-16):
+    from pyloudnorm import Meter, normalize
+
     s = time.time()
     # Create a meter instance
     meter = Meter(sample_rate)
@@ -336,6 +344,48 @@ def crop_images(image_array, width, height):
     return cropped_images
 
 
+def crop_image_tensors(images: torch.Tensor, width, height) -> torch.Tensor:
+    """crop_images for an (N, 3, H, W) batch"""
+    old_height, old_width = images.shape[-2:]
+    if old_width < width or old_height < height:
+        return images
+    top = (old_height - height) // 2
+    left = (old_width - width) // 2
+    return images[..., top : top + height, left : left + width]
+
+
+def uint8_arrays_to_tensor(arrays: List[np.ndarray], device: str) -> torch.Tensor:
+    """Stacks same-sized uint8 HWC arrays into an (N, 3, H, W) float batch in [0, 1] on the device"""
+    stacked = np.stack([array[..., :3] for array in arrays])
+    return (
+        torch.from_numpy(stacked).to(device).permute(0, 3, 1, 2).float().div_(255.0)
+    )
+
+
+def pil_images_to_tensor(images: List[Image.Image], device: str) -> torch.Tensor:
+    """Stacks same-sized images into an (N, 3, H, W) float batch in [0, 1] on the device"""
+    return uint8_arrays_to_tensor(
+        [np.asarray(image.convert("RGB")) for image in images], device
+    )
+
+
+def tensor_to_uint8_arrays(images: torch.Tensor) -> List[np.ndarray]:
+    """(N, 3, H, W) float batch in [0, 1] to contiguous uint8 HWC arrays, in one transfer"""
+    arrays = (
+        images.detach()
+        .float()
+        .clamp(0, 1)
+        .mul(255.0)
+        .round()
+        .to(torch.uint8)
+        .permute(0, 2, 3, 1)
+        .contiguous()
+        .cpu()
+        .numpy()
+    )
+    return list(arrays)
+
+
 def print_tuple(a, b):
     print(tabulate([[a, b]], tablefmt="simple_grid"))
 
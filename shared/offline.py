@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict
+
+from .constants import ARTIFACT_DIR
+
+ARTIFACT_MANIFEST = "manifest.json"
+
+# Read by huggingface_hub, transformers and diffusers when they are imported
+HF_OFFLINE_ENV = ["HF_HUB_OFFLINE", "TRANSFORMERS_OFFLINE", "HF_DATASETS_OFFLINE"]
+
+
+class MissingArtifactError(Exception):
+    pass
+
+
+_manifest: Dict[str, Dict[str, Any]] | None = None
+
+
+def load_manifest() -> Dict[str, Dict[str, Any]]:
+    """Artifacts of ARTIFACT_DIR/manifest.json by name.
+
+    Each one has a path, relative to ARTIFACT_DIR or absolute, and a sha256 for files.
+    Directories such as HuggingFace caches are only checked for existence.
+    """
+    global _manifest
+    if _manifest is None:
+        manifest_path = os.path.join(ARTIFACT_DIR, ARTIFACT_MANIFEST)
+        if not os.path.exists(manifest_path):
+            raise MissingArtifactError(f"No artifact manifest at {manifest_path}")
+        with open(manifest_path) as f:
+            _manifest = json.load(f)["artifacts"]
+    return _manifest
+
+
+def get_artifact_path(entry: Dict[str, Any]) -> str:
+    return os.path.join(ARTIFACT_DIR, entry["path"])
+
+
+def get_file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def resolve_artifact(name: str) -> str:
+    """Local path of an artifact, raises if it isn't in the manifest or on disk"""
+    entry = load_manifest().get(name, None)
+    if entry is None:
+        raise MissingArtifactError(f"Artifact {name} is not in the manifest")
+    path = get_artifact_path(entry)
+    if not os.path.exists(path):
+        raise MissingArtifactError(f"Artifact {name} is missing at {path}")
+    return path
+
+
+def verify_artifacts():
+    """Checks every artifact of the manifest, raises with all the missing or corrupt ones"""
+    s = time.time()
+    errors = []
+    manifest = load_manifest()
+    for name, entry in manifest.items():
+        path = get_artifact_path(entry)
+        if not os.path.exists(path):
+            errors.append(f"{name}: missing at {path}")
+        elif "sha256" in entry and get_file_sha256(path) != entry["sha256"]:
+            errors.append(f"{name}: checksum mismatch at {path}")
+    if len(errors) > 0:
+        raise MissingArtifactError("Offline artifacts are not usable:\n" + "\n".join(errors))
+    print(
+        f"✅ Verified {len(manifest)} offline artifacts | Duration: {round(time.time() - s, 1)} seconds"
+    )
+
+
+def enable_offline_mode():
+    """Keeps model libraries off the network, call it before importing them"""
+    for key in HF_OFFLINE_ENV:
+        os.environ[key] = "1"
+    # torch.hub checkpoints, such as the denoiser's, are read from the artifact directory
+    os.environ.setdefault("TORCH_HOME", os.path.join(ARTIFACT_DIR, "torch"))
+    verify_artifacts()
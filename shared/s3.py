@@ -0,0 +1,64 @@
+from threading import Lock
+from typing import Any, Dict
+
+import boto3
+from boto3_type_annotations.s3 import Client
+from botocore.config import Config
+
+from upload.constants import (
+    S3_ACCESS_KEY_ID,
+    S3_CLIPAPI_MAX_POOL_CONNECTIONS,
+    S3_DOWNLOAD_MAX_POOL_CONNECTIONS,
+    S3_ENDPOINT_URL,
+    S3_REGION,
+    S3_SECRET_ACCESS_KEY,
+    S3_UPLOAD_MAX_POOL_CONNECTIONS,
+)
+
+# Connection settings of the subsystems, each one gets its own client and pool
+S3_CLIENT_CONFIGS: Dict[str, Dict[str, Any]] = {
+    "upload": {
+        "max_pool_connections": S3_UPLOAD_MAX_POOL_CONNECTIONS,
+        "connect_timeout": 5,
+        "read_timeout": 5,
+    },
+    "clipapi": {
+        "max_pool_connections": S3_CLIPAPI_MAX_POOL_CONNECTIONS,
+        "connect_timeout": 5,
+    },
+    "download": {
+        "max_pool_connections": S3_DOWNLOAD_MAX_POOL_CONNECTIONS,
+        "connect_timeout": 5,
+    },
+}
+
+s3_clients: Dict[str, Client] = {}
+s3_clients_lock = Lock()
+
+
+def create_s3_client(subsystem: str) -> Client:
+    config = Config(
+        retries={"max_attempts": 3, "mode": "standard"},
+        # Idle pooled connections are kept alive between jobs
+        tcp_keepalive=True,
+        **S3_CLIENT_CONFIGS[subsystem],
+    )
+    # Sessions aren't thread-safe, the client they create is
+    session = boto3.session.Session()
+    return session.client(
+        "s3",
+        region_name=S3_REGION,
+        endpoint_url=S3_ENDPOINT_URL,
+        aws_access_key_id=S3_ACCESS_KEY_ID,
+        aws_secret_access_key=S3_SECRET_ACCESS_KEY,
+        config=config,
+    )
+
+
+def get_s3_client(subsystem: str) -> Client:
+    """The S3 client of a subsystem, created on first use and shared by its threads.
+    Subsystems are the keys of S3_CLIENT_CONFIGS."""
+    with s3_clients_lock:
+        if subsystem not in s3_clients:
+            s3_clients[subsystem] = create_s3_client(subsystem)
+        return s3_clients[subsystem]
@@ -0,0 +1,50 @@
+import base64
+from typing import TYPE_CHECKING, Any, Dict, List
+
+import orjson
+
+if TYPE_CHECKING:
+    import torch
+
+# "float" keeps the JSON lists, the others are base64 blobs of little-endian values
+EMBEDDING_ENCODINGS = ["float", "float16", "float32", "int8"]
+
+
+def dumps_json(data: Any) -> bytes:
+    """Serializes webhook and API payloads, numpy arrays included"""
+    return orjson.dumps(
+        data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+    )
+
+
+def encode_embeddings(
+    embeddings: "torch.Tensor", encoding: str = "float"
+) -> List[List[float] | Dict[str, Any]]:
+    """Encodes a batch of embeddings, one entry per row. The conversion runs on the
+    tensor's device, so the binary encodings move less data to the host.
+    int8 rows are scaled by their max magnitude, value = int8 * scale."""
+    import torch
+
+    if encoding == "float":
+        return embeddings.cpu().numpy().tolist()
+    if encoding == "int8":
+        embeddings = embeddings.float()
+        scales = embeddings.abs().amax(dim=1, keepdim=True).clamp_min(1e-12) / 127
+        values = torch.round(embeddings / scales).to(torch.int8).cpu().numpy()
+        return [
+            {
+                "encoding": encoding,
+                "scale": scale,
+                "data": base64.b64encode(row.tobytes()).decode("ascii"),
+            }
+            for row, scale in zip(values, scales.squeeze(1).cpu().tolist())
+        ]
+    dtype, numpy_dtype = {
+        "float16": (torch.float16, "<f2"),
+        "float32": (torch.float32, "<f4"),
+    }[encoding]
+    values = embeddings.to(dtype).cpu().numpy().astype(numpy_dtype, copy=False)
+    return [
+        {"encoding": encoding, "data": base64.b64encode(row.tobytes()).decode("ascii")}
+        for row in values
+    ]
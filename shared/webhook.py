@@ -1,22 +1,210 @@
+import logging
 import os
-from typing import Any, Dict, Any
+import queue
+import random
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, List, Tuple
 
 import requests
-import time
+from requests.adapters import HTTPAdapter
+from tabulate import tabulate
 
-MAX_RETRIES = 3
+from shared.constants import (
+    WEBHOOK_BACKOFF_BASE,
+    WEBHOOK_BACKOFF_MAX,
+    WEBHOOK_MAX_RETRIES,
+    WEBHOOK_MAX_WORKERS,
+    WEBHOOK_OUTBOX_SIZE,
+    WEBHOOK_TIMEOUT,
+)
+from shared.serialize import dumps_json
 
+# Not retried, the request itself is wrong
+FINAL_STATUS_CODES = [200, 400, 401]
 
-def post_webhook(url: str, data: Dict[str, Any], retries: int = 0) -> int:
-    """Retry a POST request to a webhook URL, return status code"""
-    ret = requests.post(
-        url, json=data, headers={"signature": os.environ.get("WEBHOOK_SIGNATURE")}
+
+def create_session(pool_size: int) -> requests.Session:
+    """Session keeping connections to the webhook endpoints alive between posts"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(
+        {
+            "Content-Type": "application/json",
+            "signature": os.environ.get("WEBHOOK_SIGNATURE"),
+        }
     )
-    if ret.status_code not in [200, 400, 401] and retries < MAX_RETRIES:
-        print(f"Webhook failed with status code {ret.status_code}")
-        # Sleep 150ms * retries
-        sleep_time = 0.15 * retries
-        print(f"Sleeping {sleep_time} seconds before retrying webhook")
-        time.sleep(sleep_time)
-        return post_webhook(url, data, retries + 1)
-    return ret.status_code
+    return session
+
+
+def backoff_seconds(attempt: int) -> float:
+    """Exponential backoff with full jitter"""
+    return random.uniform(0, min(WEBHOOK_BACKOFF_MAX, WEBHOOK_BACKOFF_BASE * 2**attempt))
+
+
+def post_webhook(
+    url: str, body: bytes, session: requests.Session
+) -> Tuple[int | None, int]:
+    """Retry a POST request to a webhook URL, return the last status code, None
+    when no response came back, and the number of attempts"""
+    status_code = None
+    for attempt in range(WEBHOOK_MAX_RETRIES + 1):
+        if attempt > 0:
+            sleep_time = backoff_seconds(attempt)
+            print(f"Sleeping {sleep_time:.2f} seconds before retrying webhook")
+            time.sleep(sleep_time)
+        try:
+            status_code = session.post(url, data=body, timeout=WEBHOOK_TIMEOUT).status_code
+        except requests.RequestException as e:
+            print(f"Webhook failed: {e}")
+            status_code = None
+            continue
+        if status_code in FINAL_STATUS_CODES:
+            return status_code, attempt + 1
+        print(f"Webhook failed with status code {status_code}")
+    return status_code, WEBHOOK_MAX_RETRIES + 1
+
+
+def webhook_job_key(data: Dict[str, Any]) -> Any:
+    """Posts of the same job are delivered in order, responses are reused across its events"""
+    return data.get("id", id(data))
+
+
+class WebhookMetrics:
+    """Delivery latency, from the submit to the last attempt, and attempts per post"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.count = 0
+        self.failed = 0
+        self.attempts = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, delivered: bool, attempts: int, latency: float):
+        with self.lock:
+            self.count += 1
+            self.failed += 0 if delivered else 1
+            self.attempts += attempts
+            self.latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def log(self, outbox_size: int):
+        with self.lock:
+            if self.count == 0:
+                return
+            table = [
+                [
+                    self.count,
+                    self.failed,
+                    round(self.attempts / self.count, 2),
+                    round(self.latency / self.count * 1000),
+                    round(self.max_latency * 1000),
+                    outbox_size,
+                ]
+            ]
+        print(
+            tabulate(
+                table,
+                headers=[
+                    "Webhooks",
+                    "Failed",
+                    "Attempts",
+                    "Latency ms",
+                    "Max latency ms",
+                    "Outbox",
+                ],
+                tablefmt="double_grid",
+            )
+        )
+
+
+class WebhookDispatcher:
+    """Posts webhooks from background threads, so a slow endpoint doesn't hold up
+    the prediction and upload threads.
+
+    Posts of a job always go to the same thread, one after the other, so START is
+    delivered before COMPLETED. The outbox is bounded: submit waits when it's full.
+    Payloads are serialized on submit, the responses are mutated after they are sent.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = WEBHOOK_MAX_WORKERS,
+        outbox_size: int = WEBHOOK_OUTBOX_SIZE,
+    ):
+        self.max_workers = max(1, max_workers)
+        self.lanes: List[queue.Queue] = [
+            queue.Queue(maxsize=max(1, outbox_size // self.max_workers))
+            for _ in range(self.max_workers)
+        ]
+        self.threads: List[Thread] = []
+        self.lock = Lock()
+        self.session: requests.Session | None = None
+        self.metrics = WebhookMetrics()
+
+    def start(self):
+        with self.lock:
+            if len(self.threads) > 0:
+                return
+            self.session = create_session(self.max_workers)
+            for i, lane in enumerate(self.lanes):
+                thread = Thread(
+                    target=self.run, args=(lane,), name=f"webhook-{i}", daemon=True
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def submit(self, url: str, data: Dict[str, Any], job_key: Any = None):
+        """Queues a post of the data, as it is now, to the webhook URL.
+        Posts built from a copy of a job's response pass the job_key of the response."""
+        self.start()
+        body = dumps_json(data)
+        # Same job, same lane
+        if job_key is None:
+            job_key = webhook_job_key(data)
+        lane = self.lanes[hash(job_key) % self.max_workers]
+        lane.put((url, body, time.time()))
+
+    def run(self, lane: queue.Queue):
+        while True:
+            item = lane.get()
+            try:
+                if item is None:
+                    return
+                url, body, submitted_at = item
+                status_code, attempts = post_webhook(url, body, self.session)
+                logging.info(f"-- Webhook: {status_code}")
+                self.metrics.record(
+                    status_code in FINAL_STATUS_CODES,
+                    attempts,
+                    time.time() - submitted_at,
+                )
+            except Exception as e:
+                logging.error(f"Exception in webhook dispatcher: {e}")
+            finally:
+                lane.task_done()
+
+    def outbox_size(self) -> int:
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def log(self):
+        self.metrics.log(self.outbox_size())
+
+    def shutdown(self):
+        """Delivers the posts in the outbox, then stops the threads"""
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        if len(threads) == 0:
+            return
+        for lane in self.lanes:
+            lane.put(None)
+        for thread in threads:
+            thread.join()
+        self.session.close()
+
+
+webhook_dispatcher = WebhookDispatcher()
@@ -5,3 +5,40 @@ S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL")
 S3_BUCKET_NAME_UPLOAD = os.environ.get("S3_BUCKET_NAME_UPLOAD")
 S3_ACCESS_KEY_ID = os.environ.get("AWS_ACCESS_KEY_ID")
 S3_SECRET_ACCESS_KEY = os.environ.get("AWS_SECRET_ACCESS_KEY")
+
+# Processes encoding images for upload, 0 encodes in the upload threads
+ENCODE_MAX_WORKERS = int(os.environ.get("ENCODE_MAX_WORKERS", "2"))
+
+# Objects uploaded at the same time across all jobs
+UPLOAD_MAX_WORKERS = max(1, int(os.environ.get("UPLOAD_MAX_WORKERS", "16")))
+# Jobs whose uploads and webhook are in flight, the upload queue waits past it
+UPLOAD_MAX_JOBS = max(1, int(os.environ.get("UPLOAD_MAX_JOBS", "4")))
+
+# Decoded outputs held in memory between prediction and upload
+UPLOAD_QUEUE_MEMORY_BUDGET = int(os.environ.get("UPLOAD_QUEUE_MEMORY_MB", "2048")) * 1024**2
+# Outputs over the budget are encoded to this directory, empty disables it and only waits
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR", "/app/data/upload-spool")
+UPLOAD_SPOOL_BUDGET = int(os.environ.get("UPLOAD_SPOOL_MB", "4096")) * 1024**2
+
+# Objects from this size, or of unknown size, are uploaded in parts
+UPLOAD_MULTIPART_THRESHOLD = int(os.environ.get("UPLOAD_MULTIPART_THRESHOLD_MB", "8")) * 1024**2
+UPLOAD_MULTIPART_CHUNKSIZE = int(os.environ.get("UPLOAD_MULTIPART_CHUNK_MB", "8")) * 1024**2
+# Parts of one object uploaded at the same time
+UPLOAD_MULTIPART_MAX_CONCURRENCY = max(
+    1, int(os.environ.get("UPLOAD_MULTIPART_MAX_CONCURRENCY", "4"))
+)
+
+# Connections each S3 client keeps open, per subsystem sharing it.
+# Each upload thread can have UPLOAD_MULTIPART_MAX_CONCURRENCY parts in flight.
+S3_UPLOAD_MAX_POOL_CONNECTIONS = int(
+    os.environ.get(
+        "S3_UPLOAD_MAX_POOL_CONNECTIONS",
+        str(UPLOAD_MAX_WORKERS * UPLOAD_MULTIPART_MAX_CONCURRENCY + 4),
+    )
+)
+S3_CLIPAPI_MAX_POOL_CONNECTIONS = int(
+    os.environ.get("S3_CLIPAPI_MAX_POOL_CONNECTIONS", "100")
+)
+S3_DOWNLOAD_MAX_POOL_CONNECTIONS = int(
+    os.environ.get("S3_DOWNLOAD_MAX_POOL_CONNECTIONS", "10")
+)
@@ -0,0 +1,224 @@
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from multiprocessing import get_context, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+from tabulate import tabulate
+
+from upload.constants import ENCODE_MAX_WORKERS
+
+
+class EncodeBufferPool:
+    """Output buffers reused across jobs, so encoding doesn't grow a new one each time.
+
+    Upload threads only live as long as a job, so the buffers are pooled here
+    instead of being kept per thread.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.buffers: List[BytesIO] = []
+
+    @contextmanager
+    def buffer(self) -> Iterator[BytesIO]:
+        with self.lock:
+            buffer = self.buffers.pop() if len(self.buffers) > 0 else BytesIO()
+        # Truncated after writing, truncating to 0 here would shrink it
+        buffer.seek(0)
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                self.buffers.append(buffer)
+
+
+encode_buffers = EncodeBufferPool()
+
+
+class SpooledFile:
+    """An output written to the upload spool, in place of its in-memory data"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+
+def encode_image(
+    image: Image.Image | np.ndarray,
+    target_extension: str,
+    target_quality: int,
+    buffer: BytesIO,
+) -> int:
+    """Encodes a uint8 HWC array, or a PIL image, into the buffer and leaves it
+    at the start of the encoded bytes. Returns their size."""
+    if isinstance(image, np.ndarray):
+        pil_image = Image.fromarray(np.ascontiguousarray(image))
+    else:
+        pil_image = image
+    if target_extension == "jpeg" and pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
+    pil_image.save(buffer, format=target_extension.upper(), quality=target_quality)
+    size = buffer.tell()
+    buffer.truncate()
+    buffer.seek(0)
+    return size
+
+
+def encode_frame(
+    shm_name: str,
+    shape: Tuple[int, ...],
+    dtype: str,
+    target_extension: str,
+    target_quality: int,
+) -> Tuple[bytes, float]:
+    """Runs in the encoder processes, encodes a frame from shared memory.
+    Returns the encoded bytes and the encoding time in seconds."""
+    s = time.time()
+    shm = SharedMemory(name=shm_name)
+    # The uploading process owns the segment and unlinks it
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        frame = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        buffer = BytesIO()
+        encode_image(frame, target_extension, target_quality, buffer)
+        # The view has to go before the segment can be closed
+        del frame
+    finally:
+        shm.close()
+    return buffer.getvalue(), time.time() - s
+
+
+class EncodeMetrics:
+    """Encoding latency per format. The encode time is measured in the encoder,
+    the total time includes the shared memory handoff and the wait for a free encoder."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.stats: Dict[str, Dict[str, float]] = {}
+
+    def record(self, target_extension: str, encode_seconds: float, total_seconds: float):
+        with self.lock:
+            stats = self.stats.setdefault(
+                target_extension,
+                {"count": 0, "encode": 0.0, "total": 0.0, "max_total": 0.0},
+            )
+            stats["count"] += 1
+            stats["encode"] += encode_seconds
+            stats["total"] += total_seconds
+            stats["max_total"] = max(stats["max_total"], total_seconds)
+
+    def log(self):
+        with self.lock:
+            table = [
+                [
+                    target_extension,
+                    int(stats["count"]),
+                    round(stats["encode"] / stats["count"] * 1000),
+                    round(stats["total"] / stats["count"] * 1000),
+                    round(stats["max_total"] * 1000),
+                ]
+                for target_extension, stats in self.stats.items()
+            ]
+        print(
+            tabulate(
+                table,
+                headers=["Format", "Images", "Encode ms", "Total ms", "Max total ms"],
+                tablefmt="double_grid",
+            )
+        )
+
+
+encode_metrics = EncodeMetrics()
+
+
+class EncoderPool:
+    """Persistent processes encoding output images, off the GIL of the GPU feeder
+    and upload threads. Frames are handed over through shared memory, the encoded
+    bytes come back to the upload thread that submitted them."""
+
+    def __init__(self, max_workers: int = ENCODE_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.executor: ProcessPoolExecutor | None = None
+
+    def start(self):
+        if self.max_workers < 1 or self.executor is not None:
+            return
+        # Not forked, the parent process holds CUDA state and running threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.max_workers, mp_context=get_context("spawn")
+        )
+        # Start the processes now rather than on the first job
+        for future in [
+            self.executor.submit(time.sleep, 0) for _ in range(self.max_workers)
+        ]:
+            future.result()
+        logging.info(f"Started {self.max_workers} image encoder processes")
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def encode(
+        self,
+        image: Image.Image | np.ndarray,
+        target_extension: str,
+        target_quality: int,
+    ) -> Tuple[bytes, float]:
+        """Returns the encoded bytes and the encoding time in seconds"""
+        frame = np.ascontiguousarray(np.asarray(image))
+        shm = SharedMemory(create=True, size=frame.nbytes)
+        try:
+            shared_frame = np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)
+            shared_frame[...] = frame
+            del shared_frame
+            future = self.executor.submit(
+                encode_frame,
+                shm.name,
+                frame.shape,
+                frame.dtype.str,
+                target_extension,
+                target_quality,
+            )
+            return future.result()
+        finally:
+            shm.close()
+            shm.unlink()
+
+
+encoder_pool = EncoderPool()
+
+
+@contextmanager
+def encoded_image(
+    image: Image.Image | np.ndarray | SpooledFile,
+    target_extension: str,
+    target_quality: int,
+) -> Iterator[Tuple[BinaryIO | bytes, int]]:
+    """Yields the encoded image as an upload body and its size, from the encoder
+    processes when they are started, from a pooled buffer in this thread otherwise.
+    Spooled images were encoded when they were spooled and are read from their file."""
+    if isinstance(image, SpooledFile):
+        with open(image.path, "rb") as f:
+            yield f, image.size
+        return
+    s = time.time()
+    if encoder_pool.executor is not None:
+        encoded, encode_seconds = encoder_pool.encode(
+            image, target_extension, target_quality
+        )
+        encode_metrics.record(target_extension, encode_seconds, time.time() - s)
+        yield encoded, len(encoded)
+        return
+    with encode_buffers.buffer() as buffer:
+        size = encode_image(image, target_extension, target_quality, buffer)
+        encode_seconds = time.time() - s
+        encode_metrics.record(target_extension, encode_seconds, encode_seconds)
+        yield buffer, size
@@ -0,0 +1,42 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Any, Callable
+
+from upload.constants import UPLOAD_MAX_JOBS, UPLOAD_MAX_WORKERS
+
+
+class UploadEngine:
+    """Long-lived executors of the upload thread.
+
+    Objects of all jobs share one pool of upload threads, so the global concurrency
+    is bounded. Up to max_jobs jobs are in flight at the same time: the next job's
+    uploads start while the previous one is still uploading or posting its webhook.
+    Each job runs on its own thread, so its webhook still follows its own uploads.
+    """
+
+    def __init__(
+        self, max_workers: int = UPLOAD_MAX_WORKERS, max_jobs: int = UPLOAD_MAX_JOBS
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="upload"
+        )
+        self.job_executor = ThreadPoolExecutor(
+            max_workers=max_jobs, thread_name_prefix="upload-job"
+        )
+        self.job_slots = BoundedSemaphore(max_jobs)
+
+    def submit_job(self, fn: Callable[..., Any], *args: Any) -> Future:
+        """Runs a job, waits for a free slot when max_jobs are in flight"""
+        self.job_slots.acquire()
+        try:
+            future = self.job_executor.submit(fn, *args)
+        except Exception:
+            self.job_slots.release()
+            raise
+        future.add_done_callback(lambda _: self.job_slots.release())
+        return future
+
+    def shutdown(self):
+        """Waits for the jobs in flight, then for their uploads"""
+        self.job_executor.shutdown(wait=True)
+        self.executor.shutdown(wait=True)
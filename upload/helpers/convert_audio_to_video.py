@@ -1,13 +1,14 @@
 from pydub import AudioSegment
 import cv2
 import ffmpeg
-from typing import List
+from typing import BinaryIO, Iterator, List
 import os
 import tempfile
 import requests
 import math
 from io import BytesIO
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from functools import partial
 from upload.helpers.get_waveform_image_url import get_waveform_image_url
 
@@ -45,9 +46,12 @@ def process_frame(
     return new_image
 
 
+@contextmanager
 def convert_audio_to_video(
     wav_bytes: BytesIO, speaker: str, prompt: str, audio_array: List[float]
-) -> BytesIO:
+) -> Iterator[BinaryIO]:
+    """Yields the MP4 as ffmpeg produces it, so it can be uploaded meanwhile.
+    Raises on exit if ffmpeg failed, the stream may have been cut short."""
     image_url = get_waveform_image_url(speaker, prompt, audio_array)
     overlay_path = os.path.join(
         os.path.dirname(__file__), "../..", "assets", "overlay.png"
@@ -78,7 +82,6 @@ def convert_audio_to_video(
 
     fourcc = cv2.VideoWriter_fourcc(*"RGBA")
     raw_video_path = audio_file_path.replace(".wav", ".avi")
-    output_video_path = audio_file_path.replace(".wav", "_output.mp4")
 
     video = cv2.VideoWriter(
         raw_video_path,
@@ -103,26 +106,31 @@ def convert_audio_to_video(
 
     video.release()
 
+    # Fragmented, the MP4 muxer can't go back to write the index on a pipe
     output = ffmpeg.output(
         ffmpeg.input(raw_video_path),
         ffmpeg.input(audio_file_path),
-        output_video_path,
+        "pipe:1",
         **{
             "vcodec": "libx264",  # H.264 codec
             "acodec": "aac",  # Audio codec to be used
             "pix_fmt": "yuv420p",
             "b:a": "320k",
             "crf": "18",
+            "format": "mp4",
+            "movflags": "frag_keyframe+empty_moov+default_base_moof",
         }
     )
-    output.run()
-
-    with open(output_video_path, "rb") as f:
-        output_bytes = BytesIO(f.read())
-
-    os.remove(img_file_path)
-    os.remove(audio_file_path)
-    os.remove(raw_video_path)
-    os.remove(output_video_path)
-
-    return output_bytes
+    process = output.run_async(pipe_stdout=True)
+    try:
+        yield process.stdout
+    finally:
+        # Drained if the upload stopped early, ffmpeg would block on a full pipe
+        process.stdout.read()
+        process.stdout.close()
+        returncode = process.wait()
+        os.remove(img_file_path)
+        os.remove(audio_file_path)
+        os.remove(raw_video_path)
+    if returncode != 0:
+        raise RuntimeError(f"ffmpeg exited with code {returncode}")
@@ -1,4 +1,6 @@
-from boto3_type_annotations.s3 import ServiceResource
+from boto3.s3.transfer import TransferConfig
+from boto3_type_annotations.s3 import Client
+import numpy as np
 from PIL import Image
 from predict.voiceover.classes import RemoveSilenceParams
 from shared.helpers import (
@@ -7,114 +9,163 @@ from shared.helpers import (
     convert_wav_to_mp3,
     remove_silence_from_wav,
 )
-from typing import Any, Dict, Iterable, List
-from predict.image.predict import (
-    PredictOutput as PredictOutputForImage,
-)
-from predict.voiceover.predict import (
-    PredictOutput as PredictOutputForVoiceover,
-)
+from typing import Any, BinaryIO, Callable, Dict, Iterable, List
+from predict.image.classes import PredictOutput as PredictOutputForImage
+from predict.voiceover.classes import PredictOutput as PredictOutputForVoiceover
 import time
 from io import BytesIO
 import uuid
-from concurrent.futures import Future, ThreadPoolExecutor
-import wave
-from pydub import AudioSegment
+from concurrent.futures import Executor, Future, wait
 
-from upload.helpers.audio_array_from_wav import audio_array_from_wav
-from upload.helpers.convert_audio_to_video import convert_audio_to_video
+from upload.constants import (
+    UPLOAD_MULTIPART_CHUNKSIZE,
+    UPLOAD_MULTIPART_MAX_CONCURRENCY,
+    UPLOAD_MULTIPART_THRESHOLD,
+)
+from upload.encode import SpooledFile, encode_metrics, encoded_image
 from upload.helpers.get_audio_duration import get_audio_duration
 
+transfer_config = TransferConfig(
+    multipart_threshold=UPLOAD_MULTIPART_THRESHOLD,
+    multipart_chunksize=UPLOAD_MULTIPART_CHUNKSIZE,
+    max_concurrency=UPLOAD_MULTIPART_MAX_CONCURRENCY,
+)
+
+
+def upload_to_s3(
+    s3: Client,
+    s3_bucket: str,
+    key: str,
+    body: BinaryIO | bytes,
+    content_type: str,
+    size: int | None = None,
+):
+    """Uploads a body under the multipart threshold in one request. Larger ones,
+    and streams of unknown size, are read part by part and the parts uploaded in parallel."""
+    if size is not None and size < UPLOAD_MULTIPART_THRESHOLD:
+        s3.put_object(Bucket=s3_bucket, Body=body, Key=key, ContentType=content_type)
+        return
+    if isinstance(body, bytes):
+        body = BytesIO(body)
+    s3.upload_fileobj(
+        body,
+        s3_bucket,
+        key,
+        ExtraArgs={"ContentType": content_type},
+        Config=transfer_config,
+    )
+
 
 def convert_and_upload_image_to_s3(
-    s3: ServiceResource,
+    s3: Client,
     s3_bucket: str,
-    pil_image: Image.Image,
+    image: Image.Image | np.ndarray | SpooledFile,
     target_quality: int,
     target_extension: str,
     upload_path_prefix: str,
 ) -> str:
     """Convert an individual image to a target format and upload to S3."""
-    start_conv = time.time()
-
-    _pil_image = pil_image
-    if target_extension == "jpeg":
-        print(f"-- Upload: Converting to JPEG")
-        _pil_image = _pil_image.convert("RGB")
-    img_format = target_extension.upper()
-    img_bytes = BytesIO()
-    _pil_image.save(img_bytes, format=img_format, quality=target_quality)
-    file_bytes = img_bytes.getvalue()
-    end_conv = time.time()
-    print(
-        f"Converted image in: {round((end_conv - start_conv) *1000)} ms - {img_format} - {target_quality}"
-    )
-
     key = f"{str(uuid.uuid4())}.{target_extension}"
     if upload_path_prefix is not None and upload_path_prefix != "":
         key = f"{ensure_trailing_slash(upload_path_prefix)}{key}"
 
     content_type = parse_content_type(target_extension)
-    start_upload = time.time()
-    print(f"-- Upload: Uploading to S3")
-    s3.Bucket(s3_bucket).put_object(Body=file_bytes, Key=key, ContentType=content_type)
-    end_upload = time.time()
+    start_conv = time.time()
+    with encoded_image(image, target_extension, target_quality) as (body, size):
+        end_conv = time.time()
+        print(
+            f"Converted image in: {round((end_conv - start_conv) *1000)} ms - {target_extension.upper()} - {target_quality} - {size} bytes"
+        )
+
+        start_upload = time.time()
+        print(f"-- Upload: Uploading to S3")
+        # The encoded buffer is the body, no copy of its bytes
+        upload_to_s3(s3, s3_bucket, key, body, content_type, size)
+        end_upload = time.time()
     print(f"Uploaded image in: {round((end_upload - start_upload) *1000)} ms")
 
     return f"s3://{s3_bucket}/{key}"
 
 
+def upload_image_output(
+    index: int,
+    uploadObject: PredictOutputForImage,
+    s3: Client,
+    s3_bucket: str,
+    upload_path_prefix: str,
+    on_uploaded: Callable[[int, Dict[str, Any]], None] | None,
+) -> Dict[str, Any]:
+    """Uploads one image and returns its result, after on_uploaded was called with it"""
+    result = {
+        "image": convert_and_upload_image_to_s3(
+            s3,
+            s3_bucket,
+            uploadObject.image,
+            uploadObject.target_quality,
+            uploadObject.target_extension,
+            upload_path_prefix,
+        ),
+        "image_embed": uploadObject.open_clip_image_embed,
+        "aesthetic_rating_score": uploadObject.aesthetic_rating_score,
+        "aesthetic_artifact_score": uploadObject.aesthetic_artifact_score,
+    }
+    if on_uploaded is not None:
+        try:
+            on_uploaded(index, result)
+        except Exception as e:
+            # The image is stored, the job doesn't fail over its progress event
+            print(f"Failed to report uploaded image {index}: {e}")
+    return result
+
+
 def upload_files_for_image(
     uploadObjects: List[PredictOutputForImage],
-    s3: ServiceResource,
+    s3: Client,
     s3_bucket: str,
     upload_path_prefix: str,
+    executor: Executor,
+    on_uploaded: Callable[[int, Dict[str, Any]], None] | None = None,
 ) -> Iterable[Dict[str, Any]]:
-    """Send all files to S3 in parallel and return the S3 URLs"""
+    """Send all files to S3 in parallel on the shared executor and return the S3 URLs.
+    on_uploaded is called with the index and result of each image once it's stored,
+    from the upload threads, before this returns."""
     print("Started - Upload all files to S3 in parallel and return the S3 URLs")
     start = time.time()
 
-    # Run all uploads at same time in threadpool
     tasks: List[Future] = []
-    with ThreadPoolExecutor(max_workers=len(uploadObjects)) as executor:
-        print(f"-- Upload: Submitting to thread")
-        for uo in uploadObjects:
-            tasks.append(
-                executor.submit(
-                    convert_and_upload_image_to_s3,
-                    s3,
-                    s3_bucket,
-                    uo.pil_image,
-                    uo.target_quality,
-                    uo.target_extension,
-                    upload_path_prefix,
-                )
+    print(f"-- Upload: Submitting to thread")
+    for i, uo in enumerate(uploadObjects):
+        tasks.append(
+            executor.submit(
+                upload_image_output,
+                i,
+                uo,
+                s3,
+                s3_bucket,
+                upload_path_prefix,
+                on_uploaded,
             )
+        )
+    # Every object of the job is stored, or given up on, before the job's webhook
+    wait(tasks)
 
     # Get results
     results = []
-    for i, task in enumerate(tasks):
+    for task in tasks:
         print(f"-- Upload: Got result")
-        uploadObject = uploadObjects[i]
-        results.append(
-            {
-                "image": task.result(),
-                "image_embed": uploadObject.open_clip_image_embed,
-                "aesthetic_rating_score": uploadObject.aesthetic_rating_score,
-                "aesthetic_artifact_score": uploadObject.aesthetic_artifact_score,
-            }
-        )
+        results.append(task.result())
 
     end = time.time()
     print(
         f"📤 All converted and uploaded to S3 in: {round((end - start) *1000)} ms - Bucket: {s3_bucket} 📤"
     )
+    encode_metrics.log()
 
     return results
 
 
 def convert_and_upload_audio_file_to_s3(
-    s3: ServiceResource,
+    s3: Client,
     s3_bucket: str,
     audio_bytes: BytesIO,
     remove_silence_params: RemoveSilenceParams,
@@ -124,6 +175,11 @@ def convert_and_upload_audio_file_to_s3(
     speaker: str,
     prompt: str,
 ) -> tuple[str, int]:
+    # Only voiceover workers need the audio and video stack
+    from pydub import AudioSegment
+    from upload.helpers.audio_array_from_wav import audio_array_from_wav
+    from upload.helpers.convert_audio_to_video import convert_audio_to_video
+
     if remove_silence_params.should_remove:
         s = time.time()
         audio_bytes = remove_silence_from_wav(audio_bytes, remove_silence_params)
@@ -150,17 +206,6 @@ def convert_and_upload_audio_file_to_s3(
         f"Converted audio in: {round((e_conv - s_conv) *1000)} ms - {target_extension}"
     )
 
-    s_vid = time.time()
-    content_type_video = "video/mp4"
-    video_bytes = convert_audio_to_video(
-        wav_bytes=audio_bytes,
-        speaker=speaker,
-        prompt=prompt,
-        audio_array=audio_array,
-    )
-    e_vid = time.time()
-    print(f"Created video in: {round((e_vid - s_vid) *1000)} ms")
-
     new_uuid = str(uuid.uuid4())
 
     key = f"{new_uuid}.{target_extension}"
@@ -168,8 +213,10 @@ def convert_and_upload_audio_file_to_s3(
         key = f"{ensure_trailing_slash(upload_path_prefix)}{key}"
     start_upload = time.time()
     print(f"-- Upload: Uploading to S3")
-    s3.Bucket(s3_bucket).put_object(
-        Body=audio_bytes_converted, Key=key, ContentType=content_type_audio
+    with audio_bytes_converted.getbuffer() as view:
+        audio_size = view.nbytes
+    upload_to_s3(
+        s3, s3_bucket, key, audio_bytes_converted, content_type_audio, audio_size
     )
     end_upload = time.time()
     print(f"Uploaded audio file in: {round((end_upload - start_upload) *1000)} ms")
@@ -178,13 +225,27 @@ def convert_and_upload_audio_file_to_s3(
     key_video = f"{new_uuid}.mp4"
     if upload_path_prefix is not None and upload_path_prefix != "":
         key_video = f"{ensure_trailing_slash(upload_path_prefix)}{key_video}"
-    start_upload = time.time()
+    s_vid = time.time()
+    content_type_video = "video/mp4"
     print(f"-- Upload: Uploading to S3")
-    s3.Bucket(s3_bucket).put_object(
-        Body=video_bytes, Key=key_video, ContentType=content_type_video
-    )
-    end_upload = time.time()
-    print(f"Uploaded video file in: {round((end_upload - start_upload) *1000)} ms")
+    # Uploaded while ffmpeg encodes it
+    try:
+        with convert_audio_to_video(
+            wav_bytes=audio_bytes,
+            speaker=speaker,
+            prompt=prompt,
+            audio_array=audio_array,
+        ) as video_stream:
+            upload_to_s3(s3, s3_bucket, key_video, video_stream, content_type_video)
+    except Exception:
+        # ffmpeg failing is only known once the stream is uploaded, don't leave it truncated
+        try:
+            s3.delete_object(Bucket=s3_bucket, Key=key_video)
+        except Exception as e:
+            print(f"Failed to delete the video {key_video} after a failed conversion: {e}")
+        raise
+    e_vid = time.time()
+    print(f"Created and uploaded video in: {round((e_vid - s_vid) *1000)} ms")
     video_url = f"s3://{s3_bucket}/{key_video}"
 
     return [audio_url, audio_duration, video_url, audio_array]
@@ -192,33 +253,33 @@ def convert_and_upload_audio_file_to_s3(
 
 def upload_files_for_voiceover(
     uploadObjects: List[PredictOutputForVoiceover],
-    s3: ServiceResource,
+    s3: Client,
     s3_bucket: str,
     upload_path_prefix: str,
+    executor: Executor,
 ) -> Iterable[Dict[str, Any]]:
-    """Send all files to S3 in parallel and return the S3 URLs"""
+    """Send all files to S3 in parallel on the shared executor and return the S3 URLs"""
     print("Started - Upload all files to S3 in parallel and return the S3 URLs")
     start = time.time()
 
-    # Run all uploads at same time in threadpool
     tasks: List[Future] = []
-    with ThreadPoolExecutor(max_workers=len(uploadObjects)) as executor:
-        print(f"-- Upload: Submitting to thread")
-        for uo in uploadObjects:
-            tasks.append(
-                executor.submit(
-                    convert_and_upload_audio_file_to_s3,
-                    s3,
-                    s3_bucket,
-                    uo.audio_bytes,
-                    uo.remove_silence_params,
-                    uo.sample_rate,
-                    uo.target_extension,
-                    upload_path_prefix,
-                    uo.speaker,
-                    uo.prompt,
-                )
+    print(f"-- Upload: Submitting to thread")
+    for uo in uploadObjects:
+        tasks.append(
+            executor.submit(
+                convert_and_upload_audio_file_to_s3,
+                s3,
+                s3_bucket,
+                uo.audio_bytes,
+                uo.remove_silence_params,
+                uo.sample_rate,
+                uo.target_extension,
+                upload_path_prefix,
+                uo.speaker,
+                uo.prompt,
             )
+        )
+    wait(tasks)
 
     # Get results
     results = []
@@ -0,0 +1,225 @@
+import logging
+import os
+import queue
+import shutil
+import time
+import uuid
+from io import BytesIO
+from threading import Condition
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+from PIL import Image
+from tabulate import tabulate
+
+from upload.constants import (
+    UPLOAD_QUEUE_MEMORY_BUDGET,
+    UPLOAD_SPOOL_BUDGET,
+    UPLOAD_SPOOL_DIR,
+)
+from upload.encode import SpooledFile, encoded_image
+
+
+def output_size(output: Any) -> int:
+    """Bytes an image or voiceover output holds in memory"""
+    image = getattr(output, "image", None)
+    if isinstance(image, np.ndarray):
+        return image.nbytes
+    if isinstance(image, Image.Image):
+        return image.width * image.height * len(image.getbands())
+    audio_bytes = getattr(output, "audio_bytes", None)
+    if isinstance(audio_bytes, BytesIO):
+        with audio_bytes.getbuffer() as view:
+            return view.nbytes
+    return 0
+
+
+def message_outputs(message: Dict[str, Any]) -> List[Any]:
+    if "upload_output" not in message:
+        return []
+    return message["upload_output"].outputs
+
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadQueue(queue.Queue):
+    """Queue from the prediction thread to the upload thread, bounded by the memory
+    its outputs hold rather than by its length.
+
+    Past the memory budget, outputs are spooled: images are encoded to files of the
+    spool directory, voiceover WAVs are written there and read back when the message
+    is taken off the queue. When the spool is full too, or disabled, put waits for
+    the upload thread to release messages, which slows the prediction thread down.
+    A message is always accepted when nothing is held, even if it's over the budget.
+
+    The upload thread calls release once a message is uploaded and its webhook sent.
+    """
+
+    def __init__(
+        self,
+        memory_budget: int = UPLOAD_QUEUE_MEMORY_BUDGET,
+        spool_dir: str = UPLOAD_SPOOL_DIR,
+        spool_budget: int = UPLOAD_SPOOL_BUDGET,
+    ):
+        super().__init__()
+        self.memory_budget = memory_budget
+        self.spool_dir = spool_dir
+        self.spool_budget = spool_budget
+        self.budget = Condition()
+        self.bytes_in_memory = 0
+        self.bytes_spooled = 0
+        self.spooled_count = 0
+        # Memory bytes, spooled bytes and spool files of the messages not released yet
+        self.entries: Dict[int, Tuple[int, int, List[str]]] = {}
+        if self.spool_dir:
+            # Files of a previous run, their messages are gone with it
+            shutil.rmtree(self.spool_dir, ignore_errors=True)
+            os.makedirs(self.spool_dir, exist_ok=True)
+
+    def put(self, item: Dict[str, Any], block: bool = True, timeout: float | None = None):
+        size = sum(output_size(output) for output in message_outputs(item))
+        deadline = None if timeout is None else time.time() + timeout
+        can_spool = bool(self.spool_dir)
+        while True:
+            spool = self.reserve(size, can_spool, block, deadline)
+            if not spool:
+                with self.budget:
+                    self.entries[id(item)] = (size, 0, [])
+                break
+            try:
+                spooled_size, paths = self.spool(item)
+            except Exception as e:
+                logging.error(f"Failed to spool upload outputs, waiting for memory: {e}")
+                with self.budget:
+                    self.bytes_spooled -= size
+                    self.budget.notify_all()
+                can_spool = False
+                continue
+            with self.budget:
+                self.bytes_spooled += spooled_size - size
+                self.spooled_count += len(paths)
+                self.entries[id(item)] = (0, spooled_size, paths)
+            break
+        # Unbounded by length, the budget was reserved above
+        super().put(item)
+
+    def reserve(
+        self, size: int, can_spool: bool, block: bool, deadline: float | None
+    ) -> bool:
+        """Reserves the size in memory, or in the spool when memory is over budget.
+        Returns whether the message has to be spooled."""
+        logged = False
+        with self.budget:
+            while True:
+                if (
+                    self.bytes_in_memory == 0
+                    or self.bytes_in_memory + size <= self.memory_budget
+                ):
+                    self.bytes_in_memory += size
+                    return False
+                if can_spool and self.bytes_spooled + size <= self.spool_budget:
+                    # Encoded images are smaller, adjusted once they are written
+                    self.bytes_spooled += size
+                    return True
+                remaining = None if deadline is None else deadline - time.time()
+                if not block or (remaining is not None and remaining <= 0):
+                    raise queue.Full
+                if not logged:
+                    logging.info("-- Upload: Queue over budget, waiting for uploads --")
+                    logged = True
+                self.budget.wait(remaining)
+
+    def spool(self, item: Dict[str, Any]) -> Tuple[int, List[str]]:
+        """Writes the outputs of the message to the spool directory.
+        Returns the bytes written and the files."""
+        spooled: List[Tuple[Any, str, SpooledFile]] = []
+        paths: List[str] = []
+        try:
+            for output in message_outputs(item):
+                if getattr(output, "image", None) is not None:
+                    path = os.path.join(
+                        self.spool_dir, f"{uuid.uuid4()}.{output.target_extension}"
+                    )
+                    paths.append(path)
+                    with encoded_image(
+                        output.image, output.target_extension, output.target_quality
+                    ) as (body, size), open(path, "wb") as f:
+                        if isinstance(body, bytes):
+                            f.write(body)
+                        else:
+                            shutil.copyfileobj(body, f)
+                    spooled.append((output, "image", SpooledFile(path, size)))
+                elif isinstance(getattr(output, "audio_bytes", None), BytesIO):
+                    path = os.path.join(self.spool_dir, f"{uuid.uuid4()}.wav")
+                    paths.append(path)
+                    with open(path, "wb") as f:
+                        f.write(output.audio_bytes.getvalue())
+                    spooled.append(
+                        (output, "audio_bytes", SpooledFile(path, os.path.getsize(path)))
+                    )
+        except Exception:
+            remove_files(paths)
+            raise
+        # Only once all of them are written, a failed spool leaves the message as it was
+        for output, attribute, spooled_file in spooled:
+            setattr(output, attribute, spooled_file)
+        return sum(spooled_file.size for _, _, spooled_file in spooled), paths
+
+    def get(self, block: bool = True, timeout: float | None = None) -> Dict[str, Any]:
+        item = super().get(block, timeout)
+        for output in message_outputs(item):
+            audio_bytes = getattr(output, "audio_bytes", None)
+            if isinstance(audio_bytes, SpooledFile):
+                # The audio helpers need the WAV in memory, images are uploaded from their file
+                with open(audio_bytes.path, "rb") as f:
+                    output.audio_bytes = BytesIO(f.read())
+        return item
+
+    def release(self, item: Dict[str, Any]):
+        """Frees the budget of a message taken off the queue and removes its spool files"""
+        with self.budget:
+            memory_size, spooled_size, paths = self.entries.pop(id(item), (0, 0, []))
+            self.bytes_in_memory -= memory_size
+            self.bytes_spooled -= spooled_size
+            self.spooled_count -= len(paths)
+            self.budget.notify_all()
+        remove_files(paths)
+
+    def gauges(self) -> Dict[str, int]:
+        with self.budget:
+            return {
+                "depth": self.qsize(),
+                "bytes_in_memory": self.bytes_in_memory,
+                "bytes_spooled": self.bytes_spooled,
+                "spooled_files": self.spooled_count,
+            }
+
+    def log(self):
+        gauges = self.gauges()
+        print(
+            tabulate(
+                [
+                    [
+                        gauges["depth"],
+                        f"{gauges['bytes_in_memory'] / 1024**2:.1f}",
+                        f"{self.memory_budget / 1024**2:.0f}",
+                        f"{gauges['bytes_spooled'] / 1024**2:.1f}",
+                        gauges["spooled_files"],
+                    ]
+                ],
+                headers=[
+                    "Queue depth",
+                    "Memory MB",
+                    "Budget MB",
+                    "Spooled MB",
+                    "Spooled files",
+                ],
+                tablefmt="double_grid",
+            )
+        )
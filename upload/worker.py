@@ -2,84 +2,169 @@ import logging
 import traceback
 import queue
 
+from concurrent.futures import Executor
 from threading import Event
-from typing import List, Dict, Any
+from typing import Callable, List, Dict, Any
 
-from boto3_type_annotations.s3 import ServiceResource
+from boto3_type_annotations.s3 import Client
 
 
-from predict.image.predict import PredictResult as PredictResultForImage
-from predict.voiceover.predict import PredictResult as PredictResultForVoiceover
-from rabbitmq_consumer.events import Status
-from shared.webhook import post_webhook
+from predict.image.classes import PredictResult as PredictResultForImage
+from predict.voiceover.classes import PredictResult as PredictResultForVoiceover
+from rabbitmq_consumer.events import Event as WebhookEvent, Status
+from shared.webhook import webhook_dispatcher, webhook_job_key
+from upload.encode import encoder_pool
+from upload.engine import UploadEngine
 from upload.upload import upload_files_for_image, upload_files_for_voiceover
+from upload.upload_queue import UploadQueue
+
+
+def create_output_event_sender(
+    uploadMsg: Dict[str, Any], outputs_count: int
+) -> Callable[[int, Dict[str, Any]], None]:
+    """Posts an OUTPUT event for each image of the job as soon as it's stored,
+    COMPLETED still follows with all of them"""
+    prompt_embed = uploadMsg["upload_output"].outputs[0].open_clip_prompt_embed
+    response = {
+        key: value
+        for key, value in uploadMsg.items()
+        if key not in ("upload_output", "upload_prefix")
+    }
+
+    def send_output_event(index: int, image: Dict[str, Any]):
+        event = {
+            **response,
+            "status": Status.PROCESSING,
+            "output": {
+                "prompt_embed": prompt_embed,
+                "images": [image],
+                "image_index": index,
+                "image_count": outputs_count,
+            },
+        }
+        webhook_dispatcher.submit(
+            uploadMsg["webhook_url"], event, job_key=webhook_job_key(uploadMsg)
+        )
+
+    return send_output_event
+
+
+def wants_output_events(uploadMsg: Dict[str, Any]) -> bool:
+    if "webhook_events_filter" not in uploadMsg:
+        return WebhookEvent.OUTPUT in WebhookEvent.default_events()
+    return WebhookEvent.OUTPUT in uploadMsg["webhook_events_filter"]
+
+
+def process_upload_message(
+    worker_type: str,
+    uploadMsg: Dict[str, Any],
+    s3: Client,
+    s3_bucket: str,
+    executor: Executor,
+):
+    """Uploads the outputs of a job, then sends its response to the webhook"""
+    try:
+        if "upload_output" in uploadMsg:
+            predict_result: PredictResultForImage | PredictResultForVoiceover = (
+                uploadMsg["upload_output"]
+            )
+            if len(predict_result.outputs) > 0:
+                logging.info(
+                    f"-- Upload: Uploading {len(predict_result.outputs)} files --"
+                )
+                try:
+                    if worker_type == "voiceover":
+                        uploadMsg["output"] = {
+                            "audio_files": upload_files_for_voiceover(
+                                predict_result.outputs,
+                                s3,
+                                s3_bucket,
+                                uploadMsg["upload_prefix"],
+                                executor,
+                            ),
+                        }
+                    else:
+                        # Final for the image job
+                        uploadMsg["output"] = {
+                            "prompt_embed": predict_result.outputs[
+                                0
+                            ].open_clip_prompt_embed,
+                            "images": upload_files_for_image(
+                                predict_result.outputs,
+                                s3,
+                                s3_bucket,
+                                uploadMsg["upload_prefix"],
+                                executor,
+                                on_uploaded=(
+                                    create_output_event_sender(
+                                        uploadMsg, len(predict_result.outputs)
+                                    )
+                                    if wants_output_events(uploadMsg)
+                                    else None
+                                ),
+                            ),
+                        }
+                except Exception as e:
+                    tb = traceback.format_exc()
+                    logging.error(f"Error uploading files {tb}\n")
+                    uploadMsg["status"] = Status.FAILED
+                    uploadMsg["error"] = str(e)
+                logging.info(f"-- Upload: Finished uploading files --")
+
+        if "upload_output" in uploadMsg:
+            logging.info(f"-- Upload: Deleting upload_output from message --")
+            del uploadMsg["upload_output"]
+        if "upload_prefix" in uploadMsg:
+            logging.info(f"-- Upload: Deleting upload_prefix from message --")
+            del uploadMsg["upload_prefix"]
+
+        logging.info(f"-- Upload: Publishing to WEBHOOK --")
+        webhook_dispatcher.submit(uploadMsg["webhook_url"], uploadMsg)
+    except Exception as e:
+        tb = traceback.format_exc()
+        logging.error(f"Exception in upload process {tb}\n")
+        logging.error(f"Message was: {uploadMsg}\n")
+
+
+def release_upload_message(q: UploadQueue, uploadMsg: Dict[str, Any]):
+    q.release(uploadMsg)
+    q.log()
+    webhook_dispatcher.log()
 
 
 def start_upload_worker(
     worker_type: str,
-    q: queue.Queue[Dict[str, Any]],
-    s3: ServiceResource,
+    q: UploadQueue,
+    s3: Client,
     s3_bucket: str,
     shutdown_event: Event,
 ):
-    """Starts a loop to read from the queue and upload files to S3, send responses to webhook"""
+    """Starts a loop to read from the queue and upload files to S3, send responses to webhook.
+    Jobs are pipelined on the upload engine, each one posts its webhook after its own uploads."""
     logging.info("Starting upload thread...")
+    engine = UploadEngine()
+    if worker_type == "image":
+        encoder_pool.start()
     while not shutdown_event.is_set() or not q.empty():
         try:
             # logging.info(f"-- Upload: Waiting for queue --\n")
-            uploadMsg: List[Dict[str, Any]] = q.get(timeout=1)
+            uploadMsg: Dict[str, Any] = q.get(timeout=1)
             # logging.info(f"-- Upload: Got from queue --\n")
-            if "upload_output" in uploadMsg:
-                predict_result: PredictResultForImage | PredictResultForVoiceover = (
-                    uploadMsg["upload_output"]
-                )
-                if len(predict_result.outputs) > 0:
-                    logging.info(
-                        f"-- Upload: Uploading {len(predict_result.outputs)} files --"
-                    )
-                    try:
-                        if worker_type == "voiceover":
-                            uploadMsg["output"] = {
-                                "audio_files": upload_files_for_voiceover(
-                                    predict_result.outputs,
-                                    s3,
-                                    s3_bucket,
-                                    uploadMsg["upload_prefix"],
-                                ),
-                            }
-                        else:
-                            # Final for the image job
-                            uploadMsg["output"] = {
-                                "prompt_embed": predict_result.outputs[
-                                    0
-                                ].open_clip_prompt_embed,
-                                "images": upload_files_for_image(
-                                    predict_result.outputs,
-                                    s3,
-                                    s3_bucket,
-                                    uploadMsg["upload_prefix"],
-                                ),
-                            }
-                    except Exception as e:
-                        tb = traceback.format_exc()
-                        logging.error(f"Error uploading files {tb}\n")
-                        uploadMsg["status"] = Status.FAILED
-                        uploadMsg["error"] = str(e)
-                    logging.info(f"-- Upload: Finished uploading files --")
-
-            if "upload_output" in uploadMsg:
-                logging.info(f"-- Upload: Deleting upload_output from message --")
-                del uploadMsg["upload_output"]
-            if "upload_prefix" in uploadMsg:
-                logging.info(f"-- Upload: Deleting upload_prefix from message --")
-                del uploadMsg["upload_prefix"]
-
-            logging.info(f"-- Upload: Publishing to WEBHOOK --")
-            post_webhook(uploadMsg["webhook_url"], uploadMsg)
+            future = engine.submit_job(
+                process_upload_message,
+                worker_type,
+                uploadMsg,
+                s3,
+                s3_bucket,
+                engine.executor,
+            )
+            # Its memory and spool files are held until the webhook is sent
+            future.add_done_callback(lambda _, msg=uploadMsg: release_upload_message(q, msg))
         except queue.Empty:
             continue
         except Exception as e:
             tb = traceback.format_exc()
             logging.error(f"Exception in upload process {tb}\n")
-            logging.error(f"Message was: {uploadMsg}\n")
+    engine.shutdown()
+    encoder_pool.shutdown()
     logging.info("Upload thread exiting")